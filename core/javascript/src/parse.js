@@ -341,9 +341,71 @@ function doAttrLookup(ns, identifier) {
   return result;
 }
 
-function createSemantics(grammar) {
+// Expressions that create ops get a trailing {"__pos": [file, line, column]}
+// argument, so the compiler can map ops back to source.
+const positionedExpressionTypes = {
+  "_named_apply": true,
+  "_named_apply_keywords": true,
+  "_named_tensor": true,
+  "_named_var": true,
+};
+
+function isPosition(value) {
+  return value !== null && typeof value === "object" && !(value instanceof Array) && "__pos" in value;
+}
+
+function hasPosition(expr: any[]): bool {
+  return expr.length > 0 && isPosition(expr[expr.length - 1]);
+}
+
+function lineStartOffsets(source: string): number[] {
+  var offsets = [0];
+  for (var ix = 0; ix < source.length; ++ix) {
+    if (source[ix] === "\n") {
+      offsets.push(ix + 1);
+    }
+  }
+  return offsets;
+}
+
+function lineAndColumn(lineStarts: number[], offset: number): number[] {
+  var lo = 0;
+  var hi = lineStarts.length - 1;
+  while (lo < hi) {
+    var mid = (lo + hi + 1) >> 1;
+    if (lineStarts[mid] <= offset) {
+      lo = mid;
+    } else {
+      hi = mid - 1;
+    }
+  }
+
+  return [lo + 1, offset - lineStarts[lo] + 1];
+}
+
+function createSemantics(grammar, source: string, filename: ?string) {
   var s = grammar.createSemantics();
   var anonIncrement = 0;
+  var lineStarts = lineStartOffsets(source);
+
+  // Attach the position of node to every op-creating expression in expr that
+  // doesn't already have one. Children are positioned before their parents,
+  // so we only descend until we see an expression that's been positioned.
+  function withPosition(node, expr) {
+    if (!(expr instanceof Array) || hasPosition(expr)) {
+      return expr;
+    }
+
+    expr.forEach((e) => { withPosition(node, e); });
+
+    if (positionedExpressionTypes[expr[0]] === true) {
+      var [line, column] = lineAndColumn(lineStarts, node.source.startIdx);
+      expr.push({"__pos": [filename, line, column]});
+    }
+
+    return expr;
+  }
+
   s.addAttribute(
     'asJson',
     {
@@ -436,7 +498,7 @@ function createSemantics(grammar) {
         return ["list"].concat(elems.asJson);
       },
       TensorLiteral: function(child) {
-        return ["_named_tensor", null, null, null, child.asJson];
+        return withPosition(this, ["_named_tensor", null, null, null, child.asJson]);
       },
       FunctionLiteral: function(_, signature, block) {
         return processFunctionBody(null, signature.asJson, block.asJson);
@@ -489,13 +551,13 @@ function createSemantics(grammar) {
         return ["_named_var_update", name.asJson, rhs.asJson];
       },
       VariableDeclaration: function(_1, _2, name, type, shape, _3, rhs) {
-        return [
+        return withPosition(this, [
           "_named_var", name.asJson,
           shape.asJson, type.asJson[0],
           rewriteExpressionWithShape(shape.asJson,
               rewriteExpressionWithType(type.asJson[0],
                   rhs.asJson))
-        ];
+        ]);
       },
       LetAssignment: function(_1, _2, name, _3, type, shape, _4, rhs) {
         return rewriteExpressionWithType(type.asJson[0],
@@ -503,7 +565,7 @@ function createSemantics(grammar) {
               rewriteExpressionWithName(name.asJson, rhs.asJson)));
       },
       Expression: function(child, _1, _2, _3, nameExpr) {
-        var childExpr = child.asJson;
+        var childExpr = withPosition(this, child.asJson);
         var name = nameExpr.asJson[0];
         if (!name) {
           return childExpr;
@@ -550,7 +612,7 @@ function createSemantics(grammar) {
           return exprs[0];
         }
 
-        return exprs.reduce(function(acc, e, ix) {
+        return withPosition(this, exprs.reduce(function(acc, e, ix) {
           if (!acc) {
             return e;
           }
@@ -582,30 +644,30 @@ function createSemantics(grammar) {
 
             return e;
           }
-        });
+        }));
       },
       Expression2: function(subexpr) {
-        return reduceOperandList(subexpr.asJson, {
+        return withPosition(this, reduceOperandList(subexpr.asJson, {
           "<=": "less_equal",
           "<": "less",
           "==": "equal",
           "!=": "not_equal",
           ">=": "greater_equal",
           ">": "greater",
-        });
+        }));
       },
       Expression3: function(subexpr) {
-        return reduceOperandList(subexpr.asJson, {
+        return withPosition(this, reduceOperandList(subexpr.asJson, {
           "+": "add",
           "-": "subtract",
-        });
+        }));
       },
       Expression4: function(subexpr) {
-        return reduceOperandList(subexpr.asJson, {
+        return withPosition(this, reduceOperandList(subexpr.asJson, {
           "%": "mod",
           "*": "multiply",
           "/": "divide",
-        });
+        }));
       },
       indexSuffix: function(_, identifier) {
         return identifier.asJson;
@@ -630,18 +692,18 @@ function createSemantics(grammar) {
         return result;
       },
       Expression6_applyPos: function(ns, fn_name, indexSuffix, attrs, _1, argList, _2) {
-        return [
+        return withPosition(this, [
           "_named_apply", null,
           doIndex(doLookup(ns.asJson[0], fn_name.asJson), indexSuffix.asJson[0]),
           attrs.asJson[0],
-          ...(argList.asJson || [])];
+          ...(argList.asJson || [])]);
       },
       Expression6_applyKwd: function(ns, fn_name, indexSuffix, attrs, _1, keywordArgs, _2) {
-        return [
+        return withPosition(this, [
           "_named_apply_keywords", null,
           doLookup(ns.asJson[0], fn_name.asJson),
           attrs.asJson[0],
-          keywordArgs.asJson];
+          keywordArgs.asJson]);
       },
       KeywordArguments: function(args) {
         return ["_sf_map", ...args.asJson];
@@ -716,9 +778,9 @@ function createSemantics(grammar) {
   return s;
 };
 
-var parseExpressions = function(source: string) {
+var parseExpressions = function(source: string, filename: ?string) {
   var grammar = loadGrammar();
-  var semantics = createSemantics(grammar);
+  var semantics = createSemantics(grammar, source, filename || null);
 
   var m = grammar.match(source);
   if (m.failed()) {
@@ -1,3 +1,7 @@
+import multiprocessing
+
 from nao import cli
 
+# --test-workers spawns processes, which need to find their way back here.
+multiprocessing.freeze_support()
 cli.main()
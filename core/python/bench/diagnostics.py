@@ -0,0 +1,72 @@
+"""Times compiling a large program with diagnostics on and off.
+
+Usage: python bench/diagnostics.py [--functions 500] [--repeat 3]
+
+Generates a package of many small exported functions and compiles it with
+--log-level debug and with --log-level warning. Debug output goes to
+/dev/null, so this measures formatting it rather than the terminal.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+
+from os import path
+
+from nao import log as nao_log
+from nao.compiler.compiler import Compiler
+
+def program(functions):
+  lines = []
+  for ix in range(functions):
+    lines.extend([
+      "func Layer%d(x float) {" % ix,
+      "  let a = x * %d.0" % (ix + 1),
+      "  let b = a + 1.0",
+      "  emit y = b * b",
+      "}",
+      "",
+    ])
+  return "\n".join(lines)
+
+def compile_once(workdir, source):
+  compiler = Compiler(
+      path.join(workdir, "src"),
+      path.join(workdir, "pkg"),
+      path.join(workdir, "assets"))
+  compiler.put_source("main.nao", source)
+  compiler.resolve_import_path("main")
+  return compiler.meta_graph_def()
+
+def bench(level, workdir, source, repeat):
+  nao_log.configure(level)
+  stderr = sys.stderr
+  best = None
+  with open("/dev/null", "w") as devnull:
+    sys.stderr = devnull
+    try:
+      for _ in range(repeat):
+        start = time.time()
+        compile_once(workdir, source)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    finally:
+      sys.stderr = stderr
+  print("%-8s %8.3fs" % (level, best))
+  return best
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--functions", type=int, default=500)
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+
+  workdir = tempfile.mkdtemp()
+  source = program(args.functions)
+  debug = bench("debug", workdir, source, args.repeat)
+  quiet = bench("warning", workdir, source, args.repeat)
+  print("diagnostics cost %.1f%% of compile time" % (100.0 * (debug - quiet) / debug))
+
+if __name__ == '__main__':
+  sys.exit(main())
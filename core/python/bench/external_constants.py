@@ -0,0 +1,78 @@
+"""Times loading an exported metagraph with large constants.
+
+Usage: python bench/external_constants.py [--megabytes 500] [--dir DIR]
+
+Writes a binary MetaGraphDef whose constants are inline, and a copy whose
+constants were moved to a sidecar with graph_xform.externalize_constants. For
+each, times parsing the file, importing it and initializing its variables.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+
+from os import path
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.python.framework import meta_graph
+
+from nao.run import graph_execution
+from nao.structure import graph_io
+from nao.structure import graph_xform
+
+def write_model(filepath, megabytes, arrays):
+  floats_per_array = megabytes * 1024 * 1024 // 4 // arrays
+  with tf.Graph().as_default():
+    total = None
+    for ix in range(arrays):
+      value = np.random.rand(floats_per_array).astype(np.float32)
+      weight = tf.reduce_sum(tf.constant(value, name="model/w%d" % ix))
+      total = weight if total is None else total + weight
+    tf.identity(total, name="model/total")
+
+    meta_graph_def, _ = meta_graph.export_scoped_meta_graph()
+  graph_io.write_meta_graph_def(meta_graph_def, filepath, binary=True)
+  return meta_graph_def
+
+def timed(name, fn):
+  start = time.time()
+  result = fn()
+  print("%-28s %8.3fs" % (name, time.time() - start))
+  return result
+
+def load(filepath, label):
+  meta_graph_def = timed("%s parse" % label, lambda: graph_io.read_meta_graph_def(filepath))
+  with tf.Graph().as_default():
+    with graph_execution.create_session() as sess:
+      timed("%s import" % label, lambda: graph_execution.import_meta_graph(sess, meta_graph_def))
+      timed("%s initialize" % label, lambda: sess.run(tf.global_variables_initializer()))
+      return timed("%s first run" % label, lambda: sess.run("model/total:0"))
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--megabytes", type=int, default=500)
+  parser.add_argument("--arrays", type=int, default=16)
+  parser.add_argument("--min-bytes", type=int, default=1024 * 1024)
+  parser.add_argument("--dir", type=str, default=None)
+  args = parser.parse_args()
+
+  workdir = args.dir or tempfile.mkdtemp()
+  inline_path = path.join(workdir, "inline.metagraph.pb")
+  external_path = path.join(workdir, "external.metagraph.pb")
+
+  meta_graph_def = timed("write inline", lambda: write_model(inline_path, args.megabytes, args.arrays))
+  graph_xform.externalize_constants(meta_graph_def, path.join(workdir, "external.consts"), args.min_bytes)
+  timed("write external", lambda: graph_io.write_meta_graph_def(meta_graph_def, external_path, binary=True))
+  print("%-28s %8d bytes" % ("inline metagraph", path.getsize(inline_path)))
+  print("%-28s %8d bytes" % ("external metagraph", path.getsize(external_path)))
+
+  inline_total = load(inline_path, "inline")
+  external_total = load(external_path, "external")
+  if not np.isclose(inline_total, external_total):
+    raise Exception("Results differ: %s vs %s" % (inline_total, external_total))
+
+if __name__ == '__main__':
+  sys.exit(main())
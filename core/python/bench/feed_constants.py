@@ -0,0 +1,71 @@
+"""Times loading a large --feed-constants file.
+
+Usage: python bench/feed_constants.py [--megabytes 500] [--dir DIR]
+
+Writes a binary GraphDef of float32 constants, then compares parsing it with
+repeated-field decoding (how feeds used to be loaded), a cold tensor_io load
+(which also fills the cache) and a warm, memory-mapped tensor_io load.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+
+from os import path
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.python.framework import tensor_util
+
+from nao.structure import graph_io
+from nao.structure import tensor_io
+
+def write_feed(filepath, megabytes, arrays):
+  floats_per_array = megabytes * 1024 * 1024 // 4 // arrays
+  with tf.Graph().as_default() as g:
+    for ix in range(arrays):
+      value = np.random.rand(floats_per_array).astype(np.float32)
+      tf.constant(value, name="feed/c%d" % ix)
+    graph_io.write_graph_def(g.as_graph_def(), filepath, True)
+
+def load_repeated_fields(filepath):
+  graph_def = graph_io.read_graph_def(filepath, True)
+  d = {}
+  for node in graph_def.node:
+    # Round trip through float_val, as feeds written by hand often are.
+    tensor = node.attr['value'].tensor
+    values = tensor_util.MakeNdarray(tensor).ravel().tolist()
+    d[node.name] = values
+  return d
+
+def timed(name, fn):
+  start = time.time()
+  result = fn()
+  print("%-28s %8.3fs" % (name, time.time() - start))
+  return result
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--megabytes", type=int, default=500)
+  parser.add_argument("--arrays", type=int, default=16)
+  parser.add_argument("--dir", type=str, default=None)
+  args = parser.parse_args()
+
+  workdir = args.dir or tempfile.mkdtemp()
+  filepath = path.join(workdir, "feed.graph.pb")
+  cache_dir = path.join(workdir, "cache")
+
+  timed("write feed", lambda: write_feed(filepath, args.megabytes, args.arrays))
+  timed("repeated fields", lambda: load_repeated_fields(filepath))
+
+  tensor_io.clear_feed_cache()
+  timed("tensor_io (cold, caching)", lambda: tensor_io.load_feed_constants(filepath, True, "feed/", cache_dir))
+
+  tensor_io.clear_feed_cache()
+  constants = timed("tensor_io (warm, mmap)", lambda: tensor_io.load_feed_constants(filepath, True, "feed/", cache_dir))
+  timed("touch every page", lambda: sum(float(v.sum()) for v in constants.values()))
+
+if __name__ == '__main__':
+  sys.exit(main())
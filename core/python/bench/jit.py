@@ -0,0 +1,80 @@
+"""Times lenet5 inference with and without XLA JIT compilation.
+
+Usage: python bench/jit.py [--batch 64] [--steps 50]
+
+Builds the same inference graph as models/lenet5.nao three ways: without JIT,
+with each convLayer marked for XLA the way nao.jit marks a function, and with
+the session's global JIT level turned on, as --session-jit does. For each,
+times the first run (which includes compilation) and the steady state.
+Without an XLA-enabled TensorFlow build, all three should match.
+"""
+
+import argparse
+import contextlib
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from nao.compiler.nao import graph_function
+from nao.run import graph_execution
+
+def conv_layer(input, weights, biases):
+  conv = tf.nn.conv2d(input, weights, strides=[1, 1, 1, 1], padding="SAME")
+  relu = tf.nn.relu(tf.nn.bias_add(conv, biases))
+  return tf.nn.max_pool(relu, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding="SAME")
+
+def lenet5(image, jit_layers):
+  def weights(shape):
+    return tf.constant(np.random.normal(scale=0.1, size=shape).astype(np.float32))
+
+  def biases(size):
+    return tf.constant(np.full([size], 0.1, dtype=np.float32))
+
+  def maybe_jit(name):
+    return graph_function.jit_scope(name) if jit_layers else contextlib.ExitStack()
+
+  with maybe_jit("conv1"):
+    x = conv_layer(image, weights([5, 5, 1, 32]), biases(32))
+  with maybe_jit("conv2"):
+    x = conv_layer(x, weights([5, 5, 32, 64]), biases(64))
+  x = tf.reshape(x, [-1, 3136])
+  x = tf.nn.relu(tf.matmul(x, weights([3136, 512])) + biases(512))
+  return tf.matmul(x, weights([512, 10])) + biases(10)
+
+def bench(label, batch, steps, jit_layers, session_jit):
+  np.random.seed(0)
+  with tf.Graph().as_default():
+    image = tf.placeholder(tf.float32, [None, 28, 28, 1])
+    logits = lenet5(image, jit_layers)
+    feed = {image: np.random.rand(batch, 28, 28, 1).astype(np.float32)}
+
+    config = graph_execution.session_config("latency", jit=session_jit)
+    with graph_execution.create_session(config=config) as sess:
+      start = time.time()
+      result = sess.run(logits, feed_dict=feed)
+      first = time.time() - start
+
+      start = time.time()
+      for _ in range(steps):
+        sess.run(logits, feed_dict=feed)
+      steady = (time.time() - start) / steps
+
+  print("%-16s first run %8.3fms, then %8.3fms per step" % (label, first * 1000, steady * 1000))
+  return result
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--batch", type=int, default=64)
+  parser.add_argument("--steps", type=int, default=50)
+  args = parser.parse_args()
+
+  baseline = bench("no jit", args.batch, args.steps, False, False)
+  for label, jit_layers, session_jit in [("nao.jit layers", True, False), ("session jit", False, True)]:
+    result = bench(label, args.batch, args.steps, jit_layers, session_jit)
+    if not np.allclose(baseline, result, rtol=1e-3, atol=1e-3):
+      raise Exception("%s results differ from no jit" % label)
+
+if __name__ == '__main__':
+  sys.exit(main())
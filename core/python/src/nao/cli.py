@@ -16,14 +16,22 @@ import gc
 
 from os import path
 
+from nao import log as nao_log
 from nao.compiler.compiler import Compiler
 from nao.compiler.asset import graph_assets
 
 from nao.structure import graph_io
 from nao.structure import graph_query
+from nao.structure import graph_source
 from nao.structure import graph_xform
+from nao.structure import tensor_io
+from nao.run import graph_checkpoint
 from nao.run import graph_execution
+from nao.run import graph_profile
+from nao.run import graph_trace
+from nao.run import test_runner
 from nao.tool import graph_repl
+from nao.tool import naoconfig
 
 import tensorflow as tf
 from tensorflow.python.framework import meta_graph
@@ -38,7 +46,45 @@ def eprint(*args, **kwargs):
 
 pp = pprint.PrettyPrinter(indent=2, stream=sys.stderr).pprint
 
-def main():
+log = nao_log.get("cli")
+
+def format_freeze_report(report):
+  def secs(value):
+    return "n/a" if value is None else "%.4fs" % value
+
+  lines = [
+    "Froze graph for inference:",
+    "  nodes  %10d -> %10d" % (report["nodes_before"], report["nodes_after"]),
+    "  bytes  %10d -> %10d" % (report["bytes_before"], report["bytes_after"]),
+    "  load   %10s -> %10s" % (secs(report["load_secs_before"]), secs(report["load_secs_after"])),
+    "  run    %10s -> %10s" % (secs(report["run_secs_before"]), secs(report["run_secs_after"])),
+    "  dropped %d logging dependencies, folded %d constant subgraphs, collapsed %d identities" % (
+        report["logging_dropped"], report["folded"], report["identities_collapsed"]),
+  ]
+  if "quantize_mode" in report:
+    lines.append("  quantized %d weights %s, %d -> %d bytes" % (
+        report["quantized"], report["quantize_mode"],
+        report["quantized_bytes_before"], report["quantized_bytes_after"]))
+    if not report["accuracy"]:
+      lines.append("  no test results to measure accuracy against")
+    for entry in report["accuracy"]:
+      if "error" in entry:
+        delta = "error: %s" % entry["error"]
+      elif "max_abs_delta" in entry:
+        delta = "max abs delta %g, max rel delta %g" % (entry["max_abs_delta"], entry["max_rel_delta"])
+      else:
+        delta = "unchanged" if entry["equal"] else "changed"
+      lines.append("  %s: %s" % (entry["name"], delta))
+  return "\n".join(lines)
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+
+  if argv[:1] == ["convert"]:
+    from nao.tool import convert
+    return convert.main(argv[1:])
+
   parser = argparse.ArgumentParser()
 
   parser.add_argument("package_names", type=str, nargs='*')
@@ -58,33 +104,67 @@ def main():
 
   parser.add_argument("--metagraphdef", metavar='FILE', type=str,
                       help="""Graph file to load.""")
-  parser.add_argument("--binary-metagraphdef", default=False, action='store_const', const=True,
-                      help="""Whether or not input is binary.""")
+  parser.add_argument("--binary-metagraphdef", default=None, action='store_const', const=True,
+                      help="""Read --metagraphdef as binary. By default we detect whether it's binary or text.""")
   parser.add_argument("--feed-constants", metavar='FILE', type=str,
-                      help="""Path to GraphDef protobuf with constants to feed""")
+                      help="""Path to GraphDef protobuf, .npy or .npz with constants to feed""")
   parser.add_argument("--feed-constants-strip", metavar='PREFIX', type=str, default="",
                       help="""Prefix to filter for (and strip from) constants""")
   parser.add_argument("--feed-constants-prefix", metavar='PREFIX', type=str,
                       help="""Prefix to add to constant names in feed""")
-  parser.add_argument("--feed-constants-binary", default=False, action='store_const', const=True,
-                      help="""Whether or not feed constant protobuf is binary""")
+  parser.add_argument("--no-feed-cache", default=False, action='store_const', const=True,
+                      help="""Don't cache parsed --feed-constants GraphDefs in ${workspace}/cache""")
+  parser.add_argument("--feed-constants-binary", default=None, action='store_const', const=True,
+                      help="""Read --feed-constants as binary. By default we detect whether it's binary or text.""")
 
   parser.add_argument("--run", default=False, action='store_const', const=True,
                       help="""Run the graph with given (or default) --result* and --feed-* options""")
   parser.add_argument("--run-result-pattern", metavar='PATTERN', type=str, default="^(${package}/Main)/outputs/(.*)$",
                       help="""Pattern to discover run results.""")
-  parser.add_argument("--result-binary", default=False, action='store_const', const=True,
-                      help="""Whether or not to result in binary.""")
+  parser.add_argument("--run-batch", metavar='INPUT', type=str,
+                      help="""Run the graph once per record in INPUT (.jsonl, .tfrecord or .npz) in a single session, writing JSON lines to --result""")
+  parser.add_argument("--run-batch-workers", metavar='N', type=int, default=4,
+                      help="""How many records to run concurrently with --run-batch""")
+  parser.add_argument("--result-binary", default=None, action='store_const', const=True,
+                      help="""Write --result as binary. Defaults to binary for files and text for stdout.""")
+  parser.add_argument("--result-text", dest="result_binary", action='store_const', const=False,
+                      help="""Write --result as text.""")
   parser.add_argument("--result", metavar='FILE', type=str, default="/dev/stdout")
+  parser.add_argument("--result-format", metavar='FORMAT', type=str,
+                      choices=["graph"] + sorted(tensor_io.RESULT_FORMATS.keys()),
+                      help="""How to write --run results. One of graph (a GraphDef of constants), npz, tfrecord or arrow. Defaults to the --result extension, or graph""")
 
   parser.add_argument("--test", default=False, action='store_const', const=True,
                       help="""Run the tests graphs with given (or default) --test-* options""")
   parser.add_argument("--test-result-pattern", metavar='PATTERN', type=str, default="^(${package}/Test[^/]*)/outputs/(.*)$",
                       help="""Pattern to discover test graph results.""")
+  parser.add_argument("--test-workers", metavar='N', type=int, default=0,
+                      help="""Run tests across N worker processes. With 0, tests run one at a time in the --train/--run session""")
+  parser.add_argument("--test-shard", metavar='I/N', type=str,
+                      help="""Only run the I-th of N shards of the tests, counting from 0""")
+  parser.add_argument("--test-timeout", metavar='SECS', type=float,
+                      help="""Fail any single test that takes longer than SECS""")
+  parser.add_argument("--test-report", metavar='FILE', type=str,
+                      help="""Write per-test status and timings to FILE, as JUnit XML if it ends in .xml and JSON otherwise""")
+  parser.add_argument("--test-suite", metavar='FILE', type=str,
+                      help="""Run each {name, source, sources, action, fails, match, antimatch, expect} case in the JSON list in FILE within this process""")
+  parser.add_argument("--no-test-cache", default=False, action='store_const', const=True,
+                      help="""Run every test, even those that passed before and whose sources haven't changed""")
 
   parser.add_argument("--repl", default=False, action='store_const', const=True,
                       help="""Start REPL""")
 
+  parser.add_argument("--serve", metavar='METAGRAPH', type=str,
+                      help="""Serve the exported functions in METAGRAPH over HTTP""")
+  parser.add_argument("--port", metavar='PORT', type=int, default=8000,
+                      help="""Port for --serve""")
+  parser.add_argument("--serve-host", metavar='IP', type=str, default="127.0.0.1",
+                      help="""Address for --serve to listen on""")
+  parser.add_argument("--serve-max-batch-size", metavar='N', type=int, default=32,
+                      help="""Most rows to coalesce into one run for a batchable function""")
+  parser.add_argument("--serve-max-delay-ms", metavar='MS', type=float, default=5,
+                      help="""Longest to wait for more requests before running a batch""")
+
   parser.add_argument("--tensorboard", nargs='?', default="", metavar="IP:PORT",
                       help="""Start tensorboard server on the given address, with the given --log-root or --log-dir""")
 
@@ -96,8 +176,43 @@ def main():
   parser.add_argument("--train-result-pattern", metavar='PATTERN', type=str, default="^(${package}/Train[^/]*)/outputs/(.*)$",
                       help="""Pattern to discover train graph results.""")
 
+  parser.add_argument("--session-profile", metavar='PROFILE', type=str,
+                      choices=graph_execution.SESSION_PROFILES,
+                      help="""Session configuration profile. Defaults to the .naoconfig session profile, if any.""")
+  parser.add_argument("--session-inter-op-threads", metavar='N', type=int,
+                      help="""Override the profile's inter_op_parallelism_threads""")
+  parser.add_argument("--session-intra-op-threads", metavar='N', type=int,
+                      help="""Override the profile's intra_op_parallelism_threads""")
+  parser.add_argument("--session-jit", default=None, action='store_const', const=True,
+                      help="""Let XLA JIT compile every op it can, not just functions wrapped with nao.jit""")
+  parser.add_argument("--autotune-session", default=False, action='store_const', const=True,
+                      help="""Time --run results over a grid of thread pool sizes and save the fastest to .naoconfig""")
+  parser.add_argument("--autotune-session-steps", metavar='N', type=int, default=5,
+                      help="""How many timed steps to run for each autotune candidate""")
+
+  parser.add_argument("--trace", metavar='FILE', type=str,
+                      help="""Write a Chrome trace of every session run during --train, --test and --run to FILE""")
+
+  parser.add_argument("--profile", metavar='FILE', type=str,
+                      help="""Attribute op costs during --train, --test and --run to Tensorlang functions. Writes a JSON report with each phase's costs to FILE and a summary to stderr. Call sites are only known for source compiled with --profile""")
+  parser.add_argument("--profile-steps", metavar='N', type=int, default=1,
+                      help="""How many times to run each set of results while profiling. Must be 1 with --train, since each run is a training step""")
+
+  parser.add_argument("--checkpoint-every-steps", metavar='N', type=int,
+                      help="""While training, save a checkpoint every N steps reported by checkpoint.Step. Training continues during the save, so a checkpoint may include updates from later steps""")
+  parser.add_argument("--checkpoint-every-secs", metavar='SECS', type=float,
+                      help="""While training, save a checkpoint at most every SECS seconds""")
+  parser.add_argument("--checkpoint-dir", metavar='DIR', type=str,
+                      help="""Where to keep training checkpoints. Defaults to ${workspace}/checkpoint/${output-name}""")
+  parser.add_argument("--resume", default=False, action='store_const', const=True,
+                      help="""Restore the latest training checkpoint before training, and resume from its step""")
+
   parser.add_argument("--workspace", metavar='DIR', type=str,
                       help="""Default value for workspace""")
+  parser.add_argument("--log-level", metavar='LEVEL', type=str, choices=sorted(nao_log.LEVELS.keys()),
+                      help="""Which diagnostics to write to stderr. Defaults to the .naoconfig log level, or info.""")
+  parser.add_argument("--log-category", metavar='CATEGORY=LEVEL', type=str, action='append',
+                      help="""Override --log-level for one category of diagnostics: %s""" % ", ".join(sorted(nao_log.CATEGORIES.keys())))
   parser.add_argument("--log-root", metavar='DIR', type=str,
                       help="""Which directory to calculate default log dir from.""")
   parser.add_argument("--log-dir", metavar='DIR', type=str,
@@ -113,12 +228,22 @@ def main():
                       help="""Pattern to discover outputs of graph to output.""")
   parser.add_argument("--output-format", metavar='FORMAT', type=str, default="metagraph",
                       help="""Defaults to metagraph""")
-  parser.add_argument("--output-binary", default=False, action='store_const', const=True,
-                      help="""Whether or not to output in binary.""")
+  parser.add_argument("--output-binary", default=None, action='store_const', const=True,
+                      help="""Write output as binary. This is the default unless --output-file ends in .pbtxt.""")
+  parser.add_argument("--output-text", dest="output_binary", action='store_const', const=False,
+                      help="""Write output as text.""")
+  parser.add_argument("--output-compression", metavar='COMPRESSION', type=str, choices=graph_io.COMPRESSIONS,
+                      help="""Compress output with gzip or zstd. Defaults to the --output-file extension, if any.""")
+  parser.add_argument("--output-externalize-constants", metavar='BYTES', type=int,
+                      help="""Move constants of at least BYTES out of an output metagraph, into a .consts file next to it that's read when variables are initialized""")
+  parser.add_argument("--output-quantize", metavar='MODE', type=str, choices=graph_xform.QUANTIZE_MODES,
+                      help="""With --output-format graph, store large float32 weights as uint8 with a per-tensor or per-channel scale and offset""")
+  parser.add_argument("--output-quantize-test-pattern", metavar='PATTERN', type=str, default="^(${package}/Test[^/]*)/outputs/(.*)$",
+                      help="""Test graph results to compare before and after --output-quantize.""")
   parser.add_argument("--output-file", metavar='FILE', type=str,
                       help="""Path to write output to. Defaults to ${output-name}.${output-format}""")
 
-  FLAGS = parser.parse_args()
+  FLAGS = parser.parse_args(argv)
 
   if FLAGS.reopen_stderr:
     os.close(sys.stderr.fileno())
@@ -128,14 +253,26 @@ def main():
     os.close(sys.stdout.fileno())
     os.dup2(FLAGS.reopen_stdout.fileno(), sys.stdout.fileno())
 
+  if FLAGS.test_suite:
+    from nao.run import test_suite
+    entries = test_suite.run_suite(test_suite.load_cases(FLAGS.test_suite), main)
+    eprint("Test suite: %s" % test_runner.summarize(entries))
+    if FLAGS.test_report:
+      test_runner.write_report(entries, FLAGS.test_report)
+
+    failed = test_runner.failures(entries)
+    if failed:
+      raise Exception("Test suite cases didn't pass: %s" % ", ".join(entry["name"] for entry in failed))
+    return
+
   package_names = FLAGS.package_names
 
   should_parse = len(package_names) > 0 or FLAGS.source
-  if not (should_parse or FLAGS.run or FLAGS.test or FLAGS.output):
+  if not (should_parse or FLAGS.serve or FLAGS.run or FLAGS.run_batch or FLAGS.test or FLAGS.output or FLAGS.autotune_session):
     if os.isatty(1):
       FLAGS.repl = True
 
-  if should_parse and not (FLAGS.repl or FLAGS.run or FLAGS.test or FLAGS.output):
+  if should_parse and not (FLAGS.repl or FLAGS.run or FLAGS.run_batch or FLAGS.test or FLAGS.output or FLAGS.autotune_session):
     FLAGS.output = True
 
   def search_upwards(startdir, filename):
@@ -170,6 +307,28 @@ def main():
   if FLAGS.tensorboard is None:
     FLAGS.tensorboard = "127.0.0.1:6006"
 
+  # Settings in .naoconfig come first, explicit flags win.
+  workspace_config = naoconfig.load(FLAGS.workspace)
+  log_options = workspace_config.get("log", {})
+  log_category_levels = dict(log_options.get("categories", {}))
+  log_category_levels.update(nao_log.parse_category_levels(FLAGS.log_category))
+  nao_log.configure(FLAGS.log_level or log_options.get("level", "info"), log_category_levels)
+
+  session_options = dict(workspace_config.get("session", {}))
+  if FLAGS.session_profile is not None:
+    session_options["profile"] = FLAGS.session_profile
+  if FLAGS.session_inter_op_threads is not None:
+    session_options["inter_op_parallelism_threads"] = FLAGS.session_inter_op_threads
+  if FLAGS.session_intra_op_threads is not None:
+    session_options["intra_op_parallelism_threads"] = FLAGS.session_intra_op_threads
+  if FLAGS.session_jit is not None:
+    session_options["jit"] = FLAGS.session_jit
+
+  def session_config(default_profile=None):
+    options = dict(session_options)
+    profile = options.pop("profile", default_profile)
+    return graph_execution.session_config(profile, **options)
+
   def log_dir_fn_fn(pkg_names):
     if FLAGS.log_dir:
       return lambda: FLAGS.log_dir
@@ -184,15 +343,23 @@ def main():
 
     return log_dir_fn
 
+  if FLAGS.output_quantize and FLAGS.output_format != "graph":
+    raise Exception("--output-quantize only works with --output-format graph, not %s" % FLAGS.output_format)
+
+  # Positions attribute profiled costs to source lines. Otherwise they're just overhead.
+  graph_source.set_recording(bool(FLAGS.profile))
+
   def new_compiler():
     return Compiler(
         FLAGS.root,
         FLAGS.output_root,
-        FLAGS.assets_root)
+        FLAGS.assets_root,
+        session_config=session_config("interactive"))
 
   meta_graph_def = None
 
   output_package_names = None
+  package_digests = {}
 
   if should_parse:
     p = new_compiler()
@@ -211,6 +378,8 @@ def main():
         p.resolve_import_path(package_name)
 
     meta_graph_def = p.meta_graph_def()
+    for package_name in package_names:
+      package_digests[package_name] = p.import_digest(package_name)
     p = None
     # print("parsed", expressions)
     # We need to do this so we clean up references to py_funcs. LAME.
@@ -233,8 +402,12 @@ def main():
 
   if FLAGS.output and FLAGS.output_name and not FLAGS.output_file:
     output_suffix = "." + FLAGS.output_format + ".pb"
-    if not FLAGS.output_binary:
+    if FLAGS.output_binary is False:
       output_suffix += "txt"
+    if FLAGS.output_compression == "gzip":
+      output_suffix += ".gz"
+    elif FLAGS.output_compression == "zstd":
+      output_suffix += ".zst"
     FLAGS.output_file = FLAGS.output_root + "/" + FLAGS.output_name + output_suffix
 
   # Now that we know our package names, use them to target the proper results.
@@ -245,8 +418,9 @@ def main():
 
   output_package_pattern = "(?:" + str.join("|", output_package_names) + ")"
   FLAGS.output_result_pattern = FLAGS.output_result_pattern.replace("${package}", output_package_pattern)
-  eprint("FLAGS", FLAGS)
-  eprint("package_names", package_names)
+  FLAGS.output_quantize_test_pattern = FLAGS.output_quantize_test_pattern.replace("${package}", output_package_pattern)
+  log.debug("FLAGS %s", FLAGS)
+  log.debug("package_names %s", package_names)
 
   if FLAGS.tensorboard != "":
     tb_host, tb_port = FLAGS.tensorboard.split(':', 1)
@@ -262,7 +436,7 @@ def main():
     from nao.tool import jupyter_kernel, jupyter_kernel_driver
 
     if jupyter_config_file:
-      eprint("Reading jupyter_config file '%s'..." % jupyter_config_file)
+      log.info("Reading jupyter_config file '%s'...", jupyter_config_file)
       jupyter_config = json.loads("".join(open(jupyter_config_file).readlines()))
     else:
       import uuid
@@ -287,11 +461,13 @@ def main():
     feed_dict = {}
     # Properly find and strip prefix of constants, loading them with given prefix to feed_dict
     if FLAGS.feed_constants:
-      feed_graph_def = graph_io.read_graph_def(FLAGS.feed_constants, FLAGS.feed_constants_binary)
-      constants = graph_query.find_nodes_with_prefix(feed_graph_def, FLAGS.feed_constants_strip)
-      constants_dict = graph_xform.constants_as_dict(constants)
+      constants_dict = tensor_io.load_feed_constants(
+          FLAGS.feed_constants,
+          binary=FLAGS.feed_constants_binary,
+          strip_prefix=FLAGS.feed_constants_strip,
+          cache_dir=None if FLAGS.no_feed_cache else path.join(FLAGS.workspace, "cache", "feeds"))
       strip_prefix = FLAGS.feed_constants_strip
-      add_prefix = FLAGS.feed_constants_prefix
+      add_prefix = FLAGS.feed_constants_prefix or ""
       for name, value in constants_dict.items():
         if strip_prefix != None:
           if name.startswith(strip_prefix):
@@ -300,8 +476,17 @@ def main():
             continue
         feed_dict[add_prefix + name + ":0"] = value
 
+    if FLAGS.metagraphdef:
+      feed_dict.update(graph_xform.relocated_file_feeds(
+          tf.get_default_graph(),
+          path.dirname(path.abspath(FLAGS.metagraphdef))))
+    if FLAGS.serve:
+      feed_dict.update(graph_xform.relocated_file_feeds(
+          tf.get_default_graph(),
+          path.dirname(path.abspath(FLAGS.serve))))
+
     asset_map = graph_assets.load_asset_map(tf.get_default_graph())
-    eprint("asset_map", asset_map)
+    log.debug("asset_map %s", asset_map)
 
     assets_by_path = {}
     missing_assets = {}
@@ -319,57 +504,201 @@ def main():
       for asset_path, asset in missing_assets.items():
         graph_assets.maybe_download(asset_path, asset["url"])
 
-    eprint("feed_dict", feed_dict)
+    log.debug("feed_dict %s", feed_dict)
     return feed_dict
 
-  if FLAGS.train:
-    def post_train(session, result_scope_prefixes):
-      graph = session.graph
+  if FLAGS.serve:
+    from nao.tool import inference_server
+    serve_meta_graph_def = graph_io.read_meta_graph_def(
+        FLAGS.serve,
+        FLAGS.binary_metagraphdef)
+    sys.exit(inference_server.serve(
+      meta_graph_def=serve_meta_graph_def,
+      feed_dict_fn=feed_dict_fn,
+      host=FLAGS.serve_host,
+      port=FLAGS.port,
+      max_batch_size=FLAGS.serve_max_batch_size,
+      max_delay_ms=FLAGS.serve_max_delay_ms,
+      config=session_config("throughput"),
+    ))
+
+  if FLAGS.trace:
+    graph_trace.set_trace_collector(graph_trace.TraceCollector(FLAGS.trace))
+
+  if FLAGS.profile:
+    if FLAGS.train and FLAGS.profile_steps > 1:
+      raise Exception("--profile-steps %d would repeat training steps, use it with --test or --run instead of --train" % FLAGS.profile_steps)
+    graph_profile.set_profile_collector(graph_profile.FunctionCostCollector(FLAGS.profile_steps))
+
+  if FLAGS.autotune_session:
+    best = graph_execution.autotune_session_config(
+      meta_graph_def=meta_graph_def,
+      result_pattern=re.compile(FLAGS.run_result_pattern),
+      feed_dict_fn=feed_dict_fn,
+      profile=session_options.get("profile"),
+      steps=FLAGS.autotune_session_steps,
+    )
+    naoconfig.update(FLAGS.workspace, "session", best)
+    session_options.update(best)
+    eprint("Saved session settings to %s" % naoconfig.config_path(FLAGS.workspace))
+
+  def output_sidecar_path(extension):
+    # Keep files that the output graph refers to next to it.
+    if FLAGS.output_file:
+      return re.sub(r"\.(metagraph|graph)\.pb(txt)?(\.gz|\.zst)?$", "", FLAGS.output_file) + extension
+    return path.join(FLAGS.output_root, (FLAGS.output_name or "trained") + extension)
+
+  def trained_checkpoint_prefix():
+    return output_sidecar_path(".ckpt")
 
+  phases = []
+  if FLAGS.train:
+    def trained_vars(graph, result_scope_prefixes):
       trained_var_name_bs = set()
       for result_scope_prefix in result_scope_prefixes:
         collection_name = "%s:variable_names" % result_scope_prefix
-        eprint("collection_name", collection_name)
+        log.debug("collection_name %s", collection_name)
         for var_name_b in graph.get_collection_ref(collection_name):
           trained_var_name_bs.add(var_name_b)
 
       var_names = [b.decode('utf-8') for b in trained_var_name_bs]
-      vars = graph_query.find_variables_by_name(
+      return var_names, graph_query.find_variables_by_name(
           graph.get_collection_ref("variables"),
           var_names)
-      eprint("saving vars", var_names, vars)
-      graph_xform.replace_variable_initializers_with_current_values(
-          graph,
+
+    checkpoint_dir = FLAGS.checkpoint_dir
+    if checkpoint_dir is None:
+      checkpoint_dir = path.join(FLAGS.workspace, "checkpoint", FLAGS.output_name or "trained")
+
+    def pre_train(session, result_scope_prefixes):
+      if not (FLAGS.resume or FLAGS.checkpoint_every_steps or FLAGS.checkpoint_every_secs):
+        return
+
+      _, vars = trained_vars(session.graph, result_scope_prefixes)
+      if FLAGS.resume:
+        graph_checkpoint.set_resume_step(
+            graph_checkpoint.restore_latest(session, vars, checkpoint_dir))
+
+      if FLAGS.checkpoint_every_steps or FLAGS.checkpoint_every_secs:
+        if not path.exists(checkpoint_dir):
+          os.makedirs(checkpoint_dir)
+        graph_checkpoint.set_checkpointer(graph_checkpoint.PeriodicCheckpointer(
+            session,
+            vars,
+            path.join(checkpoint_dir, "model.ckpt"),
+            every_steps=FLAGS.checkpoint_every_steps,
+            every_secs=FLAGS.checkpoint_every_secs))
+
+    def post_train(session, result_scope_prefixes):
+      graph_checkpoint.stop_checkpointer()
+
+      var_names, vars = trained_vars(session.graph, result_scope_prefixes)
+      log.debug("saving vars %s %s", var_names, vars)
+      graph_xform.replace_variable_initializers_with_checkpoint(
+          session,
           vars,
+          trained_checkpoint_prefix(),
           "Trained")
 
-    graph_execution.import_and_run_meta_graph(
-      meta_graph_def=meta_graph_def,
-      feed_dict_fn=feed_dict_fn,
-      result_pattern=re.compile(FLAGS.train_result_pattern),
+    phases.append(graph_execution.Phase(
+      "train",
+      re.compile(FLAGS.train_result_pattern),
       finish_session_fn=post_train,
-      log_dir_fn=lambda x: log_dir_fn_fn(x)(),
-    )
-    meta_graph_def, _ = meta_graph.export_scoped_meta_graph()
+      start_session_fn=pre_train))
+
+  test_pattern = re.compile(FLAGS.test_result_pattern)
+  test_shard = test_runner.parse_shard(FLAGS.test_shard) if FLAGS.test_shard else None
+  def select_tests(name_index):
+    prefixes = test_runner.find_test_prefixes(name_index, test_pattern)
+    return test_runner.select_shard(prefixes, test_shard)
+
+  test_cache = None
+  # Trained variables aren't covered by source digests, so don't trust a cache then.
+  if FLAGS.test and not (FLAGS.no_test_cache or FLAGS.train or FLAGS.metagraphdef):
+    feeds_salt = None
+    if FLAGS.feed_constants:
+      feeds_stat = os.stat(FLAGS.feed_constants)
+      feeds_salt = [path.abspath(FLAGS.feed_constants), feeds_stat.st_size, feeds_stat.st_mtime,
+                    FLAGS.feed_constants_strip, FLAGS.feed_constants_prefix]
+    test_cache = test_runner.TestCache(
+      path.join(FLAGS.workspace, "cache", "tests"),
+      package_digests,
+      json.dumps([tf.__version__, feeds_salt]))
+
+  if FLAGS.test and not FLAGS.test_workers:
+    def run_tests(sess, feed_dict):
+      prefixes = select_tests(graph_query.graph_index(sess.graph))
+      return test_runner.run_with_cache(
+        prefixes,
+        lambda uncached: test_runner.run_tests_in_session(sess, feed_dict, uncached, FLAGS.test_timeout),
+        test_cache)
+
+    phases.append(graph_execution.Phase(
+      "test",
+      test_pattern,
+      run_fn=run_tests))
+
+  if FLAGS.run:
+    phases.append(graph_execution.Phase(
+      "run",
+      re.compile(FLAGS.run_result_pattern)))
+
+  phase_results = {}
+  if phases:
+    # Train, test and run share one import and one set of variables. We only
+    # need to export again if training changed the graph.
+    try:
+      phase_results, trained_meta_graph_def = graph_execution.import_and_run_phases(
+        meta_graph_def=meta_graph_def,
+        phases=phases,
+        feed_dict_fn=feed_dict_fn,
+        log_dir_fn=lambda x: log_dir_fn_fn(x)(),
+        export=FLAGS.train,
+        config=session_config(),
+      )
+    finally:
+      # Don't leave a checkpointer running if training failed.
+      graph_checkpoint.stop_checkpointer()
+
+    if trained_meta_graph_def:
+      meta_graph_def = trained_meta_graph_def
 
   if FLAGS.test:
-    graph_execution.import_and_run_meta_graph(
-      meta_graph_def=meta_graph_def,
-      feed_dict_fn=feed_dict_fn,
-      log_dir_fn=lambda x: log_dir_fn_fn(x)(),
-      result_pattern=re.compile(FLAGS.test_result_pattern),
-    )
+    if FLAGS.test_workers:
+      # Workers import the trained graph, so they see the same variables.
+      # Feeds like asset paths are found from that graph's collections.
+      with tf.Graph().as_default():
+        meta_graph.import_scoped_meta_graph(meta_graph_def)
+        test_feed_dict = test_runner.feed_dict_by_name(feed_dict_fn())
+      test_entries = test_runner.run_with_cache(
+        select_tests(graph_query.index_graph_def(meta_graph_def.graph_def)),
+        lambda uncached: test_runner.run_tests_in_workers(
+          meta_graph_def=meta_graph_def,
+          feed_dict=test_feed_dict,
+          prefixes=uncached,
+          workers=FLAGS.test_workers,
+          timeout_secs=FLAGS.test_timeout,
+          config=session_config(),
+          relocated_files_dir=path.dirname(path.abspath(FLAGS.metagraphdef)) if FLAGS.metagraphdef else None,
+        ),
+        test_cache)
+    else:
+      test_entries = phase_results["test"]
+
+    eprint("Tests: %s" % test_runner.summarize(test_entries))
+    if FLAGS.test_report:
+      test_runner.write_report(test_entries, FLAGS.test_report)
+
+    failed = test_runner.failures(test_entries)
+    if failed:
+      raise Exception(test_runner.failure_message(failed))
 
   if meta_graph_def and FLAGS.output_file:
-    eprint("meta_graph_def", [n.name for n in meta_graph_def.graph_def.node])
     graph_def = meta_graph_def.graph_def
     output_re = re.compile(FLAGS.output_result_pattern)
     output_node_names = ['py_funcs_json'] # HACK(adamb) So that pyfuncs still work.
     var_names = set()
-    for n in graph_def.node:
-      m = output_re.match(n.name)
-      if not m:
-        continue
+    for _, n, m in graph_query.index_graph_def(graph_def).match(output_re):
       output_node_names.append(n.name)
 
       # If this isn't a function, then we're covered. Otherwise pick up needed
@@ -379,15 +708,22 @@ def main():
 
       # Look for collection of variable names referenced by this function.
       collection_name = "%s:variable_names" % m.group(1)
-      eprint("collection_name", collection_name)
+      log.debug("collection_name %s", collection_name)
       function_var_name_bs = meta_graph_def.collection_def[collection_name].bytes_list.value
       for var_name_b in function_var_name_bs:
         # Remember the name of each variable referenced.
         var_names.add(var_name_b.decode('utf-8'))
 
-    eprint("var_names", var_names)
-    eprint("output_node_names", output_node_names)
-    graph_xform.strip_meta_graph(meta_graph_def, output_node_names, var_names)
+    # Keep test results around to measure how much quantizing changes them.
+    quantize_check_node_names = []
+    if FLAGS.output_quantize:
+      quantize_test_re = re.compile(FLAGS.output_quantize_test_pattern)
+      for _, n, _ in graph_query.index_graph_def(graph_def).match(quantize_test_re):
+        quantize_check_node_names.append(n.name)
+
+    log.debug("var_names %s", var_names)
+    log.debug("output_node_names %s", output_node_names)
+    graph_xform.strip_meta_graph(meta_graph_def, output_node_names + quantize_check_node_names, var_names)
 
   if FLAGS.output_file:
     output_dirname = os.path.dirname(FLAGS.output_file)
@@ -395,35 +731,78 @@ def main():
       os.makedirs(output_dirname)
 
     if FLAGS.output_format == "metagraph":
+      if FLAGS.output_externalize_constants is not None:
+        graph_xform.externalize_constants(
+          meta_graph_def,
+          output_sidecar_path(".consts"),
+          FLAGS.output_externalize_constants)
       graph_io.write_meta_graph_def(
         meta_graph_def=meta_graph_def,
         file=FLAGS.output_file,
-        binary=FLAGS.output_binary)
+        binary=FLAGS.output_binary,
+        compression=FLAGS.output_compression)
     elif FLAGS.output_format == "graph":
-      # If we trained and we're outputting a graph_def, we'll need to modify it.
-      # We'll need to replace all the trained variables with the *constants* that
-      # their initializers refer to.
-      if FLAGS.train:
-        pass
+      # Variables become constants holding their initialized (or trained) values.
+      frozen_graph_def, freeze_report = graph_execution.freeze_meta_graph(
+        meta_graph_def=meta_graph_def,
+        output_node_names=output_node_names,
+        feed_dict_fn=feed_dict_fn,
+        config=session_config(),
+        quantize=FLAGS.output_quantize,
+        check_node_names=quantize_check_node_names,
+      )
+      eprint(format_freeze_report(freeze_report))
       graph_io.write_graph_def(
-        graph_def=meta_graph_def.graph_def,
+        graph_def=frozen_graph_def,
         file=FLAGS.output_file,
-        binary=FLAGS.output_binary)
+        binary=FLAGS.output_binary,
+        compression=FLAGS.output_compression)
 
   if FLAGS.run:
-    results = graph_execution.import_and_run_meta_graph(
-      meta_graph_def=meta_graph_def,
-      feed_dict_fn=feed_dict_fn,
-      log_dir_fn=lambda x: log_dir_fn_fn(x)(),
-      result_pattern=re.compile(FLAGS.run_result_pattern),
-    )
-
-    graph_def = graph_xform.dict_as_graph_def(results)
-    graph_io.write_graph_def(
-      graph_def,
-      file=FLAGS.result,
-      binary=FLAGS.result_binary,
-    )
+    result_format = FLAGS.result_format or tensor_io.result_format_for_path(FLAGS.result) or "graph"
+    results = phase_results["run"]
+    if result_format == "graph":
+      graph_def = graph_xform.dict_as_graph_def(results)
+      graph_io.write_graph_def(
+        graph_def,
+        file=FLAGS.result,
+        binary=FLAGS.result_binary,
+      )
+    else:
+      # Write each result straight from its fetched buffer, without building a graph.
+      result_names = sorted(results.keys())
+      tensor_io.write_results(
+        result_names,
+        [results[name] for name in result_names],
+        FLAGS.result,
+        result_format)
+
+  if FLAGS.run_batch:
+    from nao.run import batch_execution
+    with open(FLAGS.result, "w") as result_file:
+      batch_execution.run_batch(
+        meta_graph_def=meta_graph_def,
+        result_pattern=re.compile(FLAGS.run_result_pattern),
+        feed_dict_fn=feed_dict_fn,
+        input_path=FLAGS.run_batch,
+        output=result_file,
+        workers=FLAGS.run_batch_workers,
+        config=session_config("throughput"),
+      )
+
+  trace_collector = graph_trace.get_trace_collector()
+  if trace_collector:
+    graph_trace.set_trace_collector(None)
+    trace_collector.write()
+    eprint("Wrote trace to %s" % trace_collector.path())
+
+  profile_collector = graph_profile.get_profile_collector()
+  if profile_collector:
+    graph_profile.set_profile_collector(None)
+    profile_collector.write(FLAGS.profile)
+    eprint(profile_collector.format_text())
+    eprint(profile_collector.format_source(FLAGS.root))
+    eprint("Wrote profile to %s" % FLAGS.profile)
 
   if FLAGS.repl:
     graph_repl.run(new_compiler(), log_dir_fn_fn(["repl"]))
@@ -11,6 +11,9 @@ def finish():
 def asset_map():
   return graph_assets.consolidate_to_asset_map(_ASSETS)
 
+def reset():
+  del _ASSETS[:]
+
 def make_compile_fn(workspace, import_path, tags):
   if not tags.get("asset", False):
     return None
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import sys
 
 from os import path
@@ -11,6 +13,8 @@ from nao.compiler.nao import compiler as nao_compiler
 from nao.compiler.py import compiler as py_compiler
 from nao.compiler.metagraph_pbtxt import compiler as metagraph_pbtxt_compiler
 
+from nao.run import graph_execution
+
 def eprint(*args, **kwargs):
   print(*args, file=sys.stderr, **kwargs)
 
@@ -23,20 +27,45 @@ class Workspace:
 
   def clear(self):
     self._source_cache = {}
+    self._reads = None
 
   def put_src(self, filename, source):
     self._source_cache[filename] = source
 
+  def start_recording_reads(self):
+    self._reads = []
+
+  def stop_recording_reads(self):
+    """Returns [(filename, sha256 or None)] for everything looked up since start_recording_reads."""
+    reads, self._reads = self._reads, None
+    return reads
+
+  def _record_read(self, filename, content):
+    if self._reads is None:
+      return
+
+    digest = None
+    if content is not None:
+      if isinstance(content, str):
+        content = content.encode('utf-8')
+      digest = hashlib.sha256(content).hexdigest()
+    self._reads.append((filename, digest))
+
   def read_src(self, filename):
     if filename in self._source_cache:
-      return self._source_cache[filename]
+      source = self._source_cache[filename]
+      self._record_read(filename, source)
+      return source
 
     filepath = path.join(self._src_root, filename)
     if not path.exists(filepath):
+      self._record_read(filename, None)
       return None
 
     with open(filepath) as f:
-      return f.read()
+      source = f.read()
+      self._record_read(filename, source)
+      return source
 
   def find_asset_path(self, name):
     return path.join(self._asset_root, name)
@@ -44,16 +73,23 @@ class Workspace:
   def find_pkg_path(self, filename):
     filepath = path.join(self._pkg_root, filename)
     if not path.exists(filepath):
+      self._record_read(filename, None)
       return None
+
+    if self._reads is not None:
+      with open(filepath, 'rb') as f:
+        self._record_read(filename, f.read())
     return filepath
 
 class Compiler:
-  def __init__(self, src_root, pkg_root, asset_root):
+  def __init__(self, src_root, pkg_root, asset_root, session_config=None):
     self._g = tf.Graph()
     self._device = None
+    self._session_config = session_config
     self._workspace = Workspace(src_root, pkg_root, asset_root)
     self._import_cache = {}
     self._import_cache_tags = {}
+    self._import_digests = {}
     self._compilers = [
       asset_compiler,
       nao_compiler,
@@ -75,16 +111,11 @@ class Compiler:
     self._device = device
 
   def new_session(self):
-    config = tf.ConfigProto(
-      operation_timeout_in_ms=20000,
-      # allow_soft_placement=True,
-      # log_device_placement=True,
-    )
-
-    # Don't allocate everything we think we'll need ahead of time.
-    config.gpu_options.allow_growth = True
+    config = self._session_config
+    if config is None:
+      config = graph_execution.session_config("interactive")
 
-    return tf.Session(
+    return graph_execution.create_session(
       config=config,
       graph=self._g,
     )
@@ -100,6 +131,14 @@ class Compiler:
       meta_graph_def, _ = meta_graph.export_scoped_meta_graph()
     return meta_graph_def
 
+  def import_digest(self, import_path):
+    """A sha256 of everything import_path was compiled from, including its imports.
+
+    This covers the sources read, the tags given (e.g. an asset's url and
+    sha256) and the digests of each transitive import.
+    """
+    return self._import_digests.get(import_path)
+
   def resolve_import_path(self, import_path, tags=None, reimport=False):
     pkg = None
     if import_path in self._import_cache:
@@ -111,12 +150,23 @@ class Compiler:
       if not reimport:
         return pkg
 
-    needed_imports, compile_fn = self._resolve_import_path(import_path, tags)
+    self._workspace.start_recording_reads()
+    try:
+      needed_imports, compile_fn = self._resolve_import_path(import_path, tags)
+    finally:
+      reads = self._workspace.stop_recording_reads()
 
     imports = {}
     for imported_path, imported_tags in needed_imports:
       imports[imported_path] = self.resolve_import_path(imported_path, imported_tags)
 
+    self._import_digests[import_path] = hashlib.sha256(json.dumps([
+      import_path,
+      sorted((tags or {}).items()),
+      reads,
+      sorted((p, self._import_digests.get(p)) for p, _ in needed_imports),
+    ], default=str).encode('utf-8')).hexdigest()
+
     with self._g.as_default():
       with tf.device(self._device):
         pkg = compile_fn(imports, pkg)
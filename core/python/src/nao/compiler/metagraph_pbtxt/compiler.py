@@ -1,115 +1,167 @@
-import tensorflow as tf
-
+import hashlib
+import os
 import re
 import sys
 import tensorflow as tf
 
 from tensorflow.contrib.graph_editor import make_view
 import tensorflow.contrib.graph_editor.transform as transform
+from tensorflow.python.framework import function
+from tensorflow.python.framework import meta_graph
+from tensorflow.python.util import compat
 
+from nao import log as nao_log
 from nao.structure import graph_io
+from nao.structure import graph_prune
 
 from nao.compiler.retvalbag import RetvalBag
 
-def eprint(*args, **kwargs):
-  print(*args, file=sys.stderr, **kwargs)
+log = nao_log.get("import")
+
+# Defun bodies can't hold these, so functions using them are copied instead.
+_UNLOWERABLE_OPS = set([
+  "Enter", "RefEnter", "Exit", "RefExit", "Merge", "RefMerge",
+  "Switch", "RefSwitch", "NextIteration", "RefNextIteration", "LoopCond",
+  "Placeholder", "PlaceholderV2",
+])
 
 class SubGraphViewFunction:
+  """An exported function from a metagraph package.
+
+  If its subgraph can be, it's lowered to a Defun once, so each call adds a
+  single call op. Otherwise each call copies the subgraph.
+  """
+
   def __init__(self, name, sgv, source_scope, inputs, output_names):
-    eprint("sgv.graph", sgv.graph)
     self._nam = name
     self._inputs = inputs
     self._src_scope = source_scope
     self._output_names = output_names
     self._sgv = sgv
+    self._lowered = None
+    self._lowering_attempted = False
 
   def _name(self):
     return self._nam
 
-  def apply(self, visitor, ctx, name, attrs, args):
-    # We'll replace the inputs with the given args and copy all operations
-    # (other than vars, which we leave as is) between outputs and inputs.
+  def _output_tensors(self, g, scope):
+    return [g.get_operation_by_name("%s/outputs/%s" % (scope, n)).outputs[0] for n in self._output_names]
+
+  def _why_not_lowerable(self):
+    ops = set(self._sgv.ops)
+    for op in ops:
+      if op.type in _UNLOWERABLE_OPS or op.op_def.is_stateful:
+        return "%s is a %s" % (op.name, op.type)
+      for control_input in op.control_inputs:
+        if control_input not in ops:
+          return "%s has a control input from outside, %s" % (op.name, control_input.name)
+    for t in self._sgv.inputs:
+      if t.dtype._is_ref_dtype:
+        return "%s uses the variable %s directly" % (self._src_scope, t.name)
+    return None
+
+  def _lower(self):
+    """Returns (Defun, captured outer tensors), or None if our subgraph can't be one."""
+    if self._lowering_attempted:
+      return self._lowered
+    self._lowering_attempted = True
+
+    why_not = self._why_not_lowerable()
+    if why_not:
+      log.info("Copying %s at each call: %s", self._src_scope, why_not)
+      return None
+
+    graph_def = tf.GraphDef()
+    for op in self._sgv.ops:
+      node = graph_def.node.add()
+      node.CopyFrom(op.node_def)
+      # Colocating with something outside the function isn't possible.
+      if "_class" in node.attr:
+        del node.attr["_class"]
+
+    # Tensors from outside that aren't our inputs, like variable reads, are
+    # passed in as extra arguments.
+    consumed = set(self._sgv.inputs)
+    declared = set(self._inputs)
+    inputs = [t for t in self._inputs if t in consumed]
+    captured = [t for t in self._sgv.inputs if t not in declared]
+    outputs = self._output_tensors(self._sgv.graph, self._src_scope)
+    output_names = [t.name for t in outputs]
+
+    @function.Defun(*[t.dtype for t in inputs + captured])
+    def lowered(*args):
+      input_map = dict((t.name, arg) for t, arg in zip(inputs + captured, args))
+      return tuple(tf.import_graph_def(graph_def, input_map=input_map, return_elements=output_names, name=""))
+
+    self._lowered = (lowered, inputs, captured, outputs)
+    return self._lowered
 
+  def apply(self, visitor, ctx, name, attrs, args):
     g = tf.get_default_graph()
     full_scope = g.unique_name(self._name() or "sgv", False)
-    scope_name = full_scope.split("/")[-1]
-    eprint("full_scope", full_scope)
-    eprint("scope_name", scope_name)
     replacements_ts = dict(zip(self._inputs, args))
-    eprint("replacements_ts", replacements_ts)
 
+    lowered = self._lower()
     with tf.name_scope(None):
-      self._copy_with_input_replacements(replacements_ts, full_scope)
-
-    output_items = [(n, "%s/outputs/%s" % (full_scope, n)) for n in self._output_names]
-    eprint("output_items", output_items)
-    try:
-      return RetvalBag(dict([(n, g.get_operation_by_name(p).outputs[0]) for n, p in output_items]))
-    except KeyError as e:
-      nodes = [n.name for n in tf.get_default_graph().as_graph_def().node]
-      nodes.sort()
-      eprint('error, but got nodes', nodes)
-      raise e
+      if lowered is None:
+        # Copy all operations (other than vars, which we leave as is) between
+        # outputs and inputs, replacing the inputs with the given args.
+        self._copy_with_input_replacements(replacements_ts, full_scope)
+      else:
+        defun, inputs, captured, original_outputs = lowered
+        with tf.name_scope(full_scope):
+          call_args = [tf.convert_to_tensor(replacements_ts[t], dtype=t.dtype) for t in inputs] + captured
+          results = defun(*call_args)
+          if not isinstance(results, (list, tuple)):
+            results = [results]
+          with tf.name_scope("outputs"):
+            for n, result, original in zip(self._output_names, results, original_outputs):
+              result.set_shape(original.get_shape())
+              tf.identity(result, name=n)
+
+    return RetvalBag(dict(zip(self._output_names, self._output_tensors(g, full_scope))))
 
   def _copy_with_input_replacements(self, replacement_ts, dst_scope):
-    """Copy a subgraph, replacing some of its inputs.
-    Note a replacement only happens if the tensor to be replaced
-    is an input of the given subgraph. The inputs of a subgraph can
-    be queried using sgv.inputs.
-    Args:
-      sgv: the source subgraph-view. This argument is converted to a subgraph
-        using the same rules as the function subgraph.make_view.
-      replacement_ts: dictionary mapping from original tensors to the
-        replaced one.
-      dst_scope: the destination scope.
-      reuse_dst_scope: if True the dst_scope is re-used if it already exists.
-        Otherwise, the scope is given a unique name based on the one given
-        by appending an underscore followed by a digit (default).
-    Raises:
-      TypeError: if dst_graph is not a tf.Graph.
-      StandardError: if sgv cannot be converted to a SubGraphView using
-        the same rules as the function subgraph.make_view.
+    """Copy our subgraph into dst_scope, replacing the inputs in replacement_ts.
+
+    A replacement only happens if the tensor to be replaced is an input of the
+    subgraph, i.e. in sgv.inputs.
     """
     copier = transform.Transformer()
-    # Replace tensor if possible.
     def replace_t_with_replacement_handler(info, t):
       if t in replacement_ts:
-        eprint("Did find", t, "in", replacement_ts)
         return replacement_ts[t]
-      else:
-        eprint("Did not find", t, "in", replacement_ts)
-        return transform.keep_t_if_possible_handler(info, t)
+      return transform.keep_t_if_possible_handler(info, t)
     copier.transform_external_input_handler = replace_t_with_replacement_handler
 
     orig_transform_op = copier.transform_op_handler
     def transform_op(info, op, copy_shape=True):
-      eprint("transform_op", op.name)
       if isinstance(op, tf.Variable):
-        eprint("Won't copy variable", op)
         return op
 
       return orig_transform_op(info, op, copy_shape)
     copier.transform_op_handler = transform_op
-    dst_graph = tf.get_default_graph()
-    eprint("dst_graph", dst_graph)
 
     return copier(
-        self._sgv, dst_graph, dst_scope, self._src_scope, reuse_dst_scope=False)
+        self._sgv, tf.get_default_graph(), dst_scope, self._src_scope, reuse_dst_scope=False)
 
-class MetaGraphDefPackage:
-  def __init__(self, meta_graph_def, import_path, internal_scope):
-    eprint("import_path, internal_scope", import_path, internal_scope)
+def _op_name(tensor_name):
+  if tensor_name.startswith("^"):
+    tensor_name = tensor_name[1:]
+  return tensor_name.split(":", 1)[0]
 
-    internal_scope = internal_scope or import_path
+def _tensor_name(input_name):
+  if ":" in input_name:
+    return input_name
+  return input_name + ":0"
 
-    self._meta_graph_def = meta_graph_def
-    self._internal_scope = internal_scope
+class _ExportIndex:
+  """What a package exports, found from node names alone."""
 
-    import_scope = import_path
-    tensors = []
-    functions = {} # name -> (scope, inputs, outputs)
-    pattern = re.compile("%s/([^/]+)(?:$|(/inputs/|/outputs/).)" % internal_scope)
-    graph_def = meta_graph_def.graph_def
+  def __init__(self, graph_def, internal_scope):
+    self.tensors = []
+    self.functions = {} # name -> (input node names, output names, node names)
+    pattern = re.compile("%s/([^/]+)(?:$|(/inputs/|/outputs/|/_/).)" % internal_scope)
     for n in graph_def.node:
       m = pattern.match(n.name)
       if not m:
@@ -118,75 +170,187 @@ class MetaGraphDefPackage:
       name = m.group(1)
       function_component = m.group(2)
       if not function_component:
-        tensors.append(n.name)
+        self.tensors.append(n.name)
         continue
 
-      if name not in functions:
-        function = (name, [], [])
-        functions[name] = function
-      else:
-        function = functions[name]
+      if name not in self.functions:
+        self.functions[name] = ([], [], [])
+      inputs, outputs, node_names = self.functions[name]
+      node_names.append(n.name)
 
-      if function_component.startswith("/inputs/"):
-        function[1].append(n.name)
-      else:
+      if function_component == "/inputs/":
+        inputs.append(n.name)
+      elif function_component == "/outputs/":
         output_prefix_len = len(internal_scope) + len(name) + len(function_component) + 1
-        function[2].append(n.name[output_prefix_len:])
+        outputs.append(n.name[output_prefix_len:])
+
+  def names(self):
+    return [name.split("/")[-1] for name in self.tensors] + list(self.functions.keys())
+
+class _LoadedMetaGraph:
+  """A parsed package file, with what we've worked out about it so far."""
+
+  def __init__(self, filepath, mtime, digest, meta_graph_def):
+    self.filepath = filepath
+    self.mtime = mtime
+    self.digest = digest
+    self.meta_graph_def = meta_graph_def
+    self.pruner = graph_prune.Pruner(meta_graph_def)
+    self._export_indexes = {}
+    self._closures = {}
+
+  def export_index(self, internal_scope):
+    if internal_scope not in self._export_indexes:
+      self._export_indexes[internal_scope] = _ExportIndex(self.meta_graph_def.graph_def, internal_scope)
+    return self._export_indexes[internal_scope]
+
+  def closure(self, root_names):
+    """The nodes root_names need, including variable initializers."""
+    key = tuple(root_names)
+    if key not in self._closures:
+      self._closures[key] = frozenset(self.pruner.closure(root_names))
+    return self._closures[key]
+
+# filepath -> _LoadedMetaGraph, so recompiling doesn't reparse unchanged packages.
+_loaded = {}
+
+def load(filepath):
+  mtime = os.path.getmtime(filepath)
+  loaded = _loaded.get(filepath)
+  if loaded is not None and loaded.mtime == mtime:
+    return loaded
+
+  with open(filepath, "rb") as f:
+    data = f.read()
+  digest = hashlib.sha256(data).hexdigest()
+  if loaded is not None and loaded.digest == digest:
+    loaded.mtime = mtime
+    return loaded
+
+  loaded = _LoadedMetaGraph(filepath, mtime, digest, graph_io.parse_meta_graph_def(data))
+  _loaded[filepath] = loaded
+  return loaded
 
-    try:
+class MetaGraphDefPackage:
+  """Imports each export of a metagraph package, and what it needs, when it's first used."""
+
+  def __init__(self, loaded, import_path, internal_scope):
+    self._loaded = loaded
+    self._import_scope = import_path
+    self._internal_scope = internal_scope or import_path
+    self._index = loaded.export_index(self._internal_scope)
+    self._graph = tf.get_default_graph()
+    self._imported = set()
+    self._exports = {} # name -> tensor | function
+
+  def _scoped(self, name):
+    return "%s/%s" % (self._import_scope, name)
+
+  def _import(self, root_names):
+    keep = self._loaded.closure(root_names)
+    new_names = keep - self._imported
+    if not new_names:
+      return
+
+    # Collections we can't split by node only come along with the first import.
+    extracted = self._loaded.pruner.extract(new_names, unprunable_collections=not self._imported)
+    graph_def = extracted.graph_def
+    g = self._graph
+
+    # Inputs from earlier imports are mapped to what's already in the graph.
+    input_map = {}
+    control_inputs = []
+    for node in graph_def.node:
+      node.name = self._scoped(node.name)
+      inputs = []
+      for input_name in node.input:
+        if _op_name(input_name) in new_names:
+          if input_name.startswith("^"):
+            inputs.append("^" + self._scoped(input_name[1:]))
+          else:
+            inputs.append(self._scoped(input_name))
+        elif input_name.startswith("^"):
+          control_inputs.append((node.name, self._scoped(input_name[1:])))
+        else:
+          scoped_input_name = self._scoped(_tensor_name(input_name))
+          input_map[scoped_input_name] = g.get_tensor_by_name(scoped_input_name)
+          inputs.append(scoped_input_name)
+      del node.input[:]
+      node.input.extend(inputs)
+
+      # The importer can only colocate with nodes it's importing.
+      if "_class" in node.attr:
+        colocations = [self._scoped(c[len("loc:@"):]).encode('utf-8') for c in
+                       [compat.as_str(c) for c in node.attr["_class"].list.s]
+                       if c[len("loc:@"):] in new_names]
+        del node.attr["_class"].list.s[:]
+        if colocations:
+          node.attr["_class"].list.s.extend([b"loc:@" + c for c in colocations])
+        else:
+          del node.attr["_class"]
+
+    with g.as_default():
       with tf.name_scope(None):
-        tf.train.import_meta_graph(meta_graph_def, import_scope=import_path)
-    except KeyError as e:
-      nodes = [n.name for n in tf.get_default_graph().as_graph_def().node]
-      nodes.sort()
-      eprint('error, but got nodes', nodes)
-      raise e
-
-    nodes = [n.name for n in tf.get_default_graph().as_graph_def().node]
-    nodes.sort()
-    eprint('no error, but got nodes', nodes)
-
-    g = tf.get_default_graph()
-    exports = {} # name -> tensor | function
-    for name in tensors:
-      eprint("tensor", name, "%s/%s" % (import_scope, name))
-      exports[name] = g.get_operation_by_name("%s/%s" % (import_scope, name))
-
-    for name, (scope, full_input_names, output_names) in functions.items():
-      # inputs = [g.get_tensor_by_name("%s/%s:0" % (import_scope, full_input_name)) for full_input_name in full_input_names]
-      inputs = [g.get_tensor_by_name("%s/%s:0" % (import_scope, full_input_name)) for full_input_name in full_input_names]
-      source_scope = "%s/%s/%s" % (import_path, internal_scope, scope)
-      eprint("sgv_scope", "%s/%s/%s" % (import_path, internal_scope, scope), g)
+        with tf.control_dependencies(None):
+          tf.import_graph_def(graph_def, input_map=input_map, name="")
+          for op_name, control_input_name in control_inputs:
+            g.get_operation_by_name(op_name)._add_control_input(g.get_operation_by_name(control_input_name))
+
+          # Restore collections for the nodes we just imported. There are no
+          # nodes left to import, only names to scope.
+          del extracted.graph_def.node[:]
+          meta_graph.import_scoped_meta_graph(extracted, import_scope=self._import_scope)
+
+    self._imported.update(new_names)
+
+  def _import_export(self, n):
+    g = self._graph
+    if n in self._index.functions:
+      full_input_names, output_names, node_names = self._index.functions[n]
+      self._import(node_names)
+      inputs = [g.get_tensor_by_name("%s:0" % self._scoped(full_input_name)) for full_input_name in full_input_names]
+      source_scope = self._scoped("%s/%s" % (self._internal_scope, n))
       source_pattern = "%s/(?:_|outputs)/.*" % source_scope
       sgv = make_view(source_pattern, graph=g)
-      eprint("sgv.inputs", list(sgv.inputs))
-      exports[name] = SubGraphViewFunction(name, sgv, source_scope, inputs, output_names)
+      return SubGraphViewFunction(n, sgv, source_scope, inputs, output_names)
+
+    for name in self._index.tensors:
+      if name == n or name.split("/")[-1] == n:
+        self._import([name])
+        return g.get_operation_by_name(self._scoped(name))
 
-    self._exports = exports
+    raise KeyError(n)
 
   def apply(self, visitor, ctx, name, attrs, args):
     n, *_ = args
 
-    try:
-      return self._exports[n]
-    except KeyError as e:
-      eprint("only have exports", list(self._exports.keys()))
-      raise e
+    if n not in self._exports:
+      try:
+        self._exports[n] = self._import_export(n)
+      except KeyError as e:
+        log.error("only have exports %s", self._index.names())
+        raise e
+    return self._exports[n]
+
+_SUFFIXES = [
+  ".metagraph.pbtxt",
+  ".metagraph.pb",
+  ".metagraph.pb.gz",
+  ".metagraph.pb.zst",
+]
 
 def make_compile_fn(workspace, import_path, tags):
   basename, scope_name = (import_path + ":").split(":", 1)
   scope_name = scope_name[:-1]
 
-  filepath = workspace.find_pkg_path(basename + ".metagraph.pbtxt")
-  binary = False
-  if filepath is None:
+  # If a package was written in more than one format, use the newest.
+  filepaths = [workspace.find_pkg_path(basename + suffix) for suffix in _SUFFIXES]
+  filepaths = [filepath for filepath in filepaths if filepath is not None]
+  if not filepaths:
     return None
+  filepath = max(filepaths, key=os.path.getmtime)
 
   def compile(resolved_imports, previous):
-    eprint("_sf_tf_metagraph_package", import_path, scope_name)
-    # TODO(adamb) how do we handle the fact that there may be multiple packages
-    #     within the given file. Should we only parse out the one we want?
-    meta_graph_def = graph_io.read_meta_graph_def(filepath, binary)
-    return MetaGraphDefPackage(meta_graph_def, basename, scope_name)
+    return MetaGraphDefPackage(load(filepath), basename, scope_name)
 
   return ([], compile)
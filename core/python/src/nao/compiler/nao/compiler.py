@@ -44,7 +44,7 @@ def make_compile_fn(workspace, import_path, tags):
   if source is None:
     return None
 
-  exprs = _js_ctx.call("parse.parseExpressions", source)
+  exprs = _js_ctx.call("parse.parseExpressions", source, import_path + ".nao")
   # pp(exprs)
 
   imported = []
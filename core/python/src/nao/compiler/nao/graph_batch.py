@@ -0,0 +1,442 @@
+import sys
+
+import tensorflow as tf
+from tensorflow.python.framework import tensor_util
+
+from nao import log as nao_log
+from nao.compiler.retvalbag import RetvalBag, unwrap_bag
+
+log = nao_log.get("compile")
+
+# We can't re-emit loop and conditional plumbing op-by-op, since the frames
+# they belong to would no longer line up.
+_CONTROL_FLOW_OPS = frozenset([
+  "Enter", "Exit", "Merge", "Switch", "NextIteration", "LoopCond",
+  "RefEnter", "RefExit", "RefMerge", "RefSwitch", "RefNextIteration",
+])
+
+# Elementwise ops with a single tensor input. They don't care about rank.
+_UNARY_OPS = frozenset([
+  "Abs", "Cast", "Ceil", "Cos", "Elu", "Exp", "Expm1", "Floor", "Identity",
+  "Inv", "IsFinite", "IsInf", "IsNan", "Log", "Log1p", "LogicalNot", "Neg",
+  "OnesLike", "Reciprocal", "Relu", "Relu6", "Round", "Rsqrt", "Selu",
+  "Sigmoid", "Sign", "Sin", "Softplus", "Softsign", "Sqrt", "Square",
+  "StopGradient", "Tan", "Tanh", "ZerosLike",
+])
+
+# Elementwise ops with two tensor inputs that follow numpy broadcasting rules.
+_BINARY_OPS = frozenset([
+  "Add", "Div", "Equal", "FloorDiv", "FloorMod", "Greater", "GreaterEqual",
+  "Less", "LessEqual", "LogicalAnd", "LogicalOr", "Maximum", "Minimum", "Mod",
+  "Mul", "NotEqual", "Pow", "RealDiv", "SquaredDifference", "Sub",
+  "TruncateDiv", "TruncateMod",
+])
+
+# Reductions whose second input is a (constant) list of axes.
+_REDUCTION_OPS = frozenset(["All", "Any", "Max", "Mean", "Min", "Prod", "Sum"])
+
+# Ops that already treat their first input's leading dimension as a batch.
+# We can fold our batch dimension into theirs.
+_BATCH_MAJOR_OPS = frozenset([
+  "AvgPool", "AvgPool3D", "Conv2D", "Conv3D", "DepthwiseConv2dNative", "LRN",
+  "MaxPool", "MaxPool3D",
+])
+
+class _Unvectorizable(Exception):
+  pass
+
+def _example_rank(t, batched):
+  ndims = t.get_shape().ndims
+  if ndims is None:
+    return None
+  return ndims - 1 if batched else ndims
+
+def _broadcast_to_batch(t, batch_size):
+  multiples = tf.concat([[batch_size], tf.ones_like(tf.shape(t))], 0)
+  return tf.tile(tf.expand_dims(t, 0), multiples)
+
+def _shift_axis(axis):
+  # Negative axes count from the end, so they're unaffected by a new leading dimension.
+  return axis + 1 if axis >= 0 else axis
+
+def _constant_axes(t):
+  return tensor_util.constant_value(t)
+
+def _recreate_op(op, inputs):
+  # Colocation constraints refer to traced ops, which we won't be running.
+  attrs = dict([(k, v) for k, v in op.node_def.attr.items() if k != "_class"])
+
+  g = tf.get_default_graph()
+  return g.create_op(
+      op.type,
+      inputs,
+      [t.dtype for t in op.outputs],
+      name=op.name.split("/")[-1],
+      attrs=attrs)
+
+def _recreate(op, inputs):
+  return _recreate_op(op, inputs).outputs
+
+def _batched(tensors):
+  return [(t, True) for t in tensors]
+
+def _align_ranks(inputs):
+  ranks = [_example_rank(t, b) for t, b in inputs]
+  if None in ranks:
+    return None
+
+  max_rank = max(ranks)
+  aligned = []
+  for (t, b), rank in zip(inputs, ranks):
+    if b:
+      # Pad with unit dimensions after the batch so trailing dimensions broadcast.
+      for _ in range(max_rank - rank):
+        t = tf.expand_dims(t, 1)
+    aligned.append(t)
+  return aligned
+
+def _fold_batch(op, inputs):
+  x, _ = inputs[0]
+  x_shape = tf.shape(x)
+  folded = tf.reshape(x, tf.concat([[-1], x_shape[2:]], 0))
+  outputs = _recreate(op, [folded] + [t for t, _ in inputs[1:]])
+  return _batched([
+    tf.reshape(out, tf.concat([x_shape[:2], tf.shape(out)[1:]], 0))
+    for out in outputs
+  ])
+
+def _vectorize_matmul(op, inputs, batch_size):
+  (a, a_batched), (b, b_batched) = inputs
+  transpose_a = op.get_attr("transpose_a")
+  transpose_b = op.get_attr("transpose_b")
+
+  if a_batched and not b_batched and not transpose_a:
+    # Stack every example's rows into one big matrix and do a single matmul.
+    a_shape = tf.shape(a)
+    a_flat = tf.reshape(a, tf.concat([[-1], a_shape[2:]], 0))
+    product = tf.matmul(a_flat, b, transpose_b=transpose_b)
+    return _batched([
+      tf.reshape(product, tf.concat([a_shape[:2], tf.shape(product)[1:]], 0))
+    ])
+
+  if not a_batched:
+    a = _broadcast_to_batch(a, batch_size)
+  if not b_batched:
+    b = _broadcast_to_batch(b, batch_size)
+
+  return _batched([tf.matmul(a, b, transpose_a=transpose_a, transpose_b=transpose_b)])
+
+def _vectorize_op(op, inputs, batch_size):
+  """Returns [(tensor, batched)] for op's outputs, or None if op isn't supported."""
+  op_type = op.type
+  input_tensors = [t for t, _ in inputs]
+  batched_flags = [b for _, b in inputs]
+
+  if op_type in _UNARY_OPS:
+    return _batched(_recreate(op, input_tensors))
+
+  if op_type in _BINARY_OPS:
+    aligned = _align_ranks(inputs)
+    if aligned is None:
+      return None
+    return _batched(_recreate(op, aligned))
+
+  if op_type == "AddN" or op_type == "Select":
+    # These demand matching shapes, so broadcast anything that isn't batched.
+    return _batched(_recreate(op, [
+      t if b else _broadcast_to_batch(t, batch_size) for t, b in inputs
+    ]))
+
+  if op_type == "BiasAdd":
+    if batched_flags[1]:
+      return None
+    return _batched(_recreate(op, input_tensors))
+
+  if op_type == "MatMul":
+    return _vectorize_matmul(op, inputs, batch_size)
+
+  if op_type == "BatchMatMul":
+    return _batched(_recreate(op, [
+      t if b else _broadcast_to_batch(t, batch_size) for t, b in inputs
+    ]))
+
+  if op_type in _BATCH_MAJOR_OPS:
+    if True in batched_flags[1:]:
+      return None
+    return _fold_batch(op, inputs)
+
+  if op_type in ("Softmax", "LogSoftmax"):
+    if _example_rank(*inputs[0]) != 1:
+      return None
+    return _batched(_recreate(op, input_tensors))
+
+  if op_type in _REDUCTION_OPS or op_type in ("ArgMax", "ArgMin"):
+    if batched_flags[1]:
+      return None
+    axes = _constant_axes(op.inputs[1])
+    if axes is None:
+      return None
+    shifted = tf.constant(
+        [_shift_axis(int(a)) for a in axes.flat] if axes.ndim else _shift_axis(int(axes)),
+        dtype=op.inputs[1].dtype)
+    return _batched(_recreate(op, [input_tensors[0], shifted]))
+
+  if op_type == "Reshape":
+    if batched_flags[1]:
+      return None
+    x, shape = input_tensors
+    return _batched([tf.reshape(x, tf.concat([tf.shape(x)[:1], shape], 0), name=op.name.split("/")[-1])])
+
+  if op_type == "Transpose":
+    if batched_flags[1]:
+      return None
+    perm = _constant_axes(op.inputs[1])
+    if perm is None:
+      return None
+    return _batched([tf.transpose(input_tensors[0], [0] + [int(p) + 1 for p in perm.flat])])
+
+  if op_type == "ExpandDims":
+    if batched_flags[1]:
+      return None
+    dim = _constant_axes(op.inputs[1])
+    if dim is None:
+      return None
+    return _batched([tf.expand_dims(input_tensors[0], _shift_axis(int(dim)))])
+
+  if op_type == "Squeeze":
+    squeeze_dims = list(op.get_attr("squeeze_dims"))
+    if not squeeze_dims:
+      # Squeezing "everything" would also squeeze a batch of one.
+      shape = op.inputs[0].get_shape()
+      if not shape.is_fully_defined():
+        return None
+      squeeze_dims = [ix for ix, d in enumerate(shape.as_list()) if d == 1]
+    return _batched([tf.squeeze(input_tensors[0], [_shift_axis(d) for d in squeeze_dims])])
+
+  if op_type == "ConcatV2":
+    if batched_flags[-1]:
+      return None
+    axis = _constant_axes(op.inputs[-1])
+    if axis is None:
+      return None
+    values = [t if b else _broadcast_to_batch(t, batch_size) for t, b in inputs[:-1]]
+    return _batched([tf.concat(values, _shift_axis(int(axis)))])
+
+  if op_type == "Pack":
+    values = [t if b else _broadcast_to_batch(t, batch_size) for t, b in inputs]
+    return _batched([tf.stack(values, axis=_shift_axis(op.get_attr("axis")))])
+
+  if op_type == "Unpack":
+    return _batched(tf.unstack(
+        input_tensors[0],
+        num=op.get_attr("num"),
+        axis=_shift_axis(op.get_attr("axis"))))
+
+  # Shape queries describe a single example, so they aren't batched.
+  if op_type == "Shape":
+    return [(tf.shape(input_tensors[0], out_type=op.get_attr("out_type"))[1:], False)]
+
+  if op_type == "Size":
+    size = tf.size(input_tensors[0], out_type=op.get_attr("out_type"))
+    return [(size // tf.cast(batch_size, size.dtype), False)]
+
+  if op_type == "Rank":
+    return [(tf.rank(input_tensors[0]) - 1, False)]
+
+  return None
+
+def _vectorize_sink(op, inputs):
+  """Re-emit an op without outputs, returning the new op."""
+  input_tensors = [t for t, _ in inputs]
+
+  if op.type == "Assert":
+    # An assertion about every example is an assertion about the batch.
+    condition, batched = inputs[0]
+    if batched:
+      condition = tf.reduce_all(condition)
+    return _recreate_op(op, [condition] + input_tensors[1:])
+
+  if op.type == "NoOp":
+    return _recreate_op(op, input_tensors)
+
+  raise _Unvectorizable(op)
+
+def _map_op(op, inputs):
+  """Fall back to running op once per example with tf.map_fn."""
+  if len(op.outputs) == 0:
+    return None
+
+  for t in op.outputs:
+    if t.dtype._is_ref_dtype:
+      return None
+
+  batched_ixs = [ix for ix, (_, b) in enumerate(inputs) if b]
+  def per_example(elems):
+    args = [t for t, _ in inputs]
+    for ix, elem in zip(batched_ixs, elems):
+      args[ix] = elem
+    return tuple(_recreate(op, args))
+
+  # Stateful ops must observe examples in order, just like they would with nao.map.
+  parallel_iterations = 1 if op.op_def.is_stateful else 10
+
+  results = tf.map_fn(
+    fn=per_example,
+    elems=tuple([inputs[ix][0] for ix in batched_ixs]),
+    dtype=tuple([t.dtype for t in op.outputs]),
+    parallel_iterations=parallel_iterations,
+    back_prop=False,
+    swap_memory=False,
+    infer_shape=True)
+
+  return _batched(results)
+
+def _vectorize_traced_ops(traced_ops, mapped, batch_size):
+  reemitted = {} # original op -> [new ops]
+  fallbacks = []
+
+  for op in traced_ops:
+    inputs = [mapped.get(t, (t, False)) for t in op.inputs]
+    control_inputs = [c for c in op.control_inputs if c in reemitted]
+
+    is_batched = True in [b for _, b in inputs]
+    # Inputs like a Shape's can be replaced without being batched. The traced
+    # op would still read the example placeholder, so it has to be re-emitted.
+    remapped = any(t in mapped for t in op.inputs)
+    if not remapped and not control_inputs:
+      # Doesn't depend on the example, so we can use the traced op as is.
+      continue
+
+    if op.type in _CONTROL_FLOW_OPS:
+      raise _Unvectorizable(op)
+
+    new_control_inputs = []
+    for c in op.control_inputs:
+      new_control_inputs.extend(reemitted.get(c, [c]))
+
+    with tf.control_dependencies(new_control_inputs):
+      if not op.outputs:
+        reemitted[op] = [_vectorize_sink(op, inputs)]
+        continue
+
+      if is_batched:
+        outputs = _vectorize_op(op, inputs, batch_size)
+        if outputs is None:
+          outputs = _map_op(op, inputs)
+          if outputs is None:
+            raise _Unvectorizable(op)
+          fallbacks.append(op)
+      else:
+        # Only reads per example values or waits on something batched, so its
+        # outputs are still per example.
+        outputs = [(t, False) for t in _recreate(op, [t for t, _ in inputs])]
+
+    for orig, new in zip(op.outputs, outputs):
+      mapped[orig] = new
+
+    reemitted[op] = [t.op for t, _ in outputs]
+
+  return fallbacks
+
+def _collection_item_op(item):
+  if isinstance(item, tf.Operation):
+    return item
+  if hasattr(item, "op"):
+    return item.op
+  # Cond and while contexts.
+  if hasattr(item, "pivot"):
+    return item.pivot.op
+  return None
+
+def _remove_ops(g, ops):
+  """Removes ops, which nothing else may consume, from g and its collections."""
+  removed_ids = set(id(op) for op in ops)
+  for op in ops:
+    del g._nodes_by_id[op._id]
+    del g._nodes_by_name[op.name]
+    for t in op.inputs:
+      t._consumers = [c for c in t._consumers if id(c) not in removed_ids]
+
+  for key in g.get_all_collection_keys():
+    collection = g.get_collection_ref(key)
+    collection[:] = [item for item in collection if id(_collection_item_op(item)) not in removed_ids]
+
+def _map_fn_apply(visitor, ctx, fn, elems, retval_items):
+  retval_names = [retval_name for retval_name, _ in retval_items]
+
+  def some_fn(elem):
+    retvals = fn.apply(visitor, ctx, "example", None, list(elem))
+    if isinstance(retvals, RetvalBag):
+      values = [retvals.get(retval_name) for retval_name in retval_names]
+    else:
+      values = [retvals]
+    return tuple([v.value() if isinstance(v, tf.Variable) else v for v in values])
+
+  results = tf.map_fn(
+    fn=some_fn,
+    elems=tuple(elems),
+    dtype=tuple([dtype for _, dtype in retval_items]),
+    parallel_iterations=1,
+    back_prop=False,
+    swap_memory=False,
+    infer_shape=True)
+
+  return dict(zip(retval_names, results))
+
+def batch_apply(visitor, ctx, fn, elems, name):
+  """Apply a per-example fn to elems, which have an extra leading batch dimension.
+
+  We trace fn once on placeholders shaped like a single example, then re-emit
+  the traced ops so they operate on the whole batch at once. Ops we don't know
+  how to vectorize are run with tf.map_fn individually. If fn contains control
+  flow, we remove the trace and fall back to running all of fn with tf.map_fn.
+  """
+  fn = unwrap_bag(fn)
+  if not isinstance(elems, (list, tuple)):
+    elems = [elems]
+  elems = [unwrap_bag(e) for e in elems]
+
+  g = tf.get_default_graph()
+  with tf.name_scope(name or "batch"):
+    batch_size = tf.shape(elems[0])[0]
+
+    start_version = g.version
+    with tf.name_scope("trace"):
+      examples = [tf.placeholder(e.dtype, e.get_shape()[1:]) for e in elems]
+
+    retvals = fn.apply(visitor, ctx, "trace", None, examples)
+    traced_ops = [op for op in g.get_operations() if op._id > start_version]
+    traced_ops.sort(key=lambda op: op._id)
+
+    if isinstance(retvals, RetvalBag):
+      retval_items = list(retvals._d.items())
+    else:
+      retval_items = [(None, retvals)]
+
+    mapped = dict([(example, (e, True)) for example, e in zip(examples, elems)])
+    try:
+      fallbacks = _vectorize_traced_ops(traced_ops, mapped, batch_size)
+    except _Unvectorizable as e:
+      log.info("nao.batch %s can't vectorize %s %s, falling back to map_fn", name, e.args[0].type, e.args[0].name)
+      retval_dtypes = [(retval_name, tf.convert_to_tensor(value).dtype.base_dtype) for retval_name, value in retval_items]
+      # Nothing refers to the trace or what we re-emitted from it yet.
+      _remove_ops(g, [op for op in g.get_operations() if op._id > start_version])
+      results = _map_fn_apply(visitor, ctx, fn, elems, retval_dtypes)
+    else:
+      if fallbacks:
+        log.info("nao.batch %s fell back to map_fn for %s", name, ["%s (%s)" % (op.name, op.type) for op in fallbacks])
+
+      results = {}
+      for retval_name, value in retval_items:
+        if isinstance(value, tf.Variable):
+          value = value.value()
+        value, batched = mapped.get(value, (value, False))
+        if not batched:
+          # Every example gets the same value, but callers still expect a batch.
+          value = _broadcast_to_batch(value, batch_size)
+        results[retval_name] = value
+
+  if len(results) == 1:
+    return tf.identity(list(results.values())[0], name=name)
+
+  return RetvalBag(results)
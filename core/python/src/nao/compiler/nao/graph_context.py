@@ -6,12 +6,12 @@ from tensorflow.python.ops import state_ops
 
 from collections import OrderedDict
 
+from nao import log as nao_log
 from nao.compiler.primitive_function import PrimitiveFunction
 from nao.compiler.retvalbag import RetvalBag
 from nao.compiler.nao import graph_function
 
-def eprint(*args, **kwargs):
-  print(*args, file=sys.stderr, **kwargs)
+log = nao_log.get("compile")
 
 class SentinelContextDelegate:
   def __init__(self):
@@ -124,7 +124,7 @@ class Context:
     if name in self._fully_qualified_packages:
       raise Exception("Already defined package: %s" % name)
 
-    eprint("Defining package", name)
+    log.debug("Defining package %s", name)
     self._fully_qualified_packages[name] = pkg
 
   def fully_qualified_package(self, name):
@@ -137,7 +137,7 @@ class Context:
     if name in self._imported_packages:
       raise Exception("Already imported package: %s" % name)
 
-    eprint("Importing package", name)
+    log.debug("Importing package %s", name)
     self._imported_packages[name] = pkg
 
   def imported_package(self, name):
@@ -170,9 +170,9 @@ class Context:
       v = self._locals[name]
       if not isinstance(v, tf.Variable) and not (isinstance(v, tf.Tensor) and v.dtype._is_ref_dtype):
         raise Exception("%s not a variable: %s" % (name, v))
-      eprint("updating local", name, "from", v, "to", rhs)
+      log.debug("updating local %s from %s to %s", name, v, rhs)
       v = tf.assign(v, rhs)
-      eprint("updated local", name, "is", v)
+      log.debug("updated local %s is %s", name, v)
       self._locals[name] = v
       return v
 
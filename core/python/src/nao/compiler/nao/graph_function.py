@@ -1,8 +1,10 @@
+import contextlib
 import inspect
 import re
 import sys
 
 import tensorflow as tf
+from tensorflow.core.framework import attr_value_pb2
 from tensorflow.contrib.graph_editor import make_view
 import tensorflow.contrib.graph_editor.transform as transform
 
@@ -108,6 +110,38 @@ class TransformedFunction:
 
     return self._apply(_apply, visitor)
 
+@contextlib.contextmanager
+def jit_scope(scope_name):
+  """Marks ops created within for XLA to compile as one cluster."""
+  g = tf.get_default_graph()
+  # Each scope is its own cluster, so XLA doesn't merge separate calls.
+  xla_scope = g.unique_name("jit_%s" % (scope_name or "fn"), mark_as_used=True)
+  with g._attr_scope({
+    "_XlaCompile": attr_value_pb2.AttrValue(b=True),
+    "_XlaScope": attr_value_pb2.AttrValue(s=xla_scope.encode('utf-8')),
+  }):
+    yield
+
+class JitFunction:
+  """Wraps fn so the ops each application creates are compiled together by XLA."""
+
+  def __init__(self, name, fn):
+    self._jit_name = name
+    self._fn = fn
+
+  def _name(self):
+    return self._jit_name or self._fn._name()
+
+  def _apply(self, impl, scope_name):
+    with jit_scope(scope_name):
+      return impl()
+
+  def apply_kw(self, visitor, ctx, scope_name, attrs, kwargs):
+    return self._apply(lambda: self._fn.apply_kw(visitor, ctx, scope_name, attrs, kwargs), scope_name)
+
+  def apply(self, visitor, ctx, scope_name, attrs, args):
+    return self._apply(lambda: self._fn.apply(visitor, ctx, scope_name, attrs, args), scope_name)
+
 class DeclaredMacro:
   def __init__(self, ctx, expr):
     self._ctx = ctx
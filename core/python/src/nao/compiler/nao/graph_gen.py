@@ -15,27 +15,29 @@ from tensorflow.core.framework import graph_pb2
 from tensorflow.core.framework import variable_pb2
 from tensorflow.core.protobuf import control_flow_pb2
 
+from nao import log as nao_log
 from nao.structure import graph_ffi
 from nao.structure import graph_io
+from nao.structure import graph_scope
+from nao.structure import graph_source
 
 from nao.compiler.nao import graph_context
 from nao.compiler.nao import graph_function
+from nao.compiler.nao import graph_batch
 from nao.compiler.nao.graph_loop import _sf_while_loop
 
 from nao.compiler.retvalbag import RetvalBag, unwrap_bag
 
 from nao.compiler.python_package import PythonPackage
 
-def eprint(*args, **kwargs):
-  print(*args, file=sys.stderr, **kwargs)
-
+log = nao_log.get("compile")
 
 class Nao:
   def __init__(self, visitor):
     self._visitor = visitor
 
   def map(self, ctx, elems, fn=None, dtype=None, name=None):
-    eprint("map of", elems, "with", fn, dtype, "named", name)
+    log.debug("map of %s with %s %s named %s", elems, fn, dtype, name)
     with tf.control_dependencies([]):
       try:
         def some_fn(elem):
@@ -53,12 +55,14 @@ class Nao:
         return tf.identity(result, name=name)
 
       except KeyError as ke:
-        eprint('error, but got graph', tf.get_default_graph().as_graph_def())
-        nodes = [n.name for n in tf.get_default_graph().as_graph_def().node]
-        nodes.sort()
-        eprint('error, but got nodes', nodes)
+        g = tf.get_default_graph()
+        log.debug("error, but got nodes %s", nao_log.Lazy(lambda: sorted(op.name for op in g.get_operations())))
         raise ke
 
+  def batch(self, ctx, elems, fn=None, name=None):
+    log.debug("batch of %s with %s named %s", elems, fn, name)
+    return graph_batch.batch_apply(self._visitor, ctx, fn, elems, name)
+
   def enqueue_many(self, ctx, queue_ref, components, name=None):
     if name is None:
       name = tf.get_default_graph().unique_name("EnqueueMany", False).split("/")[-1]
@@ -110,6 +114,9 @@ class Nao:
   def var_transform(self, ctx, fn, macro, name=None):
     return graph_function.TransformedFunction(name, fn, macro)
 
+  def jit(self, ctx, fn, name=None):
+    return graph_function.JitFunction(name, unwrap_bag(fn))
+
 class TopLevel:
   TYPES = {
 	  "half": tf.float16,
@@ -134,6 +141,8 @@ class TopLevel:
   def __init__(self):
     self.nesting_level = 0
     self._variable_listeners = []
+    self._positioned_ops = set()
+    self._positioned_depth = 0
 
   def add_variable_listener(self, listener):
     self._variable_listeners.append(listener)
@@ -166,7 +175,7 @@ class TopLevel:
     try:
       op = tf.constant(value, shape=shape, dtype=dtype, name=name)
     except TypeError as e:
-      eprint("tf.constant(%s, shape=%s, dtype=%s, name=%s)" % (value, shape, dtype, name))
+      log.error("tf.constant(%s, shape=%s, dtype=%s, name=%s)", value, shape, dtype, name)
       raise e
     ctx.possible_leaf(op)
 
@@ -189,7 +198,7 @@ class TopLevel:
       base_scope_name = 'fnc'
 
     g = tf.get_default_graph()
-    scope_name = "q___%s" % g.unique_name(base_scope_name, False).split("/")[-1]
+    scope_name = graph_scope.function_scope(g, base_scope_name)
 
     if not hasattr(fn, 'apply') and hasattr(fn, 'apply_attrs'):
       fn = fn.apply_attrs(self, attrs)
@@ -361,20 +370,19 @@ class TopLevel:
   #     When functions are emitted as FunctionDefs, this can be removed.
   def _maybe_export_function(self, package_name, subctx, name, value):
     if not name[0].isupper():
-      eprint("not capitalized", name)
+      log.debug("not exporting %s, it isn't capitalized", name)
       return
 
     value = unwrap_bag(value)
-    eprint("considering", name)
 
     if not isinstance(value, graph_function.DeclaredFunction):
-      eprint("isn't a declared function", type(value))
+      log.debug("not exporting %s, it isn't a declared function: %s", name, type(value))
       return
 
     fn = value
 
     if fn.has_attrs():
-      eprint("has attributes, skipping.")
+      log.debug("not exporting %s, it has attributes", name)
       return
 
     g = tf.get_default_graph()
@@ -384,7 +392,7 @@ class TopLevel:
       var_set.add(var.name)
     self.add_variable_listener(on_var)
 
-    eprint("exporting", name, fn)
+    log.debug("exporting %s", name)
     with tf.variable_scope(name):
       with tf.variable_scope("inputs"):
         args = [tf.placeholder(arg_dtype, arg_shape, arg_name) for (arg_name, arg_shape, arg_dtype) in fn._arg_specs()]
@@ -399,14 +407,12 @@ class TopLevel:
           try:
             returned_tensor = g.get_tensor_by_name("%s/_/%s:0" % (tensor_prefix, retval_inner_name))
           except KeyError as ke:
-            eprint("repeating lookup of %s in prefix %s for retval %s" % (retval_inner_name, tensor_prefix, retval_name))
+            log.debug("repeating lookup of %s in prefix %s for retval %s", retval_inner_name, tensor_prefix, retval_name)
             # If we fail to find the tensor above, perhaps it was just an input.
             try:
               returned_tensor = g.get_tensor_by_name("%s/inputs/%s:0" % (tensor_prefix, retval_inner_name))
             except KeyError:
-              nodes = [n.name for n in tf.get_default_graph().as_graph_def().node]
-              nodes.sort()
-              eprint('error, but got nodes', nodes)
+              log.debug("error, but got nodes %s", nao_log.Lazy(lambda: sorted(op.name for op in g.get_operations())))
               raise ke
 
           tf.identity(returned_tensor, name=retval_name)
@@ -468,6 +474,38 @@ class TopLevel:
     return result
 
   def _visit(self, ctx, expr):
+    if type(expr) == list:
+      expr, position = graph_source.pop_position(expr)
+      if position is not None and graph_source.get_recording():
+        return self._visit_positioned(ctx, expr, position)
+
+    return self._visit_unpositioned(ctx, expr)
+
+  def _visit_positioned(self, ctx, expr, position):
+    g = tf.get_default_graph()
+    version = g.version
+    self._positioned_depth += 1
+    try:
+      return self._visit_unpositioned(ctx, expr)
+    finally:
+      self._positioned_depth -= 1
+      # Nested expressions have already claimed the ops they created, so we
+      # only take the ones left over.
+      if g.version > version:
+        ops = []
+        for op_id in range(version + 1, g.version + 1):
+          op = g._nodes_by_id.get(op_id)
+          if op is None or op in self._positioned_ops:
+            continue
+          self._positioned_ops.add(op)
+          ops.append(op)
+        graph_source.record(g, ops, position)
+
+      # Claimed ops only matter to enclosing expressions.
+      if self._positioned_depth == 0:
+        self._positioned_ops.clear()
+
+  def _visit_unpositioned(self, ctx, expr):
     self.nesting_level = self.nesting_level + 1
     # eprint("%s%s" % ('  ' * self.nesting_level, expr))
 
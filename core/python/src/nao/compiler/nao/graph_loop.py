@@ -3,12 +3,13 @@ import sys
 import tensorflow as tf
 from tensorflow.core.protobuf import control_flow_pb2
 
+from nao import log as nao_log
 from nao.compiler.retvalbag import RetvalBag, unwrap_bag
+from nao.structure import graph_source
 
 from collections import OrderedDict
 
-def eprint(*args, **kwargs):
-  print(*args, file=sys.stderr, **kwargs)
+log = nao_log.get("compile")
 
 def zero_value_for_dtype(dtype):
   value = 0
@@ -81,7 +82,7 @@ def _while_fix_colocations(meta_graph_def, proxy_cruft):
           # HACK(adamb) It would be much, much better to just do the replacement
           #     commented out above, but we apparently can't replace a location
           #     with a value pointing to the existing graph. Strange.
-          eprint("HACK(adamb) Removing", class_value, "for op_name", op_name, "node name", node.name)
+          log.debug("HACK(adamb) Removing %s for op_name %s node name %s", class_value, op_name, node.name)
           del class_values[ix]
 
 def _sf_while_inner(use_device, visitor_class, ctx, exprs):
@@ -106,6 +107,7 @@ def _sf_while_inner(use_device, visitor_class, ctx, exprs):
 
 def _sf_while_embed(import_scope, input_map, retval_names, meta_graph_def, cleanup_py_funcs):
   g = tf.get_default_graph()
+  graph_source.prefix_meta_graph_def(meta_graph_def, import_scope)
 
   try:
     with tf.name_scope(None):
@@ -130,10 +132,7 @@ def _sf_while_embed(import_scope, input_map, retval_names, meta_graph_def, clean
 
     return [g.get_tensor_by_name("%s/%s" % (import_scope, n)) for n in retval_names]
   except KeyError as ke:
-    eprint('error, but got graph', tf.get_default_graph().as_graph_def())
-    nodes = [n.name for n in tf.get_default_graph().as_graph_def().node]
-    nodes.sort()
-    eprint('error, but got nodes', nodes)
+    log.debug("error, but got nodes %s", nao_log.Lazy(lambda: sorted(op.name for op in g.get_operations())))
     raise ke
 
 def _sf_while_loop(visitor, ctx, cond_expr, body_exprs, body_retvals, init_exprs):
@@ -246,7 +245,7 @@ def _sf_while_loop(visitor, ctx, cond_expr, body_exprs, body_retvals, init_exprs
   if len(device_stack) > 0:
     use_device = device_stack[-1]
 
-  eprint("Will use device", use_device)
+  log.debug("Will use device %s", use_device)
 
   # Ensure we have a placeholder for every initial value.
   with tf.Graph().as_default():
@@ -28,6 +28,10 @@ class ImportedPythonFunction:
 
 _python_importer = graph_ffi.PythonImporter()
 
+def reset():
+  global _python_importer
+  _python_importer = graph_ffi.PythonImporter()
+
 def finish():
   py_func_data = _python_importer.dump_py_funcs(script_ops._py_funcs)
   tf.constant(json.dumps(py_func_data), name="py_funcs_json")
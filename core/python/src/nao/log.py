@@ -0,0 +1,88 @@
+import logging
+import sys
+
+# Each category is a logger under "nao", so they can be filtered separately.
+CATEGORIES = {
+  "cli": "Command line settings and what's being fed and written",
+  "compile": "Building graphs from nao source",
+  "import": "Resolving and importing packages",
+  "graph": "Transforming, freezing and exporting graphs",
+  "run": "Sessions, phases, checkpoints and autotuning",
+}
+
+LEVELS = {
+  "debug": logging.DEBUG,
+  "info": logging.INFO,
+  "warning": logging.WARNING,
+  "error": logging.ERROR,
+}
+
+_ROOT = "nao"
+_handler = None
+
+class _StderrHandler(logging.Handler):
+  """Writes to whatever sys.stderr is at the time, like eprint, so redirecting it works."""
+
+  def emit(self, record):
+    try:
+      print(self.format(record), file=sys.stderr)
+    except Exception:
+      self.handleError(record)
+
+def _ensure_handler():
+  global _handler
+  if _handler is not None:
+    return
+
+  _handler = _StderrHandler()
+  _handler.setFormatter(logging.Formatter("%(message)s"))
+  root = logging.getLogger(_ROOT)
+  root.addHandler(_handler)
+  root.setLevel(logging.INFO)
+  root.propagate = False
+
+def get(category):
+  if category not in CATEGORIES:
+    raise Exception("Unknown log category: %s. Expected one of: %s" % (category, sorted(CATEGORIES.keys())))
+
+  _ensure_handler()
+  return logging.getLogger("%s.%s" % (_ROOT, category))
+
+class Lazy:
+  """Logs as str(fn()), calling fn only if the message is actually written.
+
+  For arguments that are expensive to compute, like every node name in a graph.
+  """
+
+  def __init__(self, fn):
+    self._fn = fn
+
+  def __str__(self):
+    return str(self._fn())
+
+def parse_level(name):
+  if name not in LEVELS:
+    raise Exception("Unknown log level: %s. Expected one of: %s" % (name, sorted(LEVELS.keys(), key=LEVELS.get)))
+  return LEVELS[name]
+
+def parse_category_levels(specs):
+  """Parses ["compile=debug", ...] into {"compile": "debug", ...}."""
+  category_levels = {}
+  for spec in specs or []:
+    if "=" not in spec:
+      raise Exception("Expected CATEGORY=LEVEL, e.g. compile=debug, got: %s" % spec)
+    category, level = spec.split("=", 1)
+    get(category)
+    parse_level(level)
+    category_levels[category] = level
+  return category_levels
+
+def configure(level="info", category_levels=None):
+  """Sets the level for all categories, then overrides it for those in category_levels."""
+  _ensure_handler()
+  logging.getLogger(_ROOT).setLevel(parse_level(level))
+
+  category_levels = category_levels or {}
+  for category in CATEGORIES:
+    category_level = category_levels.get(category)
+    get(category).setLevel(parse_level(category_level) if category_level else logging.NOTSET)
@@ -0,0 +1,171 @@
+import json
+import sys
+import threading
+import time
+
+from concurrent import futures
+
+import numpy as np
+import tensorflow as tf
+
+from nao.run import graph_execution
+from nao.structure import graph_query
+from nao.tool import json_util
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+
+def _read_jsonl(path):
+  with open(path) as f:
+    for line in f:
+      line = line.strip()
+      if not line:
+        continue
+      yield json.loads(line)
+
+def _example_feeds(example):
+  feeds = {}
+  for name, feature in example.features.feature.items():
+    kind = feature.WhichOneof("kind")
+    if kind == "float_list":
+      feeds[name] = np.array(feature.float_list.value, dtype=np.float32)
+    elif kind == "int64_list":
+      feeds[name] = np.array(feature.int64_list.value, dtype=np.int64)
+    elif kind == "bytes_list":
+      feeds[name] = np.array(feature.bytes_list.value, dtype=object)
+  return feeds
+
+def _read_tfrecord(path):
+  for record in tf.python_io.tf_record_iterator(path):
+    example = tf.train.Example()
+    example.ParseFromString(record)
+    yield _example_feeds(example)
+
+def _read_npz(path):
+  # Each array holds one row per record.
+  with np.load(path) as npz:
+    arrays = dict((name, npz[name]) for name in npz.files)
+
+  lengths = set(len(array) for array in arrays.values())
+  if len(lengths) > 1:
+    raise Exception("Arrays in %s have different lengths: %s" % (path, sorted(lengths)))
+
+  for ix in range(lengths.pop() if lengths else 0):
+    yield dict((name, array[ix]) for name, array in arrays.items())
+
+def read_feeds(path):
+  if path.endswith(".jsonl") or path.endswith(".json"):
+    return _read_jsonl(path)
+  if path.endswith(".tfrecord") or path.endswith(".tfrecords"):
+    return _read_tfrecord(path)
+  if path.endswith(".npz"):
+    return _read_npz(path)
+
+  raise Exception("Don't know how to read feeds from %s. Expected .jsonl, .tfrecord or .npz" % path)
+
+def _feed_name(prefixes, name):
+  # Bare names refer to the inputs of the function being run.
+  if ":" in name:
+    return name
+
+  if len(prefixes) != 1:
+    raise Exception("Feed name %s is ambiguous with more than one result prefix: %s" % (name, prefixes))
+
+  return "%s/inputs/%s:0" % (prefixes[0], name)
+
+def _percentile(sorted_values, p):
+  if not sorted_values:
+    return 0.0
+  ix = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+  return sorted_values[ix]
+
+def _format_stats(latencies, elapsed):
+  latencies = sorted(latencies)
+  count = len(latencies)
+  return "%d records in %.3fs (%.1f records/s). Latency ms p50 %.3f p90 %.3f p99 %.3f max %.3f" % (
+      count,
+      elapsed,
+      count / elapsed if elapsed > 0 else 0.0,
+      _percentile(latencies, 50) * 1000,
+      _percentile(latencies, 90) * 1000,
+      _percentile(latencies, 99) * 1000,
+      (latencies[-1] if latencies else 0.0) * 1000)
+
+def run_batch(
+    meta_graph_def,
+    result_pattern,
+    feed_dict_fn,
+    input_path,
+    output,
+    workers=4,
+    config=None):
+  """Runs the results matching result_pattern once for each record in input_path.
+
+  Everything shares one session. Results are written to output as JSON lines
+  as soon as they finish, so they may be out of order. Each line has the
+  index of its input record.
+  """
+  with tf.Graph().as_default():
+    with graph_execution.create_session(config=config) as sess:
+      release_py_funcs = graph_execution.import_meta_graph(sess, meta_graph_def)
+      coord = tf.train.Coordinator()
+      threads = []
+      try:
+        prefixes, result_names, ops = graph_query.find_results(sess.graph, result_pattern)
+        base_feed_dict = feed_dict_fn()
+        tf.global_variables_initializer().run(feed_dict=base_feed_dict)
+        threads = tf.train.start_queue_runners(coord=coord)
+
+        output_lock = threading.Lock()
+        latencies = []
+        # Don't read more of the input than we have workers to run.
+        in_flight = threading.BoundedSemaphore(workers * 2)
+
+        def run_one(ix, feeds):
+          try:
+            feed_dict = dict(base_feed_dict)
+            for name, value in feeds.items():
+              feed_dict[_feed_name(prefixes, name)] = value
+
+            start = time.time()
+            result_tensors = sess.run(ops, feed_dict=feed_dict)
+            latency = time.time() - start
+
+            results = {}
+            for name, value in zip(result_names, result_tensors):
+              results[name] = json_util.Cleanse(np.asarray(value).tolist())
+
+            line = json.dumps({"index": ix, "results": results})
+            with output_lock:
+              latencies.append(latency)
+              output.write(line)
+              output.write("\n")
+              output.flush()
+          finally:
+            in_flight.release()
+
+        start = time.time()
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+          pending = []
+          for ix, feeds in enumerate(read_feeds(input_path)):
+            in_flight.acquire()
+            pending.append(executor.submit(run_one, ix, feeds))
+            # Surface failures early, rather than after reading everything.
+            still_pending = []
+            for p in pending:
+              if p.done():
+                p.result()
+              else:
+                still_pending.append(p)
+            pending = still_pending
+
+          for p in pending:
+            p.result()
+
+        stats = _format_stats(latencies, time.time() - start)
+        eprint(stats)
+        return stats
+      finally:
+        coord.request_stop()
+        coord.join(threads)
+        release_py_funcs()
@@ -0,0 +1,144 @@
+import re
+import sys
+import threading
+import time
+
+import tensorflow as tf
+
+from nao import log as nao_log
+
+log = nao_log.get("run")
+
+_checkpointer = None
+_resume_step = 0
+
+_STEP_SUFFIX_RE = re.compile(r"-(\d+)$")
+
+class PeriodicCheckpointer:
+  """Saves vars from a background thread every so many steps or seconds.
+
+  The training loop reports progress with notify_step, which never waits on a
+  save. If steps complete faster than we can save them, we skip to the most
+  recent one.
+
+  Snapshots are best-effort: the loop keeps training while we save, so a
+  checkpoint may mix variables from the step it's named for and later ones.
+  That's fine for resuming, but don't expect it to reproduce a step exactly.
+  Saving from inside the step instead would need a second session.run while
+  the step's own run holds an inter-op thread, which deadlocks with a single
+  inter-op thread.
+  """
+
+  def __init__(self, session, vars, checkpoint_prefix, every_steps=None, every_secs=None):
+    self._session = session
+    self._checkpoint_prefix = checkpoint_prefix
+    self._every_steps = every_steps
+    self._every_secs = every_secs
+    with session.graph.as_default():
+      with tf.name_scope(None):
+        self._saver = tf.train.Saver(var_list=vars, name="PeriodicSaver", max_to_keep=3)
+
+    self._cv = threading.Condition()
+    self._stopping = False
+    self._pending_step = None
+    self._last_requested_step = None
+    self._last_requested_time = time.time()
+
+    self._thread = threading.Thread(target=self._run, name="checkpointer")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _due(self, step):
+    if self._last_requested_step is None:
+      self._last_requested_step = step
+      return False
+
+    if self._every_steps and step - self._last_requested_step >= self._every_steps:
+      return True
+
+    if self._every_secs and time.time() - self._last_requested_time >= self._every_secs:
+      return True
+
+    return False
+
+  def notify_step(self, step):
+    with self._cv:
+      if not self._due(step):
+        return
+
+      self._last_requested_step = step
+      self._last_requested_time = time.time()
+      self._pending_step = step
+      self._cv.notify()
+
+  def _run(self):
+    while True:
+      with self._cv:
+        while self._pending_step is None and not self._stopping:
+          self._cv.wait()
+
+        if self._pending_step is None:
+          return
+
+        step = self._pending_step
+        self._pending_step = None
+
+      try:
+        saved_path = self._saver.save(self._session, self._checkpoint_prefix, global_step=step, write_meta_graph=False)
+        log.info("Saved checkpoint for step %d to %s", step, saved_path)
+      except Exception as e:
+        log.warning("Failed to save checkpoint for step %d: %s", step, e)
+
+  def stop(self):
+    with self._cv:
+      self._stopping = True
+      self._cv.notify()
+    self._thread.join()
+
+def restore_latest(session, vars, checkpoint_dir):
+  """Restores vars from the latest checkpoint in checkpoint_dir.
+
+  Returns the step after the one that checkpoint was saved for, or 0 if there's
+  nothing to restore.
+  """
+  checkpoint_path = tf.train.latest_checkpoint(checkpoint_dir)
+  if checkpoint_path is None:
+    log.info("No checkpoint to resume from in %s", checkpoint_dir)
+    return 0
+
+  with session.graph.as_default():
+    with tf.name_scope(None):
+      saver = tf.train.Saver(var_list=vars, name="ResumeSaver")
+  saver.restore(session, checkpoint_path)
+
+  m = _STEP_SUFFIX_RE.search(checkpoint_path)
+  step = int(m.group(1)) + 1 if m else 0
+  log.info("Resuming from %s at step %d", checkpoint_path, step)
+  return step
+
+def set_checkpointer(checkpointer):
+  global _checkpointer
+  _checkpointer = checkpointer
+
+def get_checkpointer():
+  global _checkpointer
+  return _checkpointer
+
+def stop_checkpointer():
+  checkpointer = get_checkpointer()
+  if checkpointer is not None:
+    set_checkpointer(None)
+    checkpointer.stop()
+
+def notify_step(step):
+  checkpointer = _checkpointer
+  if checkpointer is not None:
+    checkpointer.notify_step(step)
+
+def set_resume_step(step):
+  global _resume_step
+  _resume_step = step
+
+def resume_step():
+  global _resume_step
+  return _resume_step
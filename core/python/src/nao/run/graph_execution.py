@@ -1,29 +1,93 @@
 import json
 
+from nao import log as nao_log
 from nao.structure import graph_query
 from nao.structure import graph_xform
 from nao.structure import graph_ffi
+from nao.structure import graph_source
 
+from nao.run import graph_profile
 from nao.run import graph_summary
+from nao.run import graph_trace
 
 from tensorflow.python.framework import meta_graph
 
+import numpy as np
 import tensorflow as tf
+import multiprocessing
 import sys
+import time
 
-from tensorflow.python.client import timeline
 
-def eprint(*args, **kwargs):
-  print(*args, file=sys.stderr, **kwargs)
+log = nao_log.get("run")
 
-def create_session():
-  config = tf.ConfigProto(
-    # log_device_placement=True,
-    operation_timeout_in_ms=600000,
-    inter_op_parallelism_threads=2,
-  )
+def _cpu_count():
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+# Each profile maps a cpu count to ConfigProto fields (plus allow_growth, which
+# lives in gpu_options, and jit, which sets the global XLA JIT level).
+_SESSION_PROFILES = {
+  "default": lambda cpus: {
+    "operation_timeout_in_ms": 600000,
+    "inter_op_parallelism_threads": 2,
+  },
+  # Many independent ops in flight at once, each free to use every core.
+  "throughput": lambda cpus: {
+    "operation_timeout_in_ms": 600000,
+    "inter_op_parallelism_threads": cpus,
+    "intra_op_parallelism_threads": cpus,
+  },
+  # Few ops in flight, but each kernel gets the whole machine.
+  "latency": lambda cpus: {
+    "operation_timeout_in_ms": 600000,
+    "inter_op_parallelism_threads": 2,
+    "intra_op_parallelism_threads": cpus,
+  },
+  # Leave most of the machine for our neighbours.
+  "shared-host": lambda cpus: {
+    "operation_timeout_in_ms": 600000,
+    "inter_op_parallelism_threads": max(1, cpus // 8),
+    "intra_op_parallelism_threads": max(1, cpus // 4),
+  },
+  # For the REPL and Jupyter. Don't allocate everything we think we'll need
+  # ahead of time.
+  "interactive": lambda cpus: {
+    "operation_timeout_in_ms": 20000,
+    "allow_growth": True,
+  },
+}
+
+SESSION_PROFILES = sorted(_SESSION_PROFILES.keys())
+
+def session_config(profile=None, **overrides):
+  if profile is None:
+    profile = "default"
+
+  if profile not in _SESSION_PROFILES:
+    raise Exception("Unknown session profile: %s. Expected one of: %s" % (profile, SESSION_PROFILES))
+
+  options = _SESSION_PROFILES[profile](_cpu_count())
+  for key, value in overrides.items():
+    if value is not None:
+      options[key] = value
 
-  return tf.Session(config=config)
+  allow_growth = options.pop("allow_growth", False)
+  jit = options.pop("jit", False)
+  config = tf.ConfigProto(**options)
+  config.gpu_options.allow_growth = allow_growth
+  if jit:
+    # Let XLA cluster and compile whatever it can, not just ops marked with nao.jit.
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+  return config
+
+def create_session(config=None, graph=None):
+  if config is None:
+    config = session_config()
+
+  return tf.Session(config=config, graph=graph)
 
 def run_session(
     sess,
@@ -32,89 +96,294 @@ def run_session(
     log_dir_fn,
     finish_session_fn=None):
 
+  log.debug("%s %s", tf.GraphKeys.QUEUE_RUNNERS, nao_log.Lazy(lambda: tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)))
+
+  # Initializers may depend on feeds, e.g. to find a moved checkpoint.
+  tf.global_variables_initializer().run(feed_dict=feed_dict)
+
+  coord = tf.train.Coordinator()
+  threads = tf.train.start_queue_runners(coord=coord)
+
+  try:
+    return run_results(sess, result_pattern, feed_dict, log_dir_fn, finish_session_fn=finish_session_fn)
+  finally:
+    coord.request_stop()
+    coord.join(threads)
+
+def run_results(
+    sess,
+    result_pattern,
+    feed_dict,
+    log_dir_fn,
+    finish_session_fn=None,
+    start_session_fn=None):
+  """Runs the results matching result_pattern in an already initialized session."""
+
   prefixes, result_names, ops = graph_query.find_results(sess.graph, result_pattern)
   log_dir = log_dir_fn(prefixes)
   graph_summary.set_summary_writer(tf.summary.FileWriter(log_dir, sess.graph))
 
-  eprint(tf.GraphKeys.QUEUE_RUNNERS, tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS))
-
-  tf.global_variables_initializer().run()
-
-  coord = tf.train.Coordinator()
+  if start_session_fn:
+    start_session_fn(sess, prefixes)
 
-  run_options = tf.RunOptions(
-    # trace_level=tf.RunOptions.FULL_TRACE
-  )
-  run_metadata = tf.RunMetadata()
+  collectors = []
+  steps = 1
+  trace_collector = graph_trace.get_trace_collector()
+  if trace_collector:
+    collectors.append(trace_collector)
+  profile_collector = graph_profile.get_profile_collector()
+  if profile_collector:
+    collectors.append(profile_collector)
+    profile_collector.add_source_positions(graph_source.load(sess.graph))
+    steps = profile_collector.steps_per_run()
 
-  threads = tf.train.start_queue_runners(coord=coord)
+  run_options = tf.RunOptions()
+  if collectors:
+    run_options.trace_level = tf.RunOptions.FULL_TRACE
 
   try:
-    result_tensors = sess.run(
-      fetches=ops,
-      feed_dict=feed_dict,
-      options=run_options,
-      run_metadata=run_metadata,
-    )
+    for step in range(steps):
+      run_metadata = tf.RunMetadata()
+      try:
+        result_tensors = sess.run(
+          fetches=ops,
+          feed_dict=feed_dict,
+          options=run_options,
+          run_metadata=run_metadata,
+        )
+      finally:
+        for collector in collectors:
+          collector.add_run_metadata(run_metadata)
 
     if finish_session_fn:
       finish_session_fn(sess, prefixes)
 
     return dict(zip(result_names, result_tensors))
   finally:
-    # Create the Timeline object, and write it to a json
-    # tl = timeline.Timeline(run_metadata.step_stats)
-    # ctf = tl.generate_chrome_trace_format()
-    # with open('timeline.json', 'w') as f:
-    #     f.write(ctf)
-
-    coord.request_stop()
-    coord.join(threads)
     graph_summary.set_summary_writer(None)
 
 from tensorflow.python.ops import script_ops
 
+def import_meta_graph(sess, meta_graph_def):
+  """Import meta_graph_def into sess.graph and restore any py_funcs it uses.
+
+  Returns a function that releases the restored py_funcs.
+  """
+  # TODO(adamb) Carefully find the asset map and replace any asset py funcs appropriately with input_map.
+  try:
+    meta_graph.import_scoped_meta_graph(
+      meta_graph_def,
+      input_map=None,
+    )
+  except KeyError as e:
+    g = tf.get_default_graph()
+    log.debug("error, but got nodes %s", nao_log.Lazy(lambda: sorted(op.name for op in g.get_operations())))
+    raise e
+
+  # NOTE(adamb) Could also store files to copy out in assets_collection
+  js_py_func_data_tensor = None
+  try:
+    js_py_func_data_tensor = sess.graph.get_tensor_by_name("py_funcs_json:0")
+  except KeyError as e:
+    pass
+
+  if js_py_func_data_tensor is None:
+    return lambda: None
+
+  js_py_func_data = js_py_func_data_tensor.eval().decode('utf-8')
+  py_func_data = json.loads(js_py_func_data)
+  # eprint('loaded py_func_data', py_func_data)
+  py_importer = graph_ffi.PythonImporter()
+  py_importer.restore_py_funcs(script_ops._py_funcs, py_func_data)
+
+  return lambda: py_importer.release_py_funcs(script_ops._py_funcs, py_func_data)
+
 def import_and_run_meta_graph(
     meta_graph_def,
     result_pattern,
     feed_dict_fn,
     log_dir_fn,
-    finish_session_fn=None):
-  # TODO(adamb) Carefully find the asset map and replace any asset py funcs appropriately with input_map.
-  with create_session() as sess:
-    try:
-      meta_graph.import_scoped_meta_graph(
-        meta_graph_def,
-        input_map=None,
-      )
-    except KeyError as e:
-      nodes = [n.name for n in tf.get_default_graph().as_graph_def().node]
-      nodes.sort()
-      eprint('error, but got nodes', nodes)
-      raise e
-
-    # NOTE(adamb) Could also store files to copy out in assets_collection
-    js_py_func_data_tensor = None
-    try:
-      js_py_func_data_tensor = sess.graph.get_tensor_by_name("py_funcs_json:0")
-    except KeyError as e:
-      pass
-
-    if js_py_func_data_tensor is not None:
-      js_py_func_data = js_py_func_data_tensor.eval().decode('utf-8')
-      py_func_data = json.loads(js_py_func_data)
-      # eprint('loaded py_func_data', py_func_data)
-      py_importer = graph_ffi.PythonImporter()
-      py_importer.restore_py_funcs(script_ops._py_funcs, py_func_data)
+    finish_session_fn=None,
+    config=None):
+  with create_session(config=config) as sess:
+    release_py_funcs = import_meta_graph(sess, meta_graph_def)
 
     try:
       return run_session(sess, result_pattern, feed_dict_fn(), log_dir_fn, finish_session_fn=finish_session_fn)
     finally:
+      release_py_funcs()
       sess.close()
 
 
-def run_imported_graph(graph_def, result_pattern, feed_dict_fn, log_dir_fn):
-  with create_session() as sess:
+class Phase:
+  def __init__(self, name, result_pattern, finish_session_fn=None, start_session_fn=None, run_fn=None):
+    self.name = name
+    self.result_pattern = result_pattern
+    self.finish_session_fn = finish_session_fn
+    self.start_session_fn = start_session_fn
+    # If given, run_fn(sess, feed_dict) replaces the usual single run of every result.
+    self.run_fn = run_fn
+
+def import_and_run_phases(
+    meta_graph_def,
+    phases,
+    feed_dict_fn,
+    log_dir_fn,
+    export=False,
+    config=None):
+  """Runs each phase in turn against a single import of meta_graph_def.
+
+  Variables are initialized once, so later phases see what earlier phases
+  did to them (e.g. test after train). Returns a dict of results by phase
+  name and, if export is True, the final MetaGraphDef.
+  """
+  with tf.Graph().as_default():
+    with create_session(config=config) as sess:
+      release_py_funcs = import_meta_graph(sess, meta_graph_def)
+
+      log.debug("%s %s", tf.GraphKeys.QUEUE_RUNNERS, nao_log.Lazy(lambda: tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)))
+
+      coord = tf.train.Coordinator()
+      threads = []
+      try:
+        feed_dict = feed_dict_fn()
+        tf.global_variables_initializer().run(feed_dict=feed_dict)
+        threads = tf.train.start_queue_runners(coord=coord)
+
+        results = {}
+        profile_collector = graph_profile.get_profile_collector()
+        for phase in phases:
+          log.info("Running phase %s", phase.name)
+          if profile_collector:
+            profile_collector.start_phase(phase.name)
+          if phase.run_fn:
+            results[phase.name] = phase.run_fn(sess, feed_dict)
+            continue
+
+          results[phase.name] = run_results(
+              sess,
+              phase.result_pattern,
+              feed_dict,
+              log_dir_fn,
+              finish_session_fn=phase.finish_session_fn,
+              start_session_fn=phase.start_session_fn)
+
+        exported_meta_graph_def = None
+        if export:
+          exported_meta_graph_def, _ = meta_graph.export_scoped_meta_graph()
+
+        return results, exported_meta_graph_def
+      finally:
+        coord.request_stop()
+        coord.join(threads)
+        release_py_funcs()
+
+def _time_runs(sess, fetches, feed_dict, steps):
+  if not fetches:
+    return None
+
+  # Warm up once, so we don't measure one-time allocations.
+  sess.run(fetches, feed_dict=feed_dict)
+  start = time.time()
+  for _ in range(steps):
+    sess.run(fetches, feed_dict=feed_dict)
+  return (time.time() - start) / steps
+
+def _time_import(pb, import_fn):
+  serialized = pb.SerializeToString()
+  start = time.time()
+  with tf.Graph().as_default():
+    parsed = type(pb)()
+    parsed.ParseFromString(serialized)
+    import_fn(parsed)
+  return time.time() - start
+
+def _compare_outputs(expected_graph_def, actual_graph_def, node_names, feed_dict, config):
+  """Runs node_names in both graphs and reports how far apart their float results are."""
+  def run(graph_def):
+    node_names_in_graph = set(node.name for node in graph_def.node)
+    feeds = {k: v for k, v in feed_dict.items() if k.split(":")[0] in node_names_in_graph}
+    with tf.Graph().as_default() as graph:
+      tf.import_graph_def(graph_def, name="")
+      with create_session(config=config, graph=graph) as sess:
+        results = []
+        for name in node_names:
+          try:
+            results.append((sess.run("%s:0" % name, feed_dict=feeds), None))
+          except Exception as e:
+            results.append((None, str(e).split("\n")[0]))
+        return results
+
+  # Nothing is running the queue runners these would wait on.
+  queued = set(graph_xform.queue_dependent_outputs(expected_graph_def, node_names))
+  entries = [{"name": name, "error": "reads from an input queue"} for name in node_names if name in queued]
+  node_names = [name for name in node_names if name not in queued]
+  for name, (expected, expected_error), (actual, actual_error) in zip(
+      node_names, run(expected_graph_def), run(actual_graph_def)):
+    entry = {"name": name}
+    if expected_error or actual_error:
+      entry["error"] = actual_error or expected_error
+    else:
+      expected, actual = np.asarray(expected), np.asarray(actual)
+      if expected.dtype.kind == "f":
+        delta = np.abs(actual.astype(np.float64) - expected)
+        entry["max_abs_delta"] = float(delta.max()) if delta.size else 0.0
+        entry["max_rel_delta"] = float((delta / np.maximum(np.abs(expected), 1e-12)).max()) if delta.size else 0.0
+      else:
+        entry["equal"] = bool(np.array_equal(expected, actual))
+    entries.append(entry)
+  return entries
+
+def freeze_meta_graph(meta_graph_def, output_node_names, feed_dict_fn, config=None, steps=10,
+    quantize=None, check_node_names=()):
+  """Initializes meta_graph_def and freezes what output_node_names need into a GraphDef.
+
+  If quantize is one of graph_xform.QUANTIZE_MODES, weights are stored as
+  uint8 and check_node_names are run before and after to measure what that
+  costs in accuracy.
+
+  Returns the GraphDef and a report of what freezing removed, how long each
+  graph takes to load and how long a run of the outputs that need no feeds
+  takes in each.
+  """
+  with tf.Graph().as_default():
+    with create_session(config=config) as sess:
+      release_py_funcs = import_meta_graph(sess, meta_graph_def)
+      try:
+        feed_dict = feed_dict_fn()
+        tf.global_variables_initializer().run(feed_dict=feed_dict)
+        graph_def, report = graph_xform.freeze_graph(sess, list(output_node_names) + list(check_node_names))
+
+        if quantize:
+          float_graph_def = tf.GraphDef()
+          float_graph_def.CopyFrom(graph_def)
+          report.update(graph_xform.quantize_weights(graph_def, quantize))
+          report["accuracy"] = _compare_outputs(
+              float_graph_def, graph_def, check_node_names,
+              {getattr(k, "name", k): v for k, v in feed_dict.items()}, config)
+
+        if check_node_names:
+          graph_xform.prune_to_outputs(graph_def, output_node_names)
+        report["nodes_after"] = len(graph_def.node)
+        report["bytes_after"] = graph_def.ByteSize()
+
+        fetches = ["%s:0" % name for name in graph_xform.runnable_outputs(graph_def, output_node_names)]
+        report["run_secs_before"] = _time_runs(sess, fetches, feed_dict, steps)
+        with tf.Graph().as_default() as frozen_graph:
+          tf.import_graph_def(graph_def, name="")
+          with create_session(config=config, graph=frozen_graph) as frozen_sess:
+            report["run_secs_after"] = _time_runs(frozen_sess, fetches, None, steps)
+      finally:
+        release_py_funcs()
+
+  report["load_secs_before"] = _time_import(
+      meta_graph_def, lambda pb: meta_graph.import_scoped_meta_graph(pb))
+  report["load_secs_after"] = _time_import(
+      graph_def, lambda pb: tf.import_graph_def(pb, name=""))
+  return graph_def, report
+
+def run_imported_graph(graph_def, result_pattern, feed_dict_fn, log_dir_fn, config=None):
+  with create_session(config=config) as sess:
     tf.import_graph_def(
       graph_def,
       name=""
@@ -124,3 +393,66 @@ def run_imported_graph(graph_def, result_pattern, feed_dict_fn, log_dir_fn):
       return run_session(sess, result_pattern, feed_dict_fn(), log_dir_fn)
     finally:
       sess.close()
+
+def _thread_counts(cpus):
+  counts = []
+  n = 1
+  while n < cpus:
+    counts.append(n)
+    n *= 2
+  counts.append(cpus)
+  return counts
+
+def _time_session(config, meta_graph_def, result_pattern, feed_dict_fn, steps):
+  with tf.Graph().as_default():
+    with create_session(config=config) as sess:
+      release_py_funcs = import_meta_graph(sess, meta_graph_def)
+      coord = tf.train.Coordinator()
+      threads = []
+      try:
+        _, _, ops = graph_query.find_results(sess.graph, result_pattern)
+        feed_dict = feed_dict_fn()
+        tf.global_variables_initializer().run(feed_dict=feed_dict)
+        threads = tf.train.start_queue_runners(coord=coord)
+
+        # Warm up once, so we don't measure one-time allocations.
+        sess.run(ops, feed_dict=feed_dict)
+
+        start = time.time()
+        for _ in range(steps):
+          sess.run(ops, feed_dict=feed_dict)
+        return (time.time() - start) / steps
+      finally:
+        coord.request_stop()
+        coord.join(threads)
+        release_py_funcs()
+
+def autotune_session_config(
+    meta_graph_def,
+    result_pattern,
+    feed_dict_fn,
+    profile=None,
+    steps=5):
+  """Time the results matching result_pattern for a grid of thread pool sizes.
+
+  Returns the fastest overrides for the given profile, suitable for passing
+  to session_config.
+  """
+  cpus = _cpu_count()
+  counts = _thread_counts(cpus)
+
+  best = None
+  for inter in counts:
+    for intra in counts:
+      overrides = {
+        "inter_op_parallelism_threads": inter,
+        "intra_op_parallelism_threads": intra,
+      }
+      config = session_config(profile, **overrides)
+      seconds = _time_session(config, meta_graph_def, result_pattern, feed_dict_fn, steps)
+      log.info("autotune inter_op=%d intra_op=%d: %.3fms per step", inter, intra, seconds * 1000)
+      if best is None or seconds < best[0]:
+        best = (seconds, overrides)
+
+  log.info("autotune best %s: %.3fms per step", best[1], best[0] * 1000)
+  return best[1]
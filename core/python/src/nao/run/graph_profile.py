@@ -0,0 +1,242 @@
+import json
+
+from os import path
+
+from nao.structure import graph_scope
+
+_profile_collector = None
+
+TOP_LEVEL = "(top level)"
+
+class _Cost:
+  def __init__(self, name):
+    self.name = name
+    self.self_micros = 0
+    self.cumulative_micros = 0
+    self.peak_bytes = 0
+    self.self_ops = 0
+    self.cumulative_ops = 0
+
+  def as_dict(self, steps):
+    return {
+      "name": self.name,
+      "self_micros": self.self_micros,
+      "cumulative_micros": self.cumulative_micros,
+      "self_micros_per_step": self.self_micros / max(1, steps),
+      "cumulative_micros_per_step": self.cumulative_micros / max(1, steps),
+      "peak_bytes": self.peak_bytes,
+      "self_ops": self.self_ops,
+      "cumulative_ops": self.cumulative_ops,
+    }
+
+class _OpCost:
+  def __init__(self):
+    self.micros = 0
+    self.peak_bytes = 0
+    self.executions = 0
+
+def _node_peak_bytes(node_stats):
+  peak_bytes = 0
+  for memory in node_stats.memory:
+    peak_bytes += memory.peak_bytes
+  return peak_bytes
+
+class _PhaseCosts:
+  """Op costs and step count for one phase, e.g. train or test."""
+
+  def __init__(self, name, positions):
+    self.name = name
+    self.steps = 0
+    self.ops = {} # op name -> _OpCost
+    self._positions = positions
+
+  def add_run_metadata(self, run_metadata):
+    self.steps += 1
+    for dev_stats in run_metadata.step_stats.dev_stats:
+      for node_stats in dev_stats.node_stats:
+        # GPU stream stats are named "op:type" and duplicate the compute stats.
+        if ":" in node_stats.node_name:
+          continue
+
+        if node_stats.node_name not in self.ops:
+          self.ops[node_stats.node_name] = _OpCost()
+
+        cost = self.ops[node_stats.node_name]
+        cost.micros += node_stats.op_end_rel_micros - node_stats.op_start_rel_micros
+        cost.peak_bytes = max(cost.peak_bytes, _node_peak_bytes(node_stats))
+        cost.executions += 1
+
+  def _aggregate(self, keys_fn):
+    costs = {}
+    def cost_for(key):
+      if key not in costs:
+        costs[key] = _Cost(key)
+      return costs[key]
+
+    for op_name, op_cost in self.ops.items():
+      keys = keys_fn(op_name)
+
+      # Self cost goes to the innermost key, cumulative cost to every key once.
+      innermost = cost_for(keys[-1])
+      innermost.self_micros += op_cost.micros
+      innermost.self_ops += 1
+
+      for key in set(keys):
+        cost = cost_for(key)
+        cost.cumulative_micros += op_cost.micros
+        cost.cumulative_ops += 1
+        cost.peak_bytes = max(cost.peak_bytes, op_cost.peak_bytes)
+
+    return sorted(costs.values(), key=lambda c: (-c.cumulative_micros, c.name))
+
+  def by_function(self):
+    return self._aggregate(lambda op_name: [TOP_LEVEL] + graph_scope.function_stack(op_name))
+
+  def by_package(self):
+    return self._aggregate(lambda op_name: [op_name.split("/", 1)[0]])
+
+  def by_call_site(self):
+    return self._aggregate(
+        lambda op_name: [TOP_LEVEL] + [scope for scope, _ in graph_scope.function_scopes(op_name)])
+
+  def by_line(self):
+    """Returns {file: {line: _Cost}} for ops with a known source position."""
+    files = {}
+    for op_name, op_cost in self.ops.items():
+      if op_name not in self._positions:
+        continue
+
+      filename, line, _ = self._positions[op_name]
+      lines = files.setdefault(filename, {})
+      if line not in lines:
+        lines[line] = _Cost("%s:%d" % (filename, line))
+
+      cost = lines[line]
+      cost.self_micros += op_cost.micros
+      cost.cumulative_micros += op_cost.micros
+      cost.self_ops += 1
+      cost.cumulative_ops += 1
+      cost.peak_bytes += op_cost.peak_bytes
+
+    return files
+
+  def report(self):
+    steps = self.steps
+    lines = []
+    for filename, costs in sorted(self.by_line().items()):
+      for line, cost in sorted(costs.items()):
+        d = cost.as_dict(steps)
+        d["file"] = filename
+        d["line"] = line
+        lines.append(d)
+
+    return {
+      "phase": self.name,
+      "steps": steps,
+      "functions": [c.as_dict(steps) for c in self.by_function()],
+      "packages": [c.as_dict(steps) for c in self.by_package()],
+      "call_sites": [c.as_dict(steps) for c in self.by_call_site()],
+      "lines": lines,
+    }
+
+  def format_source(self, src_root):
+    steps = max(1, self.steps)
+    out = []
+    for filename, costs in sorted(self.by_line().items()):
+      filepath = path.join(src_root, filename)
+      if not path.exists(filepath):
+        continue
+
+      with open(filepath) as f:
+        source_lines = f.read().split("\n")
+
+      out.append("")
+      out.append("%10s %12s  %s (%s)" % ("ms", "bytes", filename, self.name))
+      for ix, source_line in enumerate(source_lines):
+        cost = costs.get(ix + 1)
+        if cost is None:
+          out.append("%10s %12s  %4d  %s" % ("", "", ix + 1, source_line))
+        else:
+          out.append("%10.3f %12d  %4d  %s" % (
+              cost.self_micros / 1000.0 / steps,
+              cost.peak_bytes,
+              ix + 1,
+              source_line))
+
+    return "\n".join(out)
+
+  def format_text(self, limit):
+    steps = max(1, self.steps)
+    lines = ["Profiled %d step(s) of %s. Times are milliseconds per step." % (self.steps, self.name)]
+
+    for title, costs in [
+        ("function", self.by_function()),
+        ("package", self.by_package()),
+        ("call site", self.by_call_site())]:
+      lines.append("")
+      lines.append("%10s %10s %8s %12s  %s" % ("self", "cumulative", "ops", "peak bytes", title))
+      for cost in costs[:limit]:
+        lines.append("%10.3f %10.3f %8d %12d  %s" % (
+            cost.self_micros / 1000.0 / steps,
+            cost.cumulative_micros / 1000.0 / steps,
+            cost.cumulative_ops,
+            cost.peak_bytes,
+            cost.name))
+      if len(costs) > limit:
+        lines.append("... %d more" % (len(costs) - limit))
+
+    return "\n".join(lines)
+
+class FunctionCostCollector:
+  """Attributes op runtimes and memory to the Tensorlang functions that created them.
+
+  Costs and steps are kept per phase, since a train step and a test step
+  aren't comparable. Runs before any start_phase count as "run".
+  """
+
+  def __init__(self, steps=1):
+    self._steps_per_run = steps
+    self._positions = {} # op name -> (file, line, column)
+    self._phases = [] # [_PhaseCosts], in the order they started
+    self._phase = None
+
+  def steps_per_run(self):
+    return self._steps_per_run
+
+  def start_phase(self, name):
+    for phase in self._phases:
+      if phase.name == name:
+        self._phase = phase
+        return
+    self._phase = _PhaseCosts(name, self._positions)
+    self._phases.append(self._phase)
+
+  def add_source_positions(self, positions):
+    self._positions.update(positions)
+
+  def add_run_metadata(self, run_metadata):
+    if self._phase is None:
+      self.start_phase("run")
+    self._phase.add_run_metadata(run_metadata)
+
+  def report(self):
+    return {"phases": [phase.report() for phase in self._phases]}
+
+  def format_source(self, src_root):
+    """Annotates each source file with the per-step time and memory of its lines, for each phase."""
+    return "\n".join(phase.format_source(src_root) for phase in self._phases)
+
+  def format_text(self, limit=25):
+    return "\n\n".join(phase.format_text(limit) for phase in self._phases)
+
+  def write(self, filepath):
+    with open(filepath, "w") as f:
+      json.dump(self.report(), f, indent=2, sort_keys=True)
+
+def set_profile_collector(profile_collector):
+  global _profile_collector
+  _profile_collector = profile_collector
+
+def get_profile_collector():
+  global _profile_collector
+  return _profile_collector
@@ -0,0 +1,103 @@
+import json
+
+from nao.structure import graph_scope
+
+from tensorflow.core.framework import step_stats_pb2
+from tensorflow.python.client import timeline
+
+_trace_collector = None
+
+class TraceCollector:
+  """Merges the StepStats of every traced sess.run into one Chrome trace."""
+
+  def __init__(self, path):
+    self._path = path
+    self._step_stats = step_stats_pb2.StepStats()
+    self._dev_stats = {} # device -> DeviceStepStats
+    self._spans = []
+
+  def path(self):
+    return self._path
+
+  def add_run_metadata(self, run_metadata):
+    # Spans are computed per run, so repeated calls to a function over many
+    # runs don't collapse into one giant span.
+    spans = {} # scope -> [name, depth, start, end]
+    for dev_stats in run_metadata.step_stats.dev_stats:
+      if dev_stats.device not in self._dev_stats:
+        merged = self._step_stats.dev_stats.add()
+        merged.device = dev_stats.device
+        self._dev_stats[dev_stats.device] = merged
+
+      self._dev_stats[dev_stats.device].node_stats.extend(dev_stats.node_stats)
+
+      for node_stats in dev_stats.node_stats:
+        start = node_stats.all_start_micros
+        end = start + node_stats.all_end_rel_micros
+        for depth, (scope, name) in enumerate(graph_scope.function_scopes(node_stats.node_name)):
+          if scope in spans:
+            span = spans[scope]
+            span[2] = min(span[2], start)
+            span[3] = max(span[3], end)
+          else:
+            spans[scope] = [name, depth, start, end]
+
+    for scope, (name, depth, start, end) in spans.items():
+      self._spans.append((scope, name, depth, start, end))
+
+  def empty(self):
+    return len(self._dev_stats) == 0
+
+  def chrome_trace(self):
+    tl = timeline.Timeline(self._step_stats)
+    trace = json.loads(tl.generate_chrome_trace_format(show_memory=False))
+    events = trace["traceEvents"]
+
+    pid = 0
+    for event in events:
+      pid = max(pid, event.get("pid", 0) + 1)
+
+      args = event.get("args")
+      if event.get("ph") != "X" or not args or "name" not in args:
+        continue
+
+      stack = graph_scope.function_stack(args["name"])
+      if not stack:
+        continue
+
+      args["tensorlang"] = " > ".join(stack)
+      event["name"] = "%s %s" % (stack[-1], event["name"])
+
+    if self._spans:
+      events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "Tensorlang functions"}})
+
+    depths = set()
+    for scope, name, depth, start, end in self._spans:
+      if depth not in depths:
+        depths.add(depth)
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": depth, "args": {"name": "depth %d" % depth}})
+
+      events.append({
+        "name": name,
+        "cat": "Function",
+        "ph": "X",
+        "pid": pid,
+        "tid": depth,
+        "ts": start,
+        "dur": end - start,
+        "args": {"scope": scope},
+      })
+
+    return trace
+
+  def write(self):
+    with open(self._path, "w") as f:
+      json.dump(self.chrome_trace(), f)
+
+def set_trace_collector(trace_collector):
+  global _trace_collector
+  _trace_collector = trace_collector
+
+def get_trace_collector():
+  global _trace_collector
+  return _trace_collector
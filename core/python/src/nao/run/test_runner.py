@@ -0,0 +1,284 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import traceback
+
+from os import path
+from xml.etree import ElementTree
+
+import tensorflow as tf
+
+from tensorflow.core.protobuf import meta_graph_pb2
+
+from nao.run import graph_execution
+from nao.structure import graph_query
+from nao.structure import graph_xform
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+
+def find_test_prefixes(name_index, test_result_pattern):
+  prefixes = set()
+  for _, _, m in name_index.match(test_result_pattern):
+    prefixes.add(m.group(1))
+  return sorted(prefixes)
+
+def parse_shard(shard):
+  """Parses "i/n" into (i, n), with i counting from 0."""
+  m = re.match(r"^(\d+)/(\d+)$", shard or "")
+  if not m:
+    raise Exception("Expected a test shard like 0/4, got: %s" % shard)
+
+  index, count = int(m.group(1)), int(m.group(2))
+  if count < 1 or index >= count:
+    raise Exception("Test shard index must be less than shard count: %s" % shard)
+  return index, count
+
+def select_shard(prefixes, shard):
+  if shard is None:
+    return prefixes
+
+  index, count = shard
+  return [p for ix, p in enumerate(prefixes) if ix % count == index]
+
+def _prefix_pattern(prefix):
+  return re.compile("^(%s)/outputs/(.*)$" % re.escape(prefix))
+
+def run_test(sess, feed_dict, prefix, timeout_secs=None):
+  """Runs a single test in sess, returning a report entry. Never raises."""
+  start = time.time()
+  entry = {"name": prefix}
+  try:
+    _, result_names, ops = graph_query.find_results(sess.graph, _prefix_pattern(prefix))
+    run_options = tf.RunOptions()
+    if timeout_secs:
+      run_options.timeout_in_ms = int(timeout_secs * 1000)
+
+    sess.run(ops, feed_dict=feed_dict, options=run_options)
+    entry["status"] = "passed"
+  except tf.errors.DeadlineExceededError:
+    entry["status"] = "timeout"
+    entry["error"] = "Timed out after %ss" % timeout_secs
+  except Exception as e:
+    entry["status"] = "failed"
+    entry["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+
+  entry["seconds"] = time.time() - start
+  eprint("%-8s %8.3fs %s" % (entry["status"], entry["seconds"], prefix))
+  if "error" in entry:
+    eprint(entry["error"])
+  return entry
+
+def feed_dict_by_name(feed_dict):
+  """Keys feed_dict by tensor name, so it can be sent to another process."""
+  return {getattr(k, "name", k): v for k, v in feed_dict.items()}
+
+def run_tests_in_session(sess, feed_dict, prefixes, timeout_secs=None):
+  return [run_test(sess, feed_dict, prefix, timeout_secs) for prefix in prefixes]
+
+# Each worker process imports the metagraph once and keeps its session.
+_worker_session = None
+_worker_feed_dict = None
+
+def _init_worker(meta_graph_def_bytes, feed_dict, config_bytes, relocated_files_dir):
+  global _worker_session, _worker_feed_dict
+
+  meta_graph_def = meta_graph_pb2.MetaGraphDef()
+  meta_graph_def.ParseFromString(meta_graph_def_bytes)
+
+  config = None
+  if config_bytes is not None:
+    config = tf.ConfigProto()
+    config.ParseFromString(config_bytes)
+
+  graph = tf.Graph()
+  with graph.as_default():
+    _worker_session = graph_execution.create_session(config=config, graph=graph)
+    with _worker_session.as_default():
+      graph_execution.import_meta_graph(_worker_session, meta_graph_def)
+
+      _worker_feed_dict = dict(feed_dict)
+      if relocated_files_dir:
+        _worker_feed_dict.update(feed_dict_by_name(
+            graph_xform.relocated_file_feeds(graph, relocated_files_dir)))
+
+      tf.global_variables_initializer().run(feed_dict=_worker_feed_dict)
+      tf.train.start_queue_runners(sess=_worker_session, coord=tf.train.Coordinator())
+
+def _run_worker_test(prefix, timeout_secs):
+  with _worker_session.graph.as_default():
+    return run_test(_worker_session, _worker_feed_dict, prefix, timeout_secs)
+
+def run_tests_in_workers(
+    meta_graph_def,
+    feed_dict,
+    prefixes,
+    workers,
+    timeout_secs=None,
+    config=None,
+    relocated_files_dir=None):
+  """Runs each test as its own fetch across a pool of worker processes.
+
+  Each worker imports meta_graph_def once. feed_dict must be keyed by tensor
+  name. Tests that outlive their timeout
+  (e.g. stuck in a py_func) are reported as timeouts and their workers are
+  terminated at the end.
+  """
+  # Forking a process that has already started TensorFlow isn't safe.
+  ctx = multiprocessing.get_context("spawn")
+  pool = ctx.Pool(
+      processes=min(workers, max(1, len(prefixes))),
+      initializer=_init_worker,
+      initargs=(
+        meta_graph_def.SerializeToString(),
+        feed_dict,
+        config.SerializeToString() if config is not None else None,
+        relocated_files_dir))
+
+  stuck = False
+  try:
+    pending = [(prefix, pool.apply_async(_run_worker_test, (prefix, timeout_secs))) for prefix in prefixes]
+
+    # Give the session's own deadline a chance to fire first.
+    wait_secs = timeout_secs * 2 + 10 if timeout_secs else None
+
+    entries = []
+    for prefix, async_result in pending:
+      try:
+        entries.append(async_result.get(wait_secs))
+      except multiprocessing.TimeoutError:
+        stuck = True
+        entries.append({
+          "name": prefix,
+          "status": "timeout",
+          "error": "Worker didn't respond within %ss" % wait_secs,
+          "seconds": wait_secs,
+        })
+    return entries
+  finally:
+    if stuck:
+      pool.terminate()
+    else:
+      pool.close()
+    pool.join()
+
+class TestCache:
+  """Remembers which tests passed, keyed by a digest of what they were built from.
+
+  package_digests maps package names to Compiler.import_digest values. Tests
+  in packages without a digest are never cached. salt covers anything else a
+  result depends on, like the TensorFlow version and feeds.
+  """
+
+  def __init__(self, cache_dir, package_digests, salt=""):
+    self._cache_dir = cache_dir
+    self._package_digests = package_digests
+    self._salt = salt
+
+  def _entry_path(self, prefix):
+    package_name = prefix.rpartition("/")[0]
+    package_digest = self._package_digests.get(package_name)
+    if package_digest is None:
+      return None
+
+    key = hashlib.sha256(("%s\0%s\0%s" % (package_digest, prefix, self._salt)).encode('utf-8')).hexdigest()
+    return path.join(self._cache_dir, "%s.json" % key)
+
+  def lookup(self, prefix):
+    entry_path = self._entry_path(prefix)
+    if entry_path is None or not path.exists(entry_path):
+      return None
+
+    with open(entry_path) as f:
+      cached = json.load(f)
+    return {
+      "name": prefix,
+      "status": "cached",
+      "seconds": 0.0,
+      "cached_seconds": cached["seconds"],
+    }
+
+  def store(self, entry):
+    entry_path = self._entry_path(entry["name"])
+    if entry_path is None:
+      return
+
+    if not path.exists(self._cache_dir):
+      os.makedirs(self._cache_dir)
+    tmp_path = entry_path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(entry, f)
+    os.rename(tmp_path, entry_path)
+
+def run_with_cache(prefixes, run_fn, cache=None):
+  """Calls run_fn with the prefixes that haven't passed before, caching new passes."""
+  if cache is None:
+    return run_fn(prefixes)
+
+  entries_by_name = {}
+  uncached = []
+  for prefix in prefixes:
+    entry = cache.lookup(prefix)
+    if entry is None:
+      uncached.append(prefix)
+    else:
+      eprint("%-8s %8s  %s" % ("cached", "", prefix))
+      entries_by_name[prefix] = entry
+
+  if not uncached:
+    return [entries_by_name[prefix] for prefix in prefixes]
+
+  for entry in run_fn(uncached):
+    if entry["status"] == "passed":
+      cache.store(entry)
+    entries_by_name[entry["name"]] = entry
+
+  return [entries_by_name[prefix] for prefix in prefixes]
+
+def summarize(entries):
+  counts = {}
+  for entry in entries:
+    counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+  return ", ".join("%d %s" % (n, status) for status, n in sorted(counts.items()))
+
+def failures(entries):
+  return [entry for entry in entries if entry["status"] not in ("passed", "cached")]
+
+def failure_message(failed):
+  return "Tests didn't pass:\n" + "\n".join(
+      "%s (%s): %s" % (entry["name"], entry["status"], entry.get("error", "")) for entry in failed)
+
+def _write_junit(entries, filepath):
+  suite = ElementTree.Element("testsuite", {
+    "name": "nao",
+    "tests": str(len(entries)),
+    "failures": str(len([e for e in entries if e["status"] == "failed"])),
+    "errors": str(len([e for e in entries if e["status"] == "timeout"])),
+    "time": "%.3f" % sum(e["seconds"] for e in entries),
+  })
+  for entry in entries:
+    classname, _, name = entry["name"].rpartition("/")
+    case = ElementTree.SubElement(suite, "testcase", {
+      "classname": classname,
+      "name": name,
+      "time": "%.3f" % entry["seconds"],
+    })
+    if entry["status"] == "cached":
+      ElementTree.SubElement(case, "system-out").text = "cached pass"
+    elif entry["status"] == "failed":
+      ElementTree.SubElement(case, "failure", {"message": entry["error"].split("\n", 1)[0]}).text = entry["error"]
+    elif entry["status"] == "timeout":
+      ElementTree.SubElement(case, "error", {"message": entry["error"]})
+
+  ElementTree.ElementTree(suite).write(filepath, encoding="utf-8", xml_declaration=True)
+
+def write_report(entries, filepath):
+  if filepath.endswith(".xml"):
+    _write_junit(entries, filepath)
+  else:
+    with open(filepath, "w") as f:
+      json.dump({"tests": entries, "summary": summarize(entries)}, f, indent=2, sort_keys=True)
@@ -0,0 +1,213 @@
+import contextlib
+import gc
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from os import path
+
+import tensorflow as tf
+
+from tensorflow.python.ops import script_ops
+
+from nao.compiler.asset import compiler as asset_compiler
+from nao.compiler.py import compiler as py_compiler
+from nao.run import graph_checkpoint
+from nao.run import graph_profile
+from nao.run import graph_summary
+from nao.run import graph_trace
+from nao.structure import graph_source
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+
+# Fixtures check what tests print, so they can't come from the test cache.
+_ACTION_FLAGS = {
+  "run": ["--run"],
+  "test": ["--test", "--no-test-cache"],
+  "export": [],
+}
+
+_REGEXP_FLAGS = {
+  "i": re.IGNORECASE,
+  "m": re.MULTILINE,
+}
+
+def load_cases(filepath):
+  with open(filepath) as f:
+    return json.load(f)
+
+def _compile_pattern(pattern):
+  # JavaScript callers send RegExps as {"source": ..., "flags": ...}.
+  if isinstance(pattern, dict):
+    flags = 0
+    for flag in pattern.get("flags", ""):
+      flags |= _REGEXP_FLAGS.get(flag, 0)
+    return re.compile(pattern["source"], flags)
+  return re.compile(pattern)
+
+def reset_globals():
+  """Drops anything a previous case left behind in module state."""
+  asset_compiler.reset()
+  py_compiler.reset()
+  graph_trace.set_trace_collector(None)
+  graph_profile.set_profile_collector(None)
+  graph_checkpoint.stop_checkpointer()
+  graph_checkpoint.set_resume_step(0)
+  graph_summary.set_summary_writer(None)
+  graph_source.set_recording(False)
+
+  # py_funcs are only released once their graphs are gone. Importing a
+  # metagraph expects none to be left over.
+  gc.collect()
+  with script_ops._py_funcs._lock:
+    script_ops._py_funcs._funcs.clear()
+
+def _check(case, failed, text):
+  problems = []
+  if case.get("fails", False) and not failed:
+    problems.append("Test should fail")
+  if failed and not case.get("fails", False):
+    problems.append("Test shouldn't fail")
+
+  if "match" in case and not _compile_pattern(case["match"]).search(text):
+    problems.append("Output should match %s" % case["match"])
+
+  if "antimatch" in case and _compile_pattern(case["antimatch"]).search(text):
+    problems.append("Output shouldn't match %s" % case["antimatch"])
+
+  if "expect" in case and text != case["expect"]:
+    problems.append("Output should be:\n%s\nbut was:\n%s" % (case["expect"], text))
+
+  return problems
+
+def _checks_output(case):
+  return case.get("fails", False) or "match" in case or "antimatch" in case
+
+def _nao_command():
+  # A frozen build is its own interpreter.
+  if getattr(sys, "frozen", False):
+    return [sys.executable]
+  return [sys.executable, "-c", "import sys; from nao import cli; sys.exit(cli.main())"]
+
+def _run_in_process(argv, main_fn):
+  stderr = io.StringIO()
+  try:
+    with contextlib.redirect_stderr(stderr):
+      with tf.Graph().as_default():
+        main_fn(argv)
+  except (Exception, SystemExit) as e:
+    if not isinstance(e, SystemExit) or e.code:
+      return True, stderr.getvalue() + traceback.format_exc()
+  finally:
+    reset_globals()
+  return False, None
+
+def _run_in_subprocess(argv):
+  # TensorFlow writes some errors straight to fd 2, which only a separate
+  # process lets us capture.
+  env = dict(os.environ)
+  env["PYTHONPATH"] = os.pathsep.join(p for p in sys.path if p)
+  completed = subprocess.run(
+      _nao_command() + argv,
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      env=env)
+  if completed.returncode != 0:
+    return True, (completed.stderr + completed.stdout).decode('utf-8', 'replace')
+  return False, None
+
+def _write_sources(src_dir, sources):
+  if not path.exists(src_dir):
+    os.makedirs(src_dir)
+  for filename, content in sources.items():
+    filepath = path.join(src_dir, filename)
+    if not path.exists(path.dirname(filepath)):
+      os.makedirs(path.dirname(filepath))
+    with open(filepath, "w") as f:
+      f.write(content)
+
+def _export_packages(packages, tmp_dir, pkg_dir, run):
+  """Exports each of packages (name -> nao source) to a metagraph in pkg_dir.
+
+  Each is compiled in its own workspace, so importing it finds the metagraph
+  rather than its source. Returns (failed, text) like run.
+  """
+  for name, source in sorted(packages.items()):
+    workspace = path.join(tmp_dir, "export", name)
+    _write_sources(path.join(workspace, "src"), {name + ".nao": source})
+    failed, text = run([
+      name,
+      "--workspace", workspace,
+      "--output-file", path.join(pkg_dir, name + ".metagraph.pbtxt"),
+    ])
+    if failed:
+      return failed, "Couldn't export package %s:\n%s" % (name, text)
+  return False, None
+
+def run_case(case, main_fn):
+  """Runs case with main_fn(argv) in a fresh graph, returning a report entry.
+
+  Like a separate nao process, output is what --run writes (or for "export",
+  the metagraph as text), or stderr if the case fails. Cases that check what a
+  failure prints run in a separate process, so output TensorFlow writes to fd 2
+  is included. Any "packages" are exported as metagraphs for the case to import.
+  """
+  start = time.time()
+  action = case.get("action", "run")
+  if action not in _ACTION_FLAGS:
+    return {"name": case["name"], "status": "failed", "seconds": 0.0, "error": "Unknown action: %s" % action}
+
+  tmp_dir = tempfile.mkdtemp()
+  result_path = path.join(tmp_dir, "result.pbtxt")
+  argv = ["--source", case["source"], "--result", result_path] + _ACTION_FLAGS[action]
+  if action == "export":
+    result_path = path.join(tmp_dir, "output.metagraph.pbtxt")
+    argv.extend(["--output-file", result_path])
+
+  workspace = path.join(tmp_dir, "workspace")
+  if "sources" in case or "packages" in case:
+    _write_sources(path.join(workspace, "src"), case.get("sources", {}))
+    argv.extend(["--workspace", workspace])
+
+  if _checks_output(case):
+    run = _run_in_subprocess
+  else:
+    run = lambda argv: _run_in_process(argv, main_fn)
+
+  try:
+    failed, text = _export_packages(case.get("packages", {}), tmp_dir, path.join(workspace, "pkg"), run)
+    if not failed:
+      failed, text = run(argv)
+
+    if not failed:
+      text = ""
+      if path.exists(result_path):
+        with open(result_path) as f:
+          text = f.read()
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+  entry = {"name": case["name"], "seconds": time.time() - start}
+  problems = _check(case, failed, text)
+  if problems:
+    entry["status"] = "failed"
+    entry["error"] = "\n".join(problems)
+    if failed and not case.get("fails", False):
+      entry["error"] += "\n" + text
+  else:
+    entry["status"] = "passed"
+
+  eprint("%-8s %8.3fs %s" % (entry["status"], entry["seconds"], case["name"]))
+  return entry
+
+def run_suite(cases, main_fn):
+  return [run_case(case, main_fn) for case in cases]
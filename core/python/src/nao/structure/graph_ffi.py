@@ -38,6 +38,14 @@ class PythonImporter:
       py_funcs._unique_id = unique_id
       py_funcs._funcs = self._load_funcs(modules)
 
+  # Imported graphs don't clean up after their py_funcs, so we need to forget
+  # restored functions ourselves before restoring another graph's.
+  def release_py_funcs(self, py_funcs, data):
+    with py_funcs._lock:
+      for module_data in data['modules'].values():
+        for token in module_data['fn_name_by_token'].keys():
+          py_funcs._funcs.pop(token, None)
+
   def _dump_modules(self, fn_by_token_dict):
     modules = {}
     for token, fn in fn_by_token_dict.items():
@@ -1,41 +1,126 @@
+import gzip
+import io
+
 from tensorflow.core.framework import graph_pb2
 from tensorflow.core.protobuf import meta_graph_pb2
 from tensorflow.python.framework import meta_graph
 
 from google.protobuf import text_format
 
-def _write_pb(pb, file, binary):
-  if binary:
-    with open(file, "wb") as f:
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+COMPRESSIONS = ["gzip", "zstd"]
+
+# Files we write to that someone is probably reading, so they stay text.
+_STREAM_FILES = ["-", "/dev/stdout", "/dev/stderr"]
+
+def _zstandard():
+  try:
+    import zstandard
+  except ImportError:
+    raise Exception("Reading or writing zstd compressed graphs requires zstandard")
+  return zstandard
+
+def compression_for_path(file):
+  if file.endswith(".gz"):
+    return "gzip"
+  if file.endswith(".zst"):
+    return "zstd"
+  return None
+
+def binary_for_path(file):
+  """Whether to write file as binary if the caller doesn't say."""
+  if file in _STREAM_FILES:
+    return False
+  for suffix in [".gz", ".zst"]:
+    if file.endswith(suffix):
+      file = file[:-len(suffix)]
+  return not file.endswith(".pbtxt")
+
+def _decompress(data):
+  if data.startswith(_GZIP_MAGIC):
+    return gzip.decompress(data)
+
+  if data.startswith(_ZSTD_MAGIC):
+    with _zstandard().ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+      return reader.read()
+
+  return data
+
+def is_binary(data):
+  """Guesses whether data is a serialized protobuf rather than text format.
+
+  Serialized protos are full of field tags and lengths below 0x20, while text
+  format only has whitespace there.
+  """
+  for b in data[:65536]:
+    if b < 0x20 and b not in (0x09, 0x0a, 0x0b, 0x0c, 0x0d):
+      return True
+
+  try:
+    data[:65536].decode('utf-8')
+  except UnicodeDecodeError as e:
+    # Allow for a multibyte character cut off at the end.
+    return e.start < min(len(data), 65536) - 3
+  return False
+
+def _open_for_write(file, compression):
+  if file == "-":
+    return open("/dev/stdout", "wb")
+
+  if compression is None:
+    return open(file, "wb")
+
+  if compression == "gzip":
+    return gzip.open(file, "wb")
+
+  if compression == "zstd":
+    f = open(file, "wb")
+    return _zstandard().ZstdCompressor().stream_writer(f, closefd=True)
+
+  raise Exception("Unknown compression: %s. Expected one of: %s" % (compression, COMPRESSIONS))
+
+def _write_pb(pb, file, binary, compression):
+  if binary is None:
+    binary = binary_for_path(file)
+  if compression is None:
+    compression = compression_for_path(file)
+
+  with _open_for_write(file, compression) as f:
+    if binary:
       f.write(pb.SerializeToString())
-  else:
-    with open(file, "w") as f:
-      data = text_format.MessageToString(pb)
-      f.write(data)
+    else:
+      f.write(text_format.MessageToString(pb).encode('utf-8'))
 
 def _parse_pb(pb, data, binary):
+  if binary is None:
+    binary = is_binary(data)
+
   if binary:
     pb.ParseFromString(data)
   else:
+    if isinstance(data, bytes):
+      data = data.decode('utf-8')
     text_format.Merge(data, pb)
   return pb
 
 def _read_pb(pb, file, binary):
-  mode = "r"
-  if binary:
-    mode += "b"
-
-  with open(file, mode) as f:
-    return _parse_pb(pb, f.read(), binary)
+  with open(file, "rb") as f:
+    return _parse_pb(pb, _decompress(f.read()), binary)
 
-def read_graph_def(file, binary):
+def read_graph_def(file, binary=None):
   return _read_pb(graph_pb2.GraphDef(), file, binary)
 
-def write_graph_def(graph_def, file, binary):
-  _write_pb(graph_def, file, binary)
+def write_graph_def(graph_def, file, binary=None, compression=None):
+  _write_pb(graph_def, file, binary, compression)
+
+def parse_meta_graph_def(data, binary=None):
+  """Parses the contents of a file read_meta_graph_def would accept."""
+  return _parse_pb(meta_graph_pb2.MetaGraphDef(), _decompress(data), binary)
 
-def read_meta_graph_def(file, binary):
+def read_meta_graph_def(file, binary=None):
   return _read_pb(meta_graph_pb2.MetaGraphDef(), file, binary)
 
-def write_meta_graph_def(meta_graph_def, file, binary):
-  _write_pb(meta_graph_def, file, binary)
+def write_meta_graph_def(meta_graph_def, file, binary=None, compression=None):
+  _write_pb(meta_graph_def, file, binary, compression)
@@ -0,0 +1,179 @@
+from tensorflow.core.framework import graph_pb2
+from tensorflow.core.framework import variable_pb2
+from tensorflow.core.protobuf import control_flow_pb2
+from tensorflow.core.protobuf import meta_graph_pb2
+from tensorflow.core.protobuf import queue_runner_pb2
+
+from nao import log as nao_log
+from nao.structure import graph_source
+from nao.structure import graph_xform
+
+log = nao_log.get("graph")
+
+_VARIABLE_COLLECTIONS = [
+  "variables",
+  "local_variables",
+  "model_variables",
+  "trainable_variables",
+  "moving_average_variables",
+]
+
+def _op_name(tensor_name):
+  if tensor_name.startswith("^"):
+    tensor_name = tensor_name[1:]
+  return tensor_name.split(":", 1)[0]
+
+def _decode(value):
+  if isinstance(value, bytes):
+    return value.decode('utf-8')
+  return value
+
+def _parse(proto_class, value):
+  proto = proto_class()
+  proto.ParseFromString(value)
+  return proto
+
+# How to find the op that each entry of a bytes_list collection depends on.
+# Entries are kept only if that op is.
+_BYTES_COLLECTION_OPS = {
+  "while_context": lambda b: _parse(control_flow_pb2.WhileContextDef, b).pivot_name,
+  "cond_context": lambda b: _parse(control_flow_pb2.CondContextDef, b).pivot_name,
+  "queue_runners": lambda b: _parse(queue_runner_pb2.QueueRunnerDef, b).queue_name,
+  graph_source.COLLECTION: graph_source.op_name,
+  graph_xform.TRAINED_CHECKPOINT_COLLECTION: _decode,
+  graph_xform.EXTERNAL_CONSTANTS_COLLECTION: _decode,
+}
+
+def replace_nodes(graph_def, nodes):
+  """Makes nodes the only nodes in graph_def, keeping its versions and library."""
+  replaced = graph_pb2.GraphDef()
+  replaced.node.extend(nodes)
+  replaced.versions.CopyFrom(graph_def.versions)
+  replaced.library.CopyFrom(graph_def.library)
+  replaced.version = graph_def.version
+  graph_def.CopyFrom(replaced)
+
+class Pruner:
+  """Indexes a MetaGraphDef once, so it can be cut down to what some nodes need."""
+
+  def __init__(self, meta_graph_def):
+    self._meta_graph_def = meta_graph_def
+    self._nodes_by_name = {}
+    for node in meta_graph_def.graph_def.node:
+      self._nodes_by_name[node.name] = node
+
+    # Parse each variable once, whichever collections it's in.
+    self._var_defs = {}
+    collections = meta_graph_def.collection_def
+    for col_name in _VARIABLE_COLLECTIONS:
+      if col_name not in collections:
+        continue
+      for var_def_b in collections[col_name].bytes_list.value:
+        if var_def_b not in self._var_defs:
+          self._var_defs[var_def_b] = _parse(variable_pb2.VariableDef, var_def_b)
+
+  def var_initializer_names(self, var_names):
+    return [var_def.initializer_name for var_def in self._var_defs.values() if var_def.variable_name in var_names]
+
+  def reachable(self, root_names, keep=None):
+    """Returns the names of root_names and every node they depend on, added to keep."""
+    if keep is None:
+      keep = set()
+    stack = [_op_name(name) for name in root_names]
+    while stack:
+      name = stack.pop()
+      if name in keep:
+        continue
+
+      node = self._nodes_by_name.get(name)
+      if node is None:
+        raise Exception("Can't keep %s, there's no such node" % name)
+
+      keep.add(name)
+      for input_name in node.input:
+        input_op_name = _op_name(input_name)
+        if input_op_name not in keep:
+          stack.append(input_op_name)
+    return keep
+
+  def closure(self, root_names):
+    """Like reachable, but also keeps what each variable reached needs to be initialized and read."""
+    keep = set()
+    while root_names:
+      self.reachable(root_names, keep)
+      root_names = []
+      for var_def in self._var_defs.values():
+        if _op_name(var_def.variable_name) not in keep:
+          continue
+        for name in [var_def.initializer_name, var_def.snapshot_name]:
+          if name and _op_name(name) not in keep:
+            root_names.append(name)
+    return keep
+
+  def _prune_collection(self, col_name, col_def, keep):
+    kind = col_def.WhichOneof("kind")
+    if kind == "node_list":
+      values = col_def.node_list.value
+      kept = [v for v in values if _op_name(v) in keep]
+    elif kind == "bytes_list" and col_name in _VARIABLE_COLLECTIONS:
+      values = col_def.bytes_list.value
+      kept = [v for v in values if _op_name(self._var_defs[v].variable_name) in keep]
+    elif kind == "bytes_list" and col_name in _BYTES_COLLECTION_OPS:
+      values = col_def.bytes_list.value
+      op_name_fn = _BYTES_COLLECTION_OPS[col_name]
+      kept = [v for v in values if _op_name(op_name_fn(v)) in keep]
+    else:
+      return False
+
+    if len(kept) != len(values):
+      del values[:]
+      values.extend(kept)
+    return True
+
+  def prune(self, keep):
+    """Removes every node not in keep, along with collection entries that refer to them."""
+    meta_graph_def = self._meta_graph_def
+    graph_def = meta_graph_def.graph_def
+
+    replace_nodes(graph_def, [node for node in graph_def.node if node.name in keep])
+
+    for col_name, col_def in meta_graph_def.collection_def.items():
+      self._prune_collection(col_name, col_def, keep)
+
+    self._nodes_by_name = {}
+    for node in graph_def.node:
+      self._nodes_by_name[node.name] = node
+
+  def extract(self, keep, unprunable_collections=True):
+    """Returns a new MetaGraphDef with only the nodes in keep and the collection entries that refer to them.
+
+    Collections we can't tell the nodes of are copied whole, unless
+    unprunable_collections is False.
+    """
+    extracted = meta_graph_pb2.MetaGraphDef()
+    extracted.meta_info_def.CopyFrom(self._meta_graph_def.meta_info_def)
+
+    graph_def = self._meta_graph_def.graph_def
+    extracted.graph_def.versions.CopyFrom(graph_def.versions)
+    extracted.graph_def.library.CopyFrom(graph_def.library)
+    extracted.graph_def.node.extend([node for node in graph_def.node if node.name in keep])
+
+    for col_name, col_def in self._meta_graph_def.collection_def.items():
+      extracted_col_def = extracted.collection_def[col_name]
+      extracted_col_def.CopyFrom(col_def)
+      if not self._prune_collection(col_name, extracted_col_def, keep) and not unprunable_collections:
+        del extracted.collection_def[col_name]
+    return extracted
+
+def strip_meta_graph(meta_graph_def, node_names, var_names):
+  """Keeps only node_names, the initializers of var_names and what they depend on."""
+  bytes_before = meta_graph_def.ByteSize()
+  nodes_before = len(meta_graph_def.graph_def.node)
+
+  pruner = Pruner(meta_graph_def)
+  keep = pruner.reachable(list(node_names) + pruner.var_initializer_names(var_names))
+  pruner.prune(keep)
+
+  bytes_after = meta_graph_def.ByteSize()
+  log.info("Stripped %d of %d nodes, saving %d of %d bytes",
+      nodes_before - len(keep), nodes_before, bytes_before - bytes_after, bytes_before)
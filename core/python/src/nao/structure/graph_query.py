@@ -1,3 +1,8 @@
+import re
+import sre_constants
+import sre_parse
+import weakref
+
 def find_variables_by_name(var_collection, var_names):
   vars_by_name = {}
   for var in var_collection:
@@ -5,16 +10,199 @@ def find_variables_by_name(var_collection, var_names):
 
   return [vars_by_name[var_name] for var_name in var_names]
 
+# Past this many alternatives, scanning beats walking the trie.
+_MAX_LITERAL_PREFIXES = 64
+
+def _literal_prefixes(parsed):
+  """Returns (prefixes, complete) for parsed regex items.
+
+  Every string the items match starts with one of prefixes. complete is True
+  if the items match exactly those prefixes.
+  """
+  prefixes = [""]
+  for op, av in parsed:
+    if op == sre_constants.AT and av == sre_constants.AT_BEGINNING:
+      continue
+
+    if op == sre_constants.LITERAL:
+      prefixes = [p + chr(av) for p in prefixes]
+      continue
+
+    if op == sre_constants.SUBPATTERN:
+      alternatives = [av[-1]]
+    elif op == sre_constants.BRANCH:
+      alternatives = av[1]
+    elif op == sre_constants.IN and all(in_op == sre_constants.LITERAL for in_op, _ in av):
+      # The parser turns alternatives like a/x|a/y into a/[xy].
+      alternatives = [[item] for item in av]
+    else:
+      return prefixes, False
+
+    suffixes = []
+    complete = True
+    for alternative in alternatives:
+      alternative_suffixes, alternative_complete = _literal_prefixes(alternative)
+      suffixes.extend(alternative_suffixes)
+      complete = complete and alternative_complete
+
+    if len(prefixes) * len(suffixes) > _MAX_LITERAL_PREFIXES:
+      return prefixes, False
+
+    prefixes = [p + s for p in prefixes for s in suffixes]
+    if not complete:
+      return prefixes, False
+
+  return prefixes, True
+
+def literal_prefixes(pattern):
+  """Returns strings that anything pattern.match accepts must start with."""
+  if pattern.flags & re.IGNORECASE:
+    return [""]
+
+  try:
+    prefixes, _ = _literal_prefixes(sre_parse.parse(pattern.pattern, pattern.flags))
+  except Exception:
+    return [""]
+
+  # Drop any prefix that's covered by a shorter one.
+  prefixes = sorted(set(prefixes))
+  covering = []
+  for prefix in prefixes:
+    if not covering or not prefix.startswith(covering[-1]):
+      covering.append(prefix)
+  return covering
+
+class NameIndex:
+  """A trie of /-separated names, for finding names by prefix without a scan.
+
+  Items are returned in the order they were added.
+  """
+
+  def __init__(self):
+    self._root = ({}, [])
+    self._seq = 0
+    self._count = 0
+
+  def __len__(self):
+    return self._count
+
+  def add(self, name, item=None):
+    node = self._root
+    for component in name.split("/"):
+      children = node[0]
+      if component not in children:
+        children[component] = ({}, [])
+      node = children[component]
+
+    node[1].append((self._seq, name, item))
+    self._seq += 1
+    self._count += 1
+
+  def _walk(self, components):
+    node = self._root
+    for component in components:
+      node = node[0].get(component)
+      if node is None:
+        return None
+    return node
+
+  def _collect(self, node, into):
+    stack = [node]
+    while stack:
+      children, entries = stack.pop()
+      into.extend(entries)
+      stack.extend(children.values())
+
+  def _entries_with_prefix(self, prefix, into):
+    components = prefix.split("/")
+    node = self._walk(components[:-1])
+    if node is None:
+      return
+
+    partial = components[-1]
+    for component, child in node[0].items():
+      if component.startswith(partial):
+        self._collect(child, into)
+
+  def items_with_prefix(self, prefixes):
+    """Returns [(name, item)] for every name starting with one of prefixes."""
+    entries = []
+    for prefix in prefixes:
+      self._entries_with_prefix(prefix, entries)
+    entries.sort(key=lambda entry: entry[0])
+    return [(name, item) for _, name, item in entries]
+
+  def match(self, pattern):
+    """Returns [(name, item, match)] for every name that pattern matches."""
+    matches = []
+    for name, item in self.items_with_prefix(literal_prefixes(pattern)):
+      m = pattern.match(name)
+      if m:
+        matches.append((name, item, m))
+    return matches
+
+  def nearest(self, prefix, limit=10):
+    """Returns the deepest scope along prefix that exists, and a few names under it."""
+    components = prefix.split("/")
+    node = self._root
+    depth = 0
+    for component in components[:-1]:
+      child = node[0].get(component)
+      if child is None:
+        break
+      node = child
+      depth += 1
+
+    scope = "/".join(components[:depth])
+    children = sorted(node[0].keys())
+    if scope:
+      children = ["%s/%s" % (scope, child) for child in children]
+    return scope, children[:limit], len(children)
+
+def index_names(names):
+  index = NameIndex()
+  for name in names:
+    index.add(name)
+  return index
+
+def index_graph_def(graph_def):
+  index = NameIndex()
+  for node in graph_def.node:
+    index.add(node.name, node)
+  return index
+
+# Indexes are kept per graph and brought up to date with any ops added since.
+_graph_indexes = weakref.WeakKeyDictionary()
+
+def graph_index(graph):
+  if graph in _graph_indexes:
+    index, version = _graph_indexes[graph]
+  else:
+    index, version = NameIndex(), 0
+
+  if graph.version > version:
+    for op_id in range(version + 1, graph.version + 1):
+      op = graph._nodes_by_id.get(op_id)
+      if op is not None:
+        index.add(op.name, op)
+    _graph_indexes[graph] = (index, graph.version)
+
+  return index
+
+def no_match_message(index, pattern):
+  prefix = literal_prefixes(pattern)[0]
+  scope, names, total = index.nearest(prefix)
+  message = "No nodes match pattern %s. Considered %d nodes" % (pattern.pattern, len(index))
+  if names:
+    message += "; %s has %d children, e.g. %s" % (scope or "the root scope", total, names)
+  return message
+
 def find_nodes_with_pattern(graph, pattern):
-  node_matches = []
-  for n in graph.get_operations():
-    m = pattern.match(n.name)
-    if m:
-      node_matches.append((n, m))
+  index = graph_index(graph)
+  node_matches = [(n, m) for _, n, m in index.match(pattern)]
 
   if len(node_matches) == 0:
-    raise Exception(
-        "No nodes match pattern %s. Considered: %s" % (pattern, [n.name for n in graph.get_operations()]))
+    raise Exception(no_match_message(index, pattern))
 
   return node_matches
 
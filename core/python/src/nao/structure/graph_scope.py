@@ -0,0 +1,44 @@
+import re
+
+# Every function application gets its own name scope, named "q___<fn>" for the
+# first call and "q___<fn>___<n>" for subsequent ones. Exported functions live
+# under "<Pkg>/<Fn>/_/...".
+FUNCTION_SCOPE_PREFIX = "q___"
+APPLICATION_SEPARATOR = "___"
+EXPORT_SCOPE_SEPARATOR = "_"
+
+# Not TensorFlow's own "_<n>", which we can't tell apart from names like conv_2.
+_APPLICATION_SUFFIX_RE = re.compile(r"%s\d+$" % APPLICATION_SEPARATOR)
+
+def function_scope(graph, fn_name):
+  """Returns an unused scope name for applying fn_name in graph's current name scope."""
+  base = FUNCTION_SCOPE_PREFIX + fn_name
+  scope = base
+  n = 0
+  while graph.unique_name(scope, mark_as_used=False).split("/")[-1] != scope:
+    n += 1
+    scope = "%s%s%d" % (base, APPLICATION_SEPARATOR, n)
+  return scope
+
+def function_name(scope_component):
+  name = scope_component[len(FUNCTION_SCOPE_PREFIX):]
+  return _APPLICATION_SUFFIX_RE.sub("", name)
+
+def function_scopes(op_name):
+  """Returns a list of (scope, function_name) pairs, outermost first."""
+
+  # Ignore output suffixes like "Add:0" and GPU stream annotations like "Add:Add".
+  op_name = op_name.split(":", 1)[0]
+  parts = op_name.split("/")
+
+  scopes = []
+  for ix, part in enumerate(parts[:-1]):
+    if ix > 0 and part == EXPORT_SCOPE_SEPARATOR and not scopes:
+      scopes.append(("/".join(parts[:ix]), "/".join(parts[:ix])))
+    elif part.startswith(FUNCTION_SCOPE_PREFIX):
+      scopes.append(("/".join(parts[:ix + 1]), function_name(part)))
+
+  return scopes
+
+def function_stack(op_name):
+  return [name for _, name in function_scopes(op_name)]
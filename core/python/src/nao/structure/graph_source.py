@@ -0,0 +1,53 @@
+import json
+
+# Each entry in this collection is a JSON list of [op_name, file, line, column].
+COLLECTION = "source_positions"
+
+POSITION_KEY = "__pos"
+
+# Only the profiler reads positions, so we don't record them unless asked.
+_recording = False
+
+def set_recording(recording):
+  global _recording
+  _recording = recording
+
+def get_recording():
+  return _recording
+
+def pop_position(expr):
+  """Removes and returns the source position parse.js attached to expr, if any."""
+  if len(expr) > 1 and isinstance(expr[-1], dict) and POSITION_KEY in expr[-1]:
+    return expr[:-1], expr[-1][POSITION_KEY]
+  return expr, None
+
+def record(graph, ops, position):
+  filename, line, column = position
+  for op in ops:
+    graph.add_to_collection(COLLECTION, json.dumps([op.name, filename, line, column]))
+
+def _decode(value):
+  if isinstance(value, bytes):
+    value = value.decode('utf-8')
+  return json.loads(value)
+
+def op_name(value):
+  return _decode(value)[0]
+
+def load(graph):
+  positions = {}
+  for value in graph.get_collection(COLLECTION):
+    op_name, filename, line, column = _decode(value)
+    positions[op_name] = (filename, line, column)
+  return positions
+
+def prefix_meta_graph_def(meta_graph_def, import_scope):
+  """Prefixes op names in meta_graph_def's positions, for import with import_scope."""
+  col_defs = meta_graph_def.collection_def
+  if COLLECTION not in col_defs:
+    return
+
+  values = col_defs[COLLECTION].bytes_list.value
+  for ix in range(0, len(values)):
+    op_name, filename, line, column = _decode(values[ix])
+    values[ix] = json.dumps(["%s/%s" % (import_scope, op_name), filename, line, column]).encode('utf-8')
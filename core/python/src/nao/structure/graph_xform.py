@@ -1,41 +1,21 @@
+import os
 import sys
 
+from os import path
+
+import numpy as np
 import tensorflow as tf
 
-from tensorflow.core.framework import variable_pb2
-from tensorflow.core.protobuf import control_flow_pb2
-from tensorflow.python.framework import graph_util
+from tensorflow.core.framework import node_def_pb2
+from tensorflow.python.ops import io_ops
+
+from nao import log as nao_log
+from nao.structure import tensor_io
 
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
+log = nao_log.get("graph")
 
 def constants_as_dict(constants):
-  d = {}
-  for node in constants:
-    name = node.name
-    tensor = node.attr['value'].tensor
-    value = None
-    dtype = tensor.dtype
-    if dtype == tf.bool:
-      value = tensor.bool_val
-    elif dtype == tf.float16:
-      value = tensor.half_val
-    elif dtype == tf.float32:
-      value = tensor.float_val
-    if dtype == tf.float64:
-      value = tensor.double_val
-    elif dtype == tf.complex64:
-      value = tensor.scomplex_val
-    elif dtype == tf.complex128:
-      value = tensor.dcomplex_val
-    elif dtype == tf.int64:
-      value = tensor.int64_val
-    elif dtype == tf.string:
-      value = tensor.string_val
-
-    d[name] = value
-
-  return d
+  return tensor_io.constants_as_dict(constants)
 
 def dict_as_graph_def(constants_dict):
   with tf.Graph().as_default() as g:
@@ -44,49 +24,522 @@ def dict_as_graph_def(constants_dict):
 
     return g.as_graph_def()
 
+TRAINED_CHECKPOINT_COLLECTION = "trained_checkpoint"
+
 def replace_variable_initializers_with_current_values(graph, vars, value_suffix):
   with graph.as_default():
-    for var in vars:
+    # Fetch every value in one run, rather than one run per variable.
+    var_values = tf.get_default_session().run([var.value() for var in vars])
+    for var, var_value in zip(vars, var_values):
       var_op_name = var.op.name
-      var_value = var.value().eval()
       var_init_op = tf.assign(
         var,
         tf.constant(var_value, name="%s/%s" % (var_op_name, value_suffix)),
         name="%s/Assign%s" % (var_op_name, value_suffix)).op
       var._initializer_op = var_init_op
-      eprint("Resetting initializer for var", var)
+      log.debug("Resetting initializer for var %s", var)
+
+def replace_variable_initializers_with_checkpoint(session, vars, checkpoint_prefix, value_suffix):
+  """Saves vars to checkpoint_prefix and makes their initializers restore from it.
+
+  All vars are saved and restored with a single op. The checkpoint path is a
+  placeholder with a default, listed in the trained_checkpoint collection, so
+  it can be fed if the checkpoint moves.
+  """
+  graph = session.graph
+  if not vars:
+    return
+
+  checkpoint_dir = path.dirname(checkpoint_prefix)
+  if checkpoint_dir and not path.exists(checkpoint_dir):
+    os.makedirs(checkpoint_dir)
+
+  with graph.as_default():
+    with tf.name_scope(None):
+      saver = tf.train.Saver(var_list=vars, name="%sSaver" % value_suffix)
+      saver.save(session, checkpoint_prefix, write_meta_graph=False)
+      log.info("Saved %d trained variables to %s", len(vars), checkpoint_prefix)
+
+      with tf.control_dependencies(None):
+        checkpoint_path = tf.placeholder_with_default(
+            path.abspath(checkpoint_prefix),
+            [],
+            name="%sCheckpoint" % value_suffix)
+        graph.add_to_collection(TRAINED_CHECKPOINT_COLLECTION, checkpoint_path.op.name)
+
+        var_names = [var.op.name for var in vars]
+        restored = io_ops.restore_v2(
+            checkpoint_path,
+            var_names,
+            [""] * len(vars),
+            [var.dtype.base_dtype for var in vars],
+            name="%sRestore" % value_suffix)
+
+    for var, var_value in zip(vars, restored):
+      var_value.set_shape(var.get_shape())
+      var_op_name = var.op.name
+      var._initializer_op = tf.assign(
+        var,
+        var_value,
+        name="%s/Assign%s" % (var_op_name, value_suffix)).op
+      log.debug("Resetting initializer for var %s", var)
+
+def _relocated_path_feeds(graph, collection, search_dir, exists_suffix):
+  feed_dict = {}
+  for name in graph.get_collection(collection):
+    if isinstance(name, bytes):
+      name = name.decode('utf-8')
+    placeholder = graph.get_operation_by_name(name)
+    default_path = tf.make_ndarray(placeholder.inputs[0].op.get_attr("value")).item()
+    if isinstance(default_path, bytes):
+      default_path = default_path.decode('utf-8')
+
+    local_path = path.join(search_dir, path.basename(default_path))
+    if path.exists(local_path + exists_suffix):
+      feed_dict[placeholder.outputs[0]] = local_path
+
+  return feed_dict
+
+def relocated_file_feeds(graph, search_dir):
+  """Finds trained checkpoints and constant sidecars in search_dir for graph's placeholders.
+
+  This lets an exported graph and the files it refers to be moved together.
+  Initializers read these files, so feed them when initializing.
+  """
+  feed_dict = _relocated_path_feeds(graph, TRAINED_CHECKPOINT_COLLECTION, search_dir, ".index")
+  feed_dict.update(_relocated_path_feeds(graph, EXTERNAL_CONSTANTS_COLLECTION, search_dir, ""))
+  return feed_dict
+
+EXTERNAL_CONSTANTS_COLLECTION = "external_constants"
+
+_EXTERNAL_CONSTANTS_ALIGNMENT = 64
+
+# The dtypes decode_raw can produce.
+_EXTERNAL_CONSTANT_DTYPES = set([
+  tf.float16, tf.float32, tf.float64,
+  tf.uint8, tf.int8, tf.int16, tf.int32, tf.int64,
+])
+
+def externalize_constants(meta_graph_def, sidecar_path, min_bytes):
+  """Moves Consts of at least min_bytes out of meta_graph_def into sidecar_path.
+
+  Each one's bytes are written to the sidecar at a 64 byte aligned offset. Its
+  Const becomes an Identity of an untrainable variable of the same name plus
+  "/external". That variable's initializer slices the value out of the sidecar
+  with read_file and decode_raw, so nothing needs to be fed. Like trained
+  checkpoints, the sidecar path is a placeholder with a default, so it can be
+  fed if the files move. Returns how many bytes were moved.
+  """
+  graph_def = meta_graph_def.graph_def
+  externalized = []
+  for node in graph_def.node:
+    if node.op != "Const":
+      continue
+    tensor = node.attr["value"].tensor
+    if tf.as_dtype(tensor.dtype) not in _EXTERNAL_CONSTANT_DTYPES or tensor.ByteSize() < min_bytes:
+      continue
+    externalized.append((node.name, tensor_io.tensor_proto_to_ndarray(tensor)))
+
+  if not externalized:
+    return 0
+
+  sidecar_dir = path.dirname(sidecar_path)
+  if sidecar_dir and not path.exists(sidecar_dir):
+    os.makedirs(sidecar_dir)
+
+  offsets = []
+  with open(sidecar_path, "wb") as f:
+    for name, value in externalized:
+      f.write(b"\0" * (-f.tell() % _EXTERNAL_CONSTANTS_ALIGNMENT))
+      offsets.append(f.tell())
+      f.write(np.ascontiguousarray(value, dtype=value.dtype.newbyteorder('<')).data)
+
+  with tf.Graph().as_default() as g:
+    sidecar = tf.placeholder_with_default(path.abspath(sidecar_path), [], name="ExternalConstants")
+    contents = tf.read_file(sidecar, name="ExternalConstants/read_file")
+
+    var_defs = []
+    for (name, value), offset in zip(externalized, offsets):
+      with tf.name_scope("%s/external_value/" % name):
+        raw = tf.substr(contents, offset, value.nbytes)
+        decoded = tf.reshape(tf.decode_raw(raw, tf.as_dtype(value.dtype)), value.shape)
+      var = tf.Variable(decoded, trainable=False, collections=[], name="%s/external" % name)
+      if tf.identity(var, name=name).op.name != name:
+        raise Exception("Couldn't externalize constant %s, its name is taken" % name)
+      var_defs.append(var.to_proto().SerializeToString())
+
+    external_graph_def = g.as_graph_def()
+
+  externalized_names = set(name for name, _ in externalized)
+  replaced = dict((node.name, node) for node in graph_def.node if node.name in externalized_names)
+  nodes = [node for node in graph_def.node if node.name not in externalized_names]
+  existing_names = set(node.name for node in nodes)
+  for node in external_graph_def.node:
+    if node.name in existing_names:
+      raise Exception("Couldn't externalize constants, there's already a node named %s" % node.name)
+    # A Const's only inputs are control inputs, which the Identity must keep.
+    if node.name in replaced:
+      node.input.extend(replaced[node.name].input)
+      node.device = replaced[node.name].device
+
+  from nao.structure import graph_prune
+  graph_prune.replace_nodes(graph_def, nodes + list(external_graph_def.node))
 
-def strip_meta_graph(meta_graph_def, node_names, var_names):
-  node_names = node_names[:]
   collections = meta_graph_def.collection_def
+  collections["variables"].bytes_list.value.extend(var_defs)
+  collections[EXTERNAL_CONSTANTS_COLLECTION].bytes_list.value.append(b"ExternalConstants")
+
+  moved_bytes = sum(value.nbytes for _, value in externalized)
+  log.info("Moved %d constants (%d bytes) to %s", len(externalized), moved_bytes, sidecar_path)
+  return moved_bytes
+
+def strip_meta_graph(meta_graph_def, node_names, var_names):
+  # graph_prune needs the collection names from here.
+  from nao.structure import graph_prune
+  graph_prune.strip_meta_graph(meta_graph_def, node_names, var_names)
+
+# Ops that only record what happened, so inference doesn't need them.
+_LOGGING_OPS = set([
+  "AudioSummary",
+  "AudioSummaryV2",
+  "HistogramSummary",
+  "ImageSummary",
+  "MergeSummary",
+  "Print",
+  "ScalarSummary",
+  "TensorSummary",
+])
+
+_PY_FUNC_OPS = set(["PyFunc", "PyFuncStateless"])
+
+# Stateless ops whose value still isn't fixed when the graph is built.
+_UNFOLDABLE_OPS = set([
+  "Enter",
+  "Exit",
+  "LoopCond",
+  "Merge",
+  "NextIteration",
+  "Placeholder",
+  "PlaceholderV2",
+  "PlaceholderWithDefault",
+  "Switch",
+]) | _PY_FUNC_OPS | _LOGGING_OPS
+
+def _input_op_name(input_name):
+  if input_name.startswith("^"):
+    input_name = input_name[1:]
+  return input_name.split(":", 1)[0]
+
+def _reachable(nodes_by_name, root_names, follow_control=True):
+  reachable = set()
+  stack = list(root_names)
+  while stack:
+    name = stack.pop()
+    if name in reachable:
+      continue
+    reachable.add(name)
+    for input_name in nodes_by_name[name].input:
+      if follow_control or not input_name.startswith("^"):
+        stack.append(_input_op_name(input_name))
+  return reachable
+
+def strip_logging(graph_def, output_node_names):
+  """Drops control dependencies on summaries, prints and py_funcs whose values aren't used.
+
+  Returns how many were dropped. Nodes left unreachable are removed later.
+  """
+  nodes_by_name = dict((node.name, node) for node in graph_def.node)
+  data_needed = _reachable(nodes_by_name, output_node_names, follow_control=False)
+
+  def is_logging(name):
+    op = nodes_by_name[name].op
+    return op in _LOGGING_OPS or (op in _PY_FUNC_OPS and name not in data_needed)
 
-  # Look for matching variable names and initializers and keep them too.
-  var_def = variable_pb2.VariableDef()
-  for var_col_name in ["variables", "trainable_variables"]:
-    var_def_bs = collections[var_col_name].bytes_list.value
-    for var_def_b in var_def_bs:
-      var_def.ParseFromString(var_def_b)
-      if var_def.variable_name not in var_names:
-        # TODO(adamb) Should remove variable from collection.
+  dropped = 0
+  for node in graph_def.node:
+    inputs = [i for i in node.input if not (i.startswith("^") and is_logging(i[1:]))]
+    if len(inputs) != len(node.input):
+      dropped += len(node.input) - len(inputs)
+      del node.input[:]
+      node.input.extend(inputs)
+  return dropped
+
+def fold_constants(graph_def, output_node_names, max_bytes=1024 * 1024):
+  """Replaces stateless subgraphs that only depend on constants with their values.
+
+  Values larger than max_bytes are left to be computed, so the graph doesn't
+  grow. Returns how many nodes were replaced.
+  """
+  from tensorflow.python.framework import op_def_registry
+  registered_ops = op_def_registry.get_registered_ops()
+
+  nodes_by_name = dict((node.name, node) for node in graph_def.node)
+
+  # We can only swap a node for a single Const if nothing uses its other outputs.
+  multi_output = set()
+  for node in graph_def.node:
+    for input_name in node.input:
+      if not input_name.startswith("^") and ":" in input_name and not input_name.endswith(":0"):
+        multi_output.add(_input_op_name(input_name))
+
+  foldable = {}
+  def is_foldable(root_name):
+    # Visit inputs before the nodes that use them, without recursing.
+    stack = [(root_name, False)]
+    while stack:
+      name, inputs_visited = stack.pop()
+      if name in foldable:
         continue
-      node_names.append(var_def.initializer_name)
-
-  wc_def = control_flow_pb2.WhileContextDef()
-  wc_values = collections["while_context"].bytes_list.value
-  for wc_ix in range(len(wc_values) - 1, -1, -1):
-    wc_bytes = wc_values[wc_ix]
-    wc_def.ParseFromString(wc_bytes)
-    unused = True
-    wc_pivot_name = wc_def.pivot_name
-    for name in node_names:
-      if name.startswith(wc_pivot_name):
-        unused = False
-        break
-
-    if unused:
-      del wc_values[wc_ix]
 
-  graph_def = meta_graph_def.graph_def
-  eprint("only keeping", node_names, "from", [n.name for n in graph_def.node])
-  graph_def = graph_util.extract_sub_graph(graph_def, node_names)
-  meta_graph_def.graph_def.CopyFrom(graph_def)
+      node = nodes_by_name[name]
+      if inputs_visited:
+        # Inputs still being visited are part of a cycle, so aren't foldable.
+        foldable[name] = all(foldable.get(_input_op_name(i), False) for i in node.input)
+        continue
+
+      op_def = registered_ops.get(node.op)
+      if (node.op in _UNFOLDABLE_OPS or name in multi_output or
+          op_def is None or op_def.is_stateful):
+        foldable[name] = False
+        continue
+
+      stack.append((name, True))
+      for input_name in node.input:
+        if _input_op_name(input_name) not in foldable:
+          stack.append((_input_op_name(input_name), False))
+    return foldable[root_name]
+
+  # Fold the outermost foldable nodes, i.e. those used by something unfoldable.
+  frontier = set(name for name in output_node_names if is_foldable(name))
+  for node in graph_def.node:
+    if is_foldable(node.name):
+      continue
+    for input_name in node.input:
+      input_op_name = _input_op_name(input_name)
+      if not input_name.startswith("^") and is_foldable(input_op_name):
+        frontier.add(input_op_name)
+  frontier = sorted(name for name in frontier if nodes_by_name[name].op != "Const")
+  if not frontier:
+    return 0
+
+  subgraph_def = tf.GraphDef()
+  subgraph_def.node.extend([node for node in graph_def.node if foldable.get(node.name)])
+  for node in subgraph_def.node:
+    # Evaluate wherever we can, and don't look for colocated ops we left out.
+    node.device = ""
+    if "_class" in node.attr:
+      del node.attr["_class"]
+  with tf.Graph().as_default() as g:
+    tf.import_graph_def(subgraph_def, name="")
+
+    # Only evaluate what we know will be small enough to keep.
+    def small_enough(name):
+      tensor = g.get_tensor_by_name("%s:0" % name)
+      shape = tensor.get_shape()
+      if tensor.dtype == tf.string or not shape.is_fully_defined():
+        return False
+      return shape.num_elements() * tensor.dtype.size <= max_bytes
+    frontier = [name for name in frontier if small_enough(name)]
+    if not frontier:
+      return 0
+
+    with tf.Session(graph=g) as sess:
+      values = sess.run(["%s:0" % name for name in frontier])
+
+  folded = 0
+  for name, value in zip(frontier, values):
+    value = np.asarray(value)
+    node = nodes_by_name[name]
+    _set_const(node, name, value, node.device)
+    folded += 1
+  return folded
+
+def _set_const(node, name, value, device):
+  tensor = tf.make_tensor_proto(value)
+  # A Const can still wait on other nodes.
+  control_inputs = [input_name for input_name in node.input if input_name.startswith("^")]
+  node.Clear()
+  node.name = name
+  node.input.extend(control_inputs)
+  node.op = "Const"
+  node.device = device
+  node.attr["dtype"].type = tensor.dtype
+  node.attr["value"].tensor.CopyFrom(tensor)
+
+def collapse_identities(graph_def, output_node_names):
+  """Points the data users of each Identity at its input instead. Returns how many were bypassed."""
+  nodes_by_name = dict((node.name, node) for node in graph_def.node)
+
+  # Control edges out of an Identity of a Switch only fire on the branch it's
+  # on, so any Identity used as a control input stays.
+  keep = set(output_node_names)
+  for node in graph_def.node:
+    for input_name in node.input:
+      if input_name.startswith("^"):
+        keep.add(input_name[1:])
+
+  forwards = {}
+  for node in graph_def.node:
+    if node.op != "Identity" or node.name in keep:
+      continue
+    # An Identity with control inputs orders things, and one of a ref makes a
+    # snapshot, so those stay.
+    if len(node.input) != 1 or node.input[0].startswith("^"):
+      continue
+    if node.attr["T"].type >= 100:
+      continue
+    # Identities of a Switch are cond and while pivots.
+    input_node = nodes_by_name.get(_input_op_name(node.input[0]))
+    if input_node is None or input_node.op in ("Switch", "RefSwitch"):
+      continue
+    forwards[node.name] = node.input[0]
+
+  def resolve(input_name):
+    name = input_name
+    seen = set()
+    while True:
+      op_name = _input_op_name(name)
+      if op_name not in forwards or op_name in seen or (":" in name and not name.endswith(":0")):
+        return name
+      seen.add(op_name)
+      name = forwards[op_name]
+
+  for node in graph_def.node:
+    inputs = [input_name if input_name.startswith("^") else resolve(input_name) for input_name in node.input]
+    if inputs != list(node.input):
+      del node.input[:]
+      node.input.extend(inputs)
+  return len(forwards)
+
+def prune_to_outputs(graph_def, output_node_names):
+  """Removes every node that output_node_names don't depend on."""
+  from nao.structure import graph_prune
+
+  keep = _reachable(dict((node.name, node) for node in graph_def.node), output_node_names)
+  graph_prune.replace_nodes(graph_def, [node for node in graph_def.node if node.name in keep])
+
+def freeze_graph(session, output_node_names):
+  """Returns a GraphDef of session's graph with only what output_node_names need for inference.
+
+  Variables become constants with their current values. Logging that the
+  outputs don't use is dropped, constant subgraphs are folded and identities
+  are collapsed. Returns the frozen GraphDef and a dict describing what changed.
+  """
+  from tensorflow.python.framework import graph_util
+
+  graph_def = session.graph.as_graph_def()
+  report = {
+    "nodes_before": len(graph_def.node),
+    "bytes_before": graph_def.ByteSize(),
+  }
+
+  graph_def = graph_util.convert_variables_to_constants(session, graph_def, output_node_names)
+  report["logging_dropped"] = strip_logging(graph_def, output_node_names)
+  # Don't bother folding logging we just cut off.
+  prune_to_outputs(graph_def, output_node_names)
+  report["folded"] = fold_constants(graph_def, output_node_names)
+  report["identities_collapsed"] = collapse_identities(graph_def, output_node_names)
+  prune_to_outputs(graph_def, output_node_names)
+
+  report["nodes_after"] = len(graph_def.node)
+  report["bytes_after"] = graph_def.ByteSize()
+  return graph_def, report
+
+# Fetching these without queue runners started blocks forever.
+_INPUT_QUEUE_OPS = set([
+  "QueueDequeue", "QueueDequeueV2",
+  "QueueDequeueMany", "QueueDequeueManyV2",
+  "QueueDequeueUpTo", "QueueDequeueUpToV2",
+  "ReaderRead", "ReaderReadV2",
+  "ReaderReadUpTo", "ReaderReadUpToV2",
+])
+
+def _outputs_depending_on(graph_def, output_node_names, ops):
+  nodes_by_name = dict((node.name, node) for node in graph_def.node)
+  depending = []
+  for name in output_node_names:
+    reachable = _reachable(nodes_by_name, [name])
+    if any(nodes_by_name[r].op in ops for r in reachable):
+      depending.append(name)
+  return depending
+
+def queue_dependent_outputs(graph_def, output_node_names):
+  """Returns the output_node_names that read from an input queue or reader."""
+  return _outputs_depending_on(graph_def, output_node_names, _INPUT_QUEUE_OPS)
+
+def runnable_outputs(graph_def, output_node_names):
+  """Returns the output_node_names that need neither feeds nor queue runners."""
+  blocked = set(_outputs_depending_on(
+      graph_def, output_node_names, _INPUT_QUEUE_OPS | set(["Placeholder", "PlaceholderV2"])))
+  return [name for name in output_node_names if name not in blocked]
+
+QUANTIZE_MODES = ["per-tensor", "per-channel"]
+
+def _quantize(value, mode):
+  """Returns uint8 levels, a scale and an offset such that levels * scale + offset ~ value."""
+  if mode == "per-tensor":
+    lo, hi = value.min(), value.max()
+  elif mode == "per-channel":
+    # Channels are the last axis, i.e. outputs for MatMul and Conv2D weights.
+    axes = tuple(range(value.ndim - 1))
+    lo, hi = value.min(axis=axes), value.max(axis=axes)
+  else:
+    raise Exception("Unknown quantize mode: %s. Expected one of: %s" % (mode, QUANTIZE_MODES))
+
+  scale = (hi - lo) / 255.0
+  # A constant channel has no range, but still needs a nonzero scale.
+  scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+  offset = np.asarray(lo, dtype=np.float32)
+  levels = np.clip(np.round((value - offset) / scale), 0, 255).astype(np.uint8)
+  return levels, scale, offset
+
+def quantize_weights(graph_def, mode, min_elements=1024):
+  """Stores float32 weights as uint8 levels with a scale and offset.
+
+  Only constants of rank 2 or more with at least min_elements elements are
+  rewritten. Each becomes a uint8 Const that's cast, scaled and offset back to
+  float32 under the original name, so the ops that use it are unchanged.
+  Returns a dict describing what changed.
+  """
+  from tensorflow.python.framework import tensor_util
+
+  report = {
+    "quantize_mode": mode,
+    "quantized": 0,
+    "quantized_bytes_before": 0,
+    "quantized_bytes_after": 0,
+  }
+  added = []
+  for node in graph_def.node:
+    if node.op != "Const" or node.attr["dtype"].type != tf.float32.as_datatype_enum:
+      continue
+
+    value = tensor_util.MakeNdarray(node.attr["value"].tensor)
+    if value.ndim < 2 or value.size < min_elements:
+      continue
+
+    name = node.name
+    device = node.device
+    levels, scale, offset = _quantize(value, mode)
+
+    _set_const(node, "%s/quantized" % name, levels, device)
+    scale_node = node_def_pb2.NodeDef()
+    _set_const(scale_node, "%s/scale" % name, scale, device)
+    offset_node = node_def_pb2.NodeDef()
+    _set_const(offset_node, "%s/offset" % name, offset, device)
+
+    cast_node = node_def_pb2.NodeDef(name="%s/dequantize" % name, op="Cast", device=device, input=[node.name])
+    cast_node.attr["SrcT"].type = tf.uint8.as_datatype_enum
+    cast_node.attr["DstT"].type = tf.float32.as_datatype_enum
+    mul_node = node_def_pb2.NodeDef(name="%s/scaled" % name, op="Mul", device=device, input=[cast_node.name, scale_node.name])
+    mul_node.attr["T"].type = tf.float32.as_datatype_enum
+    add_node = node_def_pb2.NodeDef(name=name, op="Add", device=device, input=[mul_node.name, offset_node.name])
+    add_node.attr["T"].type = tf.float32.as_datatype_enum
+    added.extend([scale_node, offset_node, cast_node, mul_node, add_node])
+
+    report["quantized"] += 1
+    report["quantized_bytes_before"] += value.nbytes
+    report["quantized_bytes_after"] += levels.nbytes + scale.nbytes + offset.nbytes
+
+  graph_def.node.extend(added)
+  return report
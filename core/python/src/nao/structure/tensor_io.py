@@ -0,0 +1,261 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import zipfile
+
+from os import path
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.python.framework import tensor_util
+
+from nao.structure import graph_io
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+
+def tensor_proto_to_ndarray(tensor):
+  """Converts a TensorProto to an ndarray, viewing tensor_content without a copy.
+
+  Arrays made from tensor_content are read-only.
+  """
+  shape = [d.size for d in tensor.tensor_shape.dim]
+  if tensor.tensor_content:
+    dtype = tf.as_dtype(tensor.dtype)
+    if dtype != tf.string and dtype.is_numpy_compatible:
+      return np.frombuffer(tensor.tensor_content, dtype=dtype.as_numpy_dtype).reshape(shape)
+
+  # Values in repeated fields need copying anyway, and MakeNdarray handles the
+  # broadcasting of a single value to the full shape.
+  return tensor_util.MakeNdarray(tensor)
+
+def constants_as_dict(constants):
+  d = {}
+  for node in constants:
+    d[node.name] = tensor_proto_to_ndarray(node.attr['value'].tensor)
+  return d
+
+def _npz_member_offset(f, info):
+  # The local file header is 30 bytes, followed by the name and extra field,
+  # which may differ from the ones in the central directory.
+  f.seek(info.header_offset)
+  header = f.read(30)
+  name_length = int.from_bytes(header[26:28], 'little')
+  extra_length = int.from_bytes(header[28:30], 'little')
+  return info.header_offset + 30 + name_length + extra_length
+
+def _mmap_npy_at(filepath, f, offset):
+  f.seek(offset)
+  version = np.lib.format.read_magic(f)
+  if version == (1, 0):
+    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+  else:
+    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+  if dtype.hasobject:
+    return None
+
+  return np.memmap(
+      filepath,
+      dtype=dtype,
+      mode='r',
+      offset=f.tell(),
+      shape=shape,
+      order='F' if fortran_order else 'C')
+
+def load_npy(filepath):
+  return np.load(filepath, mmap_mode='r')
+
+def load_npz(filepath):
+  """Loads every array in filepath, memory mapping those that are stored uncompressed."""
+  arrays = {}
+  npz = None
+  with zipfile.ZipFile(filepath) as zf, open(filepath, 'rb') as f:
+    for info in zf.infolist():
+      name = info.filename
+      if name.endswith(".npy"):
+        name = name[:-len(".npy")]
+
+      array = None
+      if info.compress_type == zipfile.ZIP_STORED:
+        array = _mmap_npy_at(filepath, f, _npz_member_offset(f, info))
+
+      if array is None:
+        if npz is None:
+          npz = np.load(filepath)
+        array = npz[name]
+
+      arrays[name] = array
+
+  if npz is not None:
+    npz.close()
+
+  return arrays
+
+_feed_cache = {}
+
+def _cache_key(filepath, binary, strip_prefix):
+  stat = os.stat(filepath)
+  h = hashlib.sha1()
+  h.update(("%s\0%s\0%s\0%s\0%s" % (path.abspath(filepath), stat.st_size, stat.st_mtime, binary, strip_prefix)).encode('utf-8'))
+  return h.hexdigest()
+
+def _load_graph_def_constants(filepath, binary, strip_prefix):
+  graph_def = graph_io.read_graph_def(filepath, binary)
+  constants = [n for n in graph_def.node if n.op == "Const" and n.name.startswith(strip_prefix)]
+  return constants_as_dict(constants)
+
+def load_feed_constants(filepath, binary=False, strip_prefix="", cache_dir=None):
+  """Returns {name: ndarray} for the constants in filepath.
+
+  filepath may be a .npy or .npz file, or a GraphDef of Const nodes. Names in a
+  GraphDef must start with strip_prefix. GraphDefs are parsed once and cached
+  as uncompressed .npz files in cache_dir, so later runs can memory map them.
+  """
+  if filepath.endswith(".npy"):
+    return {path.basename(filepath)[:-len(".npy")]: load_npy(filepath)}
+
+  if filepath.endswith(".npz"):
+    return load_npz(filepath)
+
+  key = _cache_key(filepath, binary, strip_prefix)
+  if key in _feed_cache:
+    return _feed_cache[key]
+
+  cache_path = None
+  if cache_dir:
+    cache_path = path.join(cache_dir, "%s.npz" % key)
+    if path.exists(cache_path):
+      _feed_cache[key] = load_npz(cache_path)
+      return _feed_cache[key]
+
+  constants = _load_graph_def_constants(filepath, binary, strip_prefix)
+
+  # String constants can't be saved without pickling, so don't cache them.
+  cacheable = all(not v.dtype.hasobject for v in constants.values())
+  if cache_path and cacheable:
+    if not path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    tmp_path = cache_path + ".tmp.npz"
+    # Not np.savez, since a constant named e.g. "file" would clash with its arguments.
+    writer = NpzResultWriter(tmp_path)
+    try:
+      for name, value in constants.items():
+        writer.write(name, value)
+    finally:
+      writer.close()
+    os.rename(tmp_path, cache_path)
+    constants = load_npz(cache_path)
+
+  _feed_cache[key] = constants
+  return constants
+
+def clear_feed_cache():
+  _feed_cache.clear()
+
+class NpzResultWriter:
+  """Writes each result as an uncompressed .npy member of an .npz file."""
+
+  def __init__(self, filepath):
+    self._zf = zipfile.ZipFile(filepath, "w", zipfile.ZIP_STORED, allowZip64=True)
+
+  def write(self, name, value):
+    value = np.asarray(value)
+    member = name + ".npy"
+    if sys.version_info >= (3, 6):
+      with self._zf.open(member, "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, value, allow_pickle=False)
+    else:
+      # Before Python 3.6 we can't stream into a zip member.
+      header = io.BytesIO()
+      np.lib.format.write_array(header, value, allow_pickle=False)
+      self._zf.writestr(member, header.getvalue())
+
+  def close(self):
+    self._zf.close()
+
+class TFRecordResultWriter:
+  """Writes each result as a record holding a Summary.Value with its name and TensorProto."""
+
+  def __init__(self, filepath):
+    self._writer = tf.python_io.TFRecordWriter(filepath)
+
+  def write(self, name, value):
+    record = tf.Summary.Value(tag=name)
+    record.tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+    self._writer.write(record.SerializeToString())
+
+  def close(self):
+    self._writer.close()
+
+class ArrowResultWriter:
+  """Writes results as one row of an Arrow IPC file.
+
+  Each result is a column holding a single fixed size list of its flattened
+  values. Its shape and dtype are in the field metadata.
+  """
+
+  def __init__(self, filepath):
+    try:
+      import pyarrow
+    except ImportError:
+      raise Exception("Writing Arrow results requires pyarrow")
+
+    self._pa = pyarrow
+    self._filepath = filepath
+    self._fields = []
+    self._columns = []
+
+  def write(self, name, value):
+    pa = self._pa
+    value = np.asarray(value)
+    flat = value.reshape(-1)
+    if value.dtype.hasobject:
+      values = pa.array(flat.tolist(), type=pa.binary())
+    else:
+      # Arrow wraps contiguous numeric buffers without copying.
+      values = pa.array(np.ascontiguousarray(flat))
+
+    column = pa.FixedSizeListArray.from_arrays(values, len(flat))
+    self._fields.append(pa.field(name, column.type, metadata={
+      "shape": json.dumps(list(value.shape)),
+      "dtype": str(value.dtype),
+    }))
+    self._columns.append(column)
+
+  def close(self):
+    pa = self._pa
+    schema = pa.schema(self._fields)
+    with pa.OSFile(self._filepath, "wb") as sink:
+      with pa.ipc.new_file(sink, schema) as writer:
+        writer.write_batch(pa.record_batch(self._columns, schema=schema))
+
+RESULT_FORMATS = {
+  "npz": NpzResultWriter,
+  "tfrecord": TFRecordResultWriter,
+  "arrow": ArrowResultWriter,
+}
+
+def result_format_for_path(filepath):
+  for extension, result_format in [
+      (".npz", "npz"),
+      (".tfrecord", "tfrecord"),
+      (".tfrecords", "tfrecord"),
+      (".arrow", "arrow")]:
+    if filepath.endswith(extension):
+      return result_format
+  return None
+
+def write_results(result_names, result_values, filepath, result_format):
+  if result_format not in RESULT_FORMATS:
+    raise Exception("Unknown result format: %s. Expected one of: %s" % (result_format, sorted(RESULT_FORMATS.keys())))
+
+  writer = RESULT_FORMATS[result_format](filepath)
+  try:
+    for name, value in zip(result_names, result_values):
+      writer.write(name, value)
+  finally:
+    writer.close()
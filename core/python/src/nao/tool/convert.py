@@ -0,0 +1,49 @@
+import argparse
+import sys
+
+from nao.structure import graph_io
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+
+_READERS = {
+  "metagraph": graph_io.read_meta_graph_def,
+  "graph": graph_io.read_graph_def,
+}
+
+_WRITERS = {
+  "metagraph": graph_io.write_meta_graph_def,
+  "graph": graph_io.write_graph_def,
+}
+
+def _kind_for_path(filepath):
+  if ".metagraph." in filepath:
+    return "metagraph"
+  if ".graph." in filepath:
+    return "graph"
+  return None
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog="nao convert",
+      description="""Convert a GraphDef or MetaGraphDef between text, binary and compressed forms""")
+  parser.add_argument("input", metavar='INPUT', type=str)
+  parser.add_argument("output", metavar='OUTPUT', type=str,
+                      help="""Written as text if it ends in .pbtxt, binary otherwise. Compressed if it ends in .gz or .zst""")
+  parser.add_argument("--kind", type=str, choices=sorted(_READERS.keys()),
+                      help="""What INPUT holds. Defaults to its name, e.g. foo.metagraph.pbtxt""")
+  parser.add_argument("--binary", default=None, action='store_const', const=True,
+                      help="""Write OUTPUT as binary, whatever its name""")
+  parser.add_argument("--text", dest="binary", action='store_const', const=False,
+                      help="""Write OUTPUT as text, whatever its name""")
+  parser.add_argument("--compression", type=str, choices=graph_io.COMPRESSIONS,
+                      help="""Compress OUTPUT, whatever its name""")
+
+  FLAGS = parser.parse_args(argv)
+
+  kind = FLAGS.kind or _kind_for_path(FLAGS.input) or _kind_for_path(FLAGS.output)
+  if kind is None:
+    raise Exception("Can't tell if %s is a metagraph or a graph. Use --kind." % FLAGS.input)
+
+  pb = _READERS[kind](FLAGS.input)
+  _WRITERS[kind](pb, FLAGS.output, binary=FLAGS.binary, compression=FLAGS.compression)
+  eprint("Wrote %s %s" % (kind, FLAGS.output))
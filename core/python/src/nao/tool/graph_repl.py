@@ -3,6 +3,7 @@ import sys
 import tensorflow as tf
 
 from nao.run import graph_summary
+from nao.run import graph_trace
 
 from nao.compiler.retvalbag import RetvalBag
 
@@ -22,6 +23,34 @@ class ReplSession:
     self._coord = tf.train.Coordinator()
     self._next_run_id = 0
     self._summary_writer = None
+    self._trace_collector = None
+
+  def start_trace(self, path):
+    self.stop_trace()
+    self._trace_collector = graph_trace.TraceCollector(path)
+
+  def stop_trace(self):
+    trace_collector = self._trace_collector
+    if trace_collector is None:
+      return None
+
+    self._trace_collector = None
+    trace_collector.write()
+    return trace_collector.path()
+
+  def _run_magic(self, src):
+    words = src.split()
+    if words[0] == "%trace" and len(words) == 2:
+      if words[1] == "off":
+        path = self.stop_trace()
+        if path is None:
+          return "Not tracing"
+        return "Wrote trace to %s" % path
+
+      self.start_trace(words[1])
+      return "Tracing to %s" % words[1]
+
+    raise Exception("Unknown magic: %s. Expected %%trace FILE or %%trace off" % src.strip())
 
   def _vars(self):
     with self._graph.as_default():
@@ -49,6 +78,9 @@ class ReplSession:
       self._threads.extend(threads)
 
   def run(self, src, summary_fn=None):
+    if src.lstrip().startswith("%"):
+      return self._run_magic(src)
+
     run_id = self._next_run_id
     self._next_run_id = self._next_run_id + 1
     if self._summary_writer is None:
@@ -91,13 +123,20 @@ class ReplSession:
       above = above.get(None)
 
     if isinstance(above, (tf.Tensor, tf.Variable, tf.Operation)):
+      run_options = tf.RunOptions()
+      if self._trace_collector:
+        run_options.trace_level = tf.RunOptions.FULL_TRACE
       run_metadata = tf.RunMetadata()
-      above = self._session.run(above, run_metadata=run_metadata)
+      above = self._session.run(above, options=run_options, run_metadata=run_metadata)
       summary_writer.add_run_metadata(run_metadata, "repl-%04d" % run_id, run_id)
+      if self._trace_collector:
+        self._trace_collector.add_run_metadata(run_metadata)
 
     return above
 
   def __del__(self):
+    self.stop_trace()
+
     # Shutdown threads, if any.
     if self._summary_writer is not None:
       self._summary_writer.close()
@@ -0,0 +1,278 @@
+import json
+import queue
+import re
+import socketserver
+import sys
+import threading
+import time
+
+from http import server
+
+import numpy as np
+import tensorflow as tf
+
+from nao.run import graph_execution
+from nao.tool import json_util
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+
+_EXPORT_RE = re.compile(r"^([^/]+/[^/]+)/(inputs|outputs)/([^/]+)$")
+
+class Histogram:
+  """Counts values in power-of-two buckets."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._buckets = {}
+    self._count = 0
+    self._sum = 0.0
+
+  def add(self, value):
+    bucket = 1
+    while bucket < value:
+      bucket *= 2
+
+    with self._lock:
+      self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+      self._count += 1
+      self._sum += value
+
+  def as_dict(self):
+    with self._lock:
+      return {
+        "count": self._count,
+        "mean": self._sum / self._count if self._count else 0.0,
+        "buckets": [[le, n] for le, n in sorted(self._buckets.items())],
+      }
+
+class _Request:
+  def __init__(self, feeds, rows):
+    self.feeds = feeds
+    self.rows = rows
+    self.start = time.time()
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+class ExportedFunction:
+  def __init__(self, name):
+    self.name = name
+    self.inputs = {} # input name -> placeholder tensor
+    self.outputs = {} # output name -> tensor
+
+  def batchable(self):
+    # We can only stack requests, and split the results back up, if every input
+    # and output has a dynamic leading dimension.
+    if not self.inputs or not self.outputs:
+      return False
+    for t in list(self.inputs.values()) + list(self.outputs.values()):
+      shape = t.get_shape()
+      if shape.ndims is None or shape.ndims == 0 or shape[0].value is not None:
+        return False
+    return True
+
+  def describe(self):
+    def describe_tensors(tensors):
+      return dict((name, {"dtype": t.dtype.name, "shape": str(t.get_shape())}) for name, t in tensors.items())
+
+    return {
+      "inputs": describe_tensors(self.inputs),
+      "outputs": describe_tensors(self.outputs),
+      "batchable": self.batchable(),
+    }
+
+def find_exported_functions(graph):
+  functions = {}
+  for op in graph.get_operations():
+    m = _EXPORT_RE.match(op.name)
+    if not m or len(op.outputs) == 0:
+      continue
+
+    fn_name, direction, name = m.groups()
+    if fn_name not in functions:
+      functions[fn_name] = ExportedFunction(fn_name)
+
+    if direction == "inputs":
+      functions[fn_name].inputs[name] = op.outputs[0]
+    else:
+      functions[fn_name].outputs[name] = op.outputs[0]
+
+  return functions
+
+class Batcher:
+  """Coalesces concurrent requests for one function into a single sess.run."""
+
+  def __init__(self, sess, fn, base_feed_dict, max_batch_size, max_delay_secs, stats):
+    self._sess = sess
+    self._fn = fn
+    self._base_feed_dict = base_feed_dict
+    self._batchable = fn.batchable()
+    self._max_batch_size = max_batch_size if self._batchable else 1
+    self._max_delay_secs = max_delay_secs
+    self._stats = stats
+    self._queue = queue.Queue()
+    self._output_names = sorted(fn.outputs.keys())
+    self._thread = threading.Thread(target=self._run, name="batcher %s" % fn.name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, feeds):
+    missing = set(self._fn.inputs.keys()) - set(feeds.keys())
+    if missing:
+      raise Exception("Missing inputs for %s: %s" % (self._fn.name, sorted(missing)))
+
+    arrays = {}
+    for name, value in feeds.items():
+      if name not in self._fn.inputs:
+        raise Exception("Unknown input for %s: %s" % (self._fn.name, name))
+      arrays[name] = np.asarray(value, dtype=self._fn.inputs[name].dtype.as_numpy_dtype)
+
+    rows = 1
+    if self._batchable:
+      row_counts = set(len(value) if value.ndim > 0 else None for value in arrays.values())
+      if len(row_counts) != 1 or None in row_counts:
+        raise Exception("Inputs for %s must all have the same number of rows, got: %s" % (
+            self._fn.name, dict((name, value.shape) for name, value in arrays.items())))
+      rows = row_counts.pop()
+
+    request = _Request(arrays, rows)
+    self._queue.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.result
+
+  def _take_batch(self):
+    batch = [self._queue.get()]
+    rows = batch[0].rows
+    deadline = time.time() + self._max_delay_secs
+    while rows < self._max_batch_size:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        request = self._queue.get(timeout=timeout)
+      except queue.Empty:
+        break
+      batch.append(request)
+      rows += request.rows
+    return batch, rows
+
+  def _run(self):
+    while True:
+      batch, rows = self._take_batch()
+      try:
+        feed_dict = dict(self._base_feed_dict)
+        for name, t in self._fn.inputs.items():
+          if len(batch) == 1:
+            feed_dict[t] = batch[0].feeds[name]
+          else:
+            feed_dict[t] = np.concatenate([r.feeds[name] for r in batch])
+
+        values = self._sess.run([self._fn.outputs[name] for name in self._output_names], feed_dict=feed_dict)
+        self._split(batch, rows, values)
+      except Exception as e:
+        for request in batch:
+          request.error = e
+
+      self._stats["batch_size"].add(rows)
+      now = time.time()
+      for request in batch:
+        self._stats["latency_ms"].add((now - request.start) * 1000)
+        request.done.set()
+
+  def _split(self, batch, rows, values):
+    offset = 0
+    for request in batch:
+      result = {}
+      for name, value in zip(self._output_names, values):
+        value = np.asarray(value)
+        if len(batch) > 1:
+          if value.ndim == 0 or len(value) != rows:
+            raise Exception("Output %s of %s has shape %s, expected %d rows" % (name, self._fn.name, value.shape, rows))
+          value = value[offset:offset + request.rows]
+        result[name] = json_util.Cleanse(value.tolist())
+      request.result = result
+      offset += request.rows
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, server.HTTPServer):
+  daemon_threads = True
+
+def _make_handler(functions, batchers, stats):
+  class Handler(server.BaseHTTPRequestHandler):
+    def _reply(self, code, data):
+      body = json.dumps(data).encode('utf-8')
+      self.send_response(code)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      if self.path == "/":
+        self._reply(200, dict((name, fn.describe()) for name, fn in functions.items()))
+      elif self.path == "/stats":
+        self._reply(200, dict((name, h.as_dict()) for name, h in stats.items()))
+      else:
+        self._reply(404, {"error": "No such path: %s" % self.path})
+
+    def do_POST(self):
+      fn_name = self.path.strip("/")
+      if fn_name not in batchers:
+        self._reply(404, {"error": "No such function: %s" % fn_name})
+        return
+
+      try:
+        length = int(self.headers.get("Content-Length", 0))
+        feeds = json.loads(self.rfile.read(length).decode('utf-8'))
+        self._reply(200, batchers[fn_name].submit(feeds))
+      except Exception as e:
+        self._reply(400, {"error": str(e)})
+
+    def log_message(self, format, *args):
+      pass
+
+  return Handler
+
+def serve(
+    meta_graph_def,
+    feed_dict_fn,
+    host="127.0.0.1",
+    port=8000,
+    max_batch_size=32,
+    max_delay_ms=5,
+    config=None):
+  """Serves every exported function in meta_graph_def over HTTP.
+
+  POST /<Pkg>/<Fn> with a JSON object of inputs to get a JSON object of
+  outputs. GET / describes the functions and GET /stats has latency and
+  batch size histograms.
+  """
+  with tf.Graph().as_default():
+    with graph_execution.create_session(config=config) as sess:
+      release_py_funcs = graph_execution.import_meta_graph(sess, meta_graph_def)
+      try:
+        base_feed_dict = feed_dict_fn()
+        tf.global_variables_initializer().run(feed_dict=base_feed_dict)
+
+        functions = find_exported_functions(sess.graph)
+        stats = {
+          "latency_ms": Histogram(),
+          "batch_size": Histogram(),
+        }
+        batchers = {}
+        for name, fn in functions.items():
+          batchers[name] = Batcher(sess, fn, base_feed_dict, max_batch_size, max_delay_ms / 1000.0, stats)
+          eprint("Serving %s (batchable: %s)" % (name, fn.batchable()))
+
+        httpd = _ThreadingHTTPServer((host, port), _make_handler(functions, batchers, stats))
+        eprint("Listening on http://%s:%d" % (host, port))
+        try:
+          httpd.serve_forever()
+        except KeyboardInterrupt:
+          pass
+        finally:
+          httpd.server_close()
+      finally:
+        release_py_funcs()
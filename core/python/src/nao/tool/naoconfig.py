@@ -0,0 +1,43 @@
+import json
+
+from os import path
+
+# .naoconfig marks the root of a workspace. When it isn't empty, it holds a
+# JSON object with workspace-wide settings. For example:
+#
+#   {
+#     "session": {"profile": "throughput", "intra_op_parallelism_threads": 24, "jit": true},
+#     "log": {"level": "warning", "categories": {"compile": "debug"}}
+#   }
+
+FILENAME = ".naoconfig"
+
+def config_path(workspace):
+  return path.join(workspace, FILENAME)
+
+def load(workspace):
+  filepath = config_path(workspace)
+  if not path.exists(filepath):
+    return {}
+
+  with open(filepath) as f:
+    data = f.read()
+
+  if not data.strip():
+    return {}
+
+  try:
+    return json.loads(data)
+  except ValueError as e:
+    raise Exception("Couldn't parse %s: %s" % (filepath, e))
+
+def save(workspace, config):
+  with open(config_path(workspace), "w") as f:
+    f.write(json.dumps(config, indent=2, sort_keys=True))
+    f.write("\n")
+
+def update(workspace, section, values):
+  config = load(workspace)
+  config[section] = dict(config.get(section, {}), **values)
+  save(workspace, config)
+  return config
@@ -16,97 +16,76 @@ const testCases = [
   ...require('./fixtures/arguments'),
   ...require('./fixtures/attributes'),
   ...require('./fixtures/tests'),
+  ...require('./fixtures/batch'),
+  ...require('./fixtures/jit'),
+  ...require('./fixtures/metagraph_imports'),
 ]
 
-testCases.forEach(
-  (tc) => {
-    test(tc.name, function (t) {
+function regExpToJSON(re) {
+  return re && {source: re.source, flags: re.flags};
+}
 
-      var action = tc.action || "run";
-      var shouldFail = tc.fails || false;
-      var additionalArgs = [];
-      var promise;
-      switch (action) {
-      case "test":
-        additionalArgs.push("--test");
-        break;
-      case "run":
-        additionalArgs.push("--run");
-        break;
-      default:
-        t.error(`Unknown action: ${action}`);
-        t.end();
-        return;
-      }
+function suiteCase(tc) {
+  return {
+    name: tc.name,
+    source: tc.source,
+    sources: tc.sources,
+    packages: tc.packages,
+    action: tc.action || "run",
+    fails: tc.fails || false,
+    match: regExpToJSON(tc.match),
+    antimatch: regExpToJSON(tc.antimatch),
+    expect: tc.expect,
+  };
+}
 
-      t.comment(tc.source);
-
-      function checkText(text) {
-        if (tc.match) {
-          if (!text.match(tc.match)) {
-            t.fail(`Output should match ${tc.match.toString()}: ${text}`);
-          }
-        }
-
-        if (tc.antimatch) {
-          if (text.match(tc.antimatch)) {
-            t.fail(`Output shouldn't match ${tc.antimatch.toString()}: ${text}`);
-          }
-        }
+// Run every case in a single nao process, so we only pay for interpreter,
+// TensorFlow and V8 startup once.
+function runSuite(cmd) {
+  const suiteTmpDir = tmp.dirSync({unsafeCleanup: true});
+  const suitePath = path.join(suiteTmpDir.name, "suite.json");
+  const reportPath = path.join(suiteTmpDir.name, "report.json");
+  fs.writeFileSync(suitePath, JSON.stringify(testCases.map(suiteCase)));
 
-        if (tc.expect) {
-          t.isEqual(text, tc.expect);
-        }
-      }
+  function readReport() {
+    try {
+      return JSON.parse(fs.readFileSync(reportPath).toString()).tests;
+    } finally {
+      suiteTmpDir.removeCallback();
+    }
+  }
 
-      var workspaceTmpDir;
-      if (tc.sources) {
-        // Create temporary directory.
-        workspaceTmpDir = tmp.dirSync({unsafeCleanup: true});
-        additionalArgs.push("--workspace", workspaceTmpDir.name);
+  // The suite exits non-zero if any case fails, but still writes its report.
+  return spawnProcess.withStdinCapturingStdout(
+    cmd,
+    ["--test-suite", suitePath, "--test-report", reportPath],
+    ""
+  ).then(readReport, readReport);
+}
 
-        const srcDir = path.join(workspaceTmpDir.name, "src");
-        fs.mkdirSync(srcDir)
-        // Populate directory.
-        for (const key in tc.sources) {
-          const content = tc.sources[key];
-          const p = path.join(srcDir, key);
-          fs.writeFileSync(p, content);
-        }
-      }
+var cmd = process.env['NAO'];
+var suite = cmd ? runSuite(cmd) : Promise.reject(new Error("NAO must be specified."));
 
-      var cmd = process.env['NAO'];
-      if (!cmd) {
-        t.fail("NAO must be specified.");
-        t.end();
-        return;
-      }
+testCases.forEach(
+  (tc, ix) => {
+    test(tc.name, function (t) {
+      t.comment(tc.source);
 
-      spawnProcess.withStdinCapturingStdout(
-        cmd,
-        [
-          "--source", tc.source,
-          ...additionalArgs,
-        ],
-        ""
-      )
-      .then(
-        (str) => {
-          checkText(str);
-          t.assert(!shouldFail, `Test should fail`);
+      suite.then(
+        (entries) => {
+          const entry = entries[ix];
+          if (entry.status !== "passed") {
+            t.fail(entry.error);
+          } else {
+            t.pass(`${entry.seconds.toFixed(3)}s`);
+          }
           t.end();
-          workspaceTmpDir && workspaceTmpDir.removeCallback();
         },
         (err) => {
-          checkText(err.message);
-
-          if (!shouldFail) {
-            t.error(err, `Test shouldn't fail`);
-          }
+          t.error(err);
           t.end();
-          workspaceTmpDir && workspaceTmpDir.removeCallback();
         }
-      )
+      );
     });
   }
 )
@@ -0,0 +1,70 @@
+/* @flow */
+'use strict';
+
+module.exports = [
+  {
+    name: "batch vectorizes elementwise function",
+    action: "test",
+    source: `func squarePlusOne(x float) {
+  emit y = x * x + 1.0
+}
+
+func TestBatch() {
+  let r = nao.batch[fn: squarePlusOne]({1.0, 2.0, 3.0})
+  tf.Assert(tf.reduce_all(r == {2.0, 5.0, 10.0}), {"r == {2.0, 5.0, 10.0}", r})
+
+  after __leaves { ← result = 0 }
+}
+`,
+  },
+  {
+    name: "batch vectorizes matmul against shared weights",
+    action: "test",
+    source: `func project(x float <2>) {
+  let w = {{1.0, 0.0}, {0.0, 2.0}}
+  emit y = tf.reshape(tf.matmul(tf.reshape(x, {1, 2}), w), {2})
+}
+
+func TestBatchMatmul() {
+  let r = nao.batch[fn: project]({{1.0, 1.0}, {2.0, 3.0}})
+  tf.Assert(tf.reduce_all(r == {{1.0, 2.0}, {2.0, 6.0}}), {"r", r})
+
+  after __leaves { ← result = 0 }
+}
+`,
+  },
+  {
+    name: "batch re-emits ops that use a shape query",
+    action: "test",
+    source: `func scaleBySize(x float <3>) {
+  let n = tf.to_float(tf.reduce_prod(tf.shape(x)))
+  emit y = x * n
+}
+
+func TestBatchShape() {
+  let r = nao.batch[fn: scaleBySize]({{1.0, 2.0, 3.0}, {4.0, 5.0, 6.0}})
+  tf.Assert(tf.reduce_all(r == {{3.0, 6.0, 9.0}, {12.0, 15.0, 18.0}}), {"r", r})
+
+  after __leaves { ← result = 0 }
+}
+`,
+  },
+  {
+    name: "batch falls back to map_fn for control flow",
+    action: "test",
+    source: `func doubleUntilTen(x float) {
+  let out = for let v = x; v < 10.0 {
+    <- v = v * 2.0
+  }
+  emit y = out:v
+}
+
+func TestBatchLoop() {
+  let r = nao.batch[fn: doubleUntilTen]({1.0, 3.0, 5.0})
+  tf.Assert(tf.reduce_all(r == {16.0, 12.0, 10.0}), {"r", r})
+
+  after __leaves { ← result = 0 }
+}
+`,
+  },
+];
@@ -0,0 +1,33 @@
+/* @flow */
+'use strict';
+
+module.exports = [
+  {
+    name: "jit marks each application for XLA separately",
+    action: "export",
+    source: `func square(x float) {
+  emit y = x * x
+}
+
+func Main() {
+  let fastSquare = nao.jit[fn: square]()
+  <- a = fastSquare(2.0)
+  <- b = fastSquare(3.0)
+}
+`,
+    match: /key: "_XlaCompile"\s*value \{\s*b: true[\s\S]*key: "_XlaScope"\s*value \{\s*s: "([^"]*jit_[^"]*)"[\s\S]*key: "_XlaScope"\s*value \{\s*s: "(?!\1")[^"]*jit_/,
+  },
+  {
+    name: "jit doesn't change results",
+    source: `func square(x float) {
+  emit y = x * x
+}
+
+func Main() {
+  let fastSquare = nao.jit[fn: square]()
+  <- result = fastSquare(3.0)
+}
+`,
+    match: /float_val: 9.0/,
+  },
+];
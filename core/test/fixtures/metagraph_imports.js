@@ -0,0 +1,47 @@
+/* @flow */
+'use strict';
+
+module.exports = [
+  {
+    name: "imported metagraph functions can be called more than once",
+    action: "test",
+    source: `import (
+  "arith"
+)
+
+func TestMetagraphImports() {
+  tf.Assert(arith.Double(2.0) == 4.0, {"arith.Double(2.0) == 4.0"})
+  tf.Assert(arith.Double(5.0) == 10.0, {"arith.Double(5.0) == 10.0"})
+  tf.Assert(arith.Increment(122.0) == 123.0, {"arith.Increment(122.0) == 123.0"})
+
+  <- x = after __leaves { 0 }
+}
+`,
+    packages: {
+      "arith": `
+func Double(n float) { emit x = n * 2.0 }
+func Increment(n float) { emit x = n + 1.0 }
+`,
+    },
+  },
+  {
+    name: "stateful metagraph functions are copied at each call",
+    action: "test",
+    source: `import (
+  "noisy"
+)
+
+func TestMetagraphImports() {
+  tf.Assert(tf.reduce_all(noisy.AddNothing(1.0) == {1.0, 1.0}), {"noisy.AddNothing(1.0) == {1.0, 1.0}"})
+  tf.Assert(tf.reduce_all(noisy.AddNothing(2.0) == {2.0, 2.0}), {"noisy.AddNothing(2.0) == {2.0, 2.0}"})
+
+  <- x = after __leaves { 0 }
+}
+`,
+    packages: {
+      "noisy": `
+func AddNothing(n float) { emit x = n + tf.random_uniform({2}) * 0.0 }
+`,
+    },
+  },
+];
@@ -0,0 +1,17 @@
+from tensorflow.python.framework import dtypes
+
+import numpy as np
+
+from nao.run import graph_checkpoint
+
+# Call Step with each completed step of a training loop so that
+# --checkpoint-every-* can snapshot it. Snapshots are taken while training
+# continues, so they may include updates from a few steps later.
+def Step(step) -> dtypes.int64:
+  graph_checkpoint.notify_step(int(step))
+  return 0
+
+# Use ResumeStep as the initial value of a training loop's counter so that
+# --resume continues where the last checkpoint left off.
+def ResumeStep() -> dtypes.int32:
+  return np.int32(graph_checkpoint.resume_step())